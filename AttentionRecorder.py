@@ -0,0 +1,112 @@
+'''
+ Opt-in recording of attention weights for case studies.
+'''
+
+import os
+import numpy as np
+import torch
+from typing import Tuple
+
+
+class AttentionRecorder:
+    """
+    Opt-in sink for the ConceptNet attention weights of KOALA, attached by setting model.attn_recorder.
+    Attention weights of each instance are written into fixed-size arrays padded with NaN:
+        state - (capacity, max_sents, max_cpnet)
+        loc   - (capacity, max_cands, max_sents + 1, max_cpnet), max_cands includes the unk location
+        sizes - (capacity, 3), number of sentences, candidates and triples of each instance
+    Without output_path the arrays are kept in RAM as a ring buffer, which keeps the last `capacity` instances.
+    With output_path they are memory-mapped .npy files ({output_path}.state.npy, .loc.npy and .sizes.npy),
+    which can be read back with AttentionRecorder.load. Records are written in the order of the forward calls,
+    so only use the recorder with a single device.
+    """
+    def __init__(self, capacity: int, max_sents: int, max_cands: int, max_cpnet: int, output_path: str = None):
+        self.capacity = capacity
+        self.output_path = output_path
+        self.num_records = 0
+        shapes = {'state': (capacity, max_sents, max_cpnet),
+                  'loc': (capacity, max_cands, max_sents + 1, max_cpnet)}
+
+        if output_path is None:
+            self.state = np.full(shapes['state'], np.nan, dtype=np.float32)
+            self.loc = np.full(shapes['loc'], np.nan, dtype=np.float32)
+            self.sizes = np.zeros((capacity, 3), dtype=np.int32)
+        else:
+            output_dir = os.path.dirname(output_path)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            self.state = np.lib.format.open_memmap(f'{output_path}.state.npy', mode='w+', dtype=np.float32,
+                                                   shape=shapes['state'])
+            self.loc = np.lib.format.open_memmap(f'{output_path}.loc.npy', mode='w+', dtype=np.float32,
+                                                 shape=shapes['loc'])
+            self.sizes = np.lib.format.open_memmap(f'{output_path}.sizes.npy', mode='w+', dtype=np.int32,
+                                                   shape=(capacity, 3))
+            self.state[:] = np.nan
+            self.loc[:] = np.nan
+
+
+    def __len__(self):
+        return min(self.num_records, self.capacity)
+
+
+    def record(self, state_attn_probs, loc_attn_probs, num_sents: torch.Tensor, num_cands: torch.Tensor,
+               cpnet_mask: torch.Tensor) -> None:
+        """
+        Record the attention weights of a batch.
+        Args:
+            state_attn_probs: size (batch, max_sents, num_cpnet), or None if ConceptNet is not injected to state tracking
+            loc_attn_probs: size (batch, max_cands, max_sents + 1, num_cpnet), or None
+            num_sents: size (batch,)
+            num_cands: number of location candidates of each instance (with the unk location), size (batch,)
+            cpnet_mask: size (batch, num_cpnet), 1 for real triples
+        """
+        sizes = torch.stack([num_sents.long(), num_cands.long(), cpnet_mask.sum(dim=-1).long()], dim=-1).cpu().numpy()
+        if state_attn_probs is not None:
+            state_attn_probs = state_attn_probs.detach().float().cpu().numpy()
+        if loc_attn_probs is not None:
+            loc_attn_probs = loc_attn_probs.detach().float().cpu().numpy()
+
+        for i, (sents, cands, cpnet) in enumerate(sizes):
+            assert self.output_path is None or self.num_records < self.capacity, 'Attention file is full'
+            row = self.num_records % self.capacity
+            self.state[row] = np.nan
+            self.loc[row] = np.nan
+            self.sizes[row] = (sents, cands, cpnet)
+            if state_attn_probs is not None:
+                self.state[row, :sents, :cpnet] = state_attn_probs[i, :sents, :cpnet]
+            if loc_attn_probs is not None:
+                self.loc[row, :cands, :sents + 1, :cpnet] = loc_attn_probs[i, :cands, :sents + 1, :cpnet]
+            self.num_records += 1
+
+
+    def get(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the attention weights of the index-th of the kept records, from the oldest to the newest.
+        Return:
+            state attention of size (num_sents, num_cpnet), location attention of size
+            (num_cands, num_sents + 1, num_cpnet). Both are NaN if they were not recorded.
+        """
+        assert 0 <= index < len(self)
+        row = (self.num_records - len(self) + index) % self.capacity
+        sents, cands, cpnet = self.sizes[row]
+        return self.state[row, :sents, :cpnet], self.loc[row, :cands, :sents + 1, :cpnet]
+
+
+    def flush(self) -> None:
+        if self.output_path is not None:
+            for array in [self.state, self.loc, self.sizes]:
+                array.flush()
+
+
+    @staticmethod
+    def load(output_path: str) -> 'AttentionRecorder':
+        """
+        Read the attention weights written to output_path by a previous run, without loading them into RAM.
+        """
+        recorder = AttentionRecorder.__new__(AttentionRecorder)
+        recorder.output_path = None  # read-only
+        recorder.state = np.load(f'{output_path}.state.npy', mmap_mode='r')
+        recorder.loc = np.load(f'{output_path}.loc.npy', mmap_mode='r')
+        recorder.sizes = np.load(f'{output_path}.sizes.npy', mmap_mode='r')
+        recorder.capacity = recorder.num_records = recorder.sizes.shape[0]
+        return recorder
@@ -0,0 +1,351 @@
+'''
+ Memory-mapped caches of dataset features and encoder hidden states.
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import numpy as np
+import torch
+from collections import OrderedDict
+from typing import List, Dict
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# bump this whenever the set of cached fields or their layout changes,
+# so that stale caches on disk are not picked up by newer code
+FEATURE_CACHE_VERSION = 2
+# same for the layout of the encoder caches (EncoderCache), which are rebuilt if their version differs
+ENCODER_CACHE_VERSION = 1
+
+
+def file_md5(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute the md5 digest of a file, reading it chunk by chunk.
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class FeatureCache:
+    """
+    On-disk cache of the per-instance tensors built by ProparaDataset.
+    Each field is stored as a flat binary file which is memory-mapped at load time,
+    together with the offsets and shapes of every instance, so that fetching an
+    instance is a zero-copy slice of the mapped file.
+
+    Layout of a cache directory:
+        meta.json           - cache version, key components, dtypes of the fields
+        {field}.bin         - flattened values of the field, concatenated over instances
+        {field}.offsets.npy - (num_instances + 1,) start offset of each instance in {field}.bin
+        {field}.shapes.npy  - (num_instances, ndim) shape of the field for each instance
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self.meta = json.load(open(os.path.join(cache_path, 'meta.json'), 'r', encoding='utf-8'))
+        assert self.meta['version'] == FEATURE_CACHE_VERSION
+        self.num_instances = self.meta['num_instances']
+        self.fields = self.meta['fields']
+        self.data, self.offsets, self.shapes = {}, {}, {}
+
+        for field, dtype in self.fields.items():
+            self.offsets[field] = np.load(os.path.join(cache_path, f'{field}.offsets.npy'))
+            self.shapes[field] = np.load(os.path.join(cache_path, f'{field}.shapes.npy'))
+            # copy-on-write mapping: pages are only read from disk, and torch.from_numpy
+            # won't complain about a non-writable buffer
+            if self.offsets[field][-1] > 0:
+                self.data[field] = np.memmap(os.path.join(cache_path, f'{field}.bin'), dtype=np.dtype(dtype), mode='c')
+            else:  # np.memmap cannot map empty files
+                self.data[field] = np.zeros(0, dtype=np.dtype(dtype))
+
+
+    def __len__(self):
+        return self.num_instances
+
+
+    def __getstate__(self):
+        # only pickle the path, so that DataLoader workers map the files themselves
+        # instead of receiving a copy of the mapped data
+        return {'cache_path': self.cache_path}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_path'])
+
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        features = {}
+        for field in self.fields:
+            start, end = self.offsets[field][index], self.offsets[field][index + 1]
+            shape = tuple(self.shapes[field][index])
+            features[field] = torch.from_numpy(self.data[field][start:end]).view(shape)
+        return features
+
+
+    @staticmethod
+    def get_cache_key(key_fields: Dict) -> str:
+        """
+        Compute the name of the cache directory from the fields that determine its content.
+        """
+        key_fields = dict(key_fields, version=FEATURE_CACHE_VERSION)
+        key_str = json.dumps(key_fields, sort_keys=True)
+        return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+    @staticmethod
+    def build(cache_path: str, key_fields: Dict, num_instances: int, build_fn) -> None:
+        """
+        Build a cache directory by calling build_fn(index) on every instance.
+        build_fn should return a dict of tensors, with the same fields and dtypes for every instance.
+        The cache is first written to a temporary directory and then renamed, so that an interrupted
+        build never leaves a half-written cache behind.
+        """
+        tmp_path = f'{cache_path}.tmp{os.getpid()}'
+        os.makedirs(tmp_path)
+
+        fields = None
+        bin_files, offsets, shapes = {}, {}, {}
+
+        for index in range(num_instances):
+            features = build_fn(index)
+
+            if fields is None:
+                fields = {field: str(value.numpy().dtype) for field, value in features.items()}
+                for field in fields:
+                    bin_files[field] = open(os.path.join(tmp_path, f'{field}.bin'), 'wb')
+                    offsets[field] = [0]
+                    shapes[field] = []
+            assert features.keys() == fields.keys()
+
+            for field, value in features.items():
+                value = value.contiguous().numpy()
+                assert str(value.dtype) == fields[field]
+                bin_files[field].write(value.tobytes())
+                offsets[field].append(offsets[field][-1] + value.size)
+                shapes[field].append(value.shape)
+
+        for field in fields:
+            bin_files[field].close()
+            np.save(os.path.join(tmp_path, f'{field}.offsets.npy'), np.array(offsets[field], dtype=np.int64))
+            np.save(os.path.join(tmp_path, f'{field}.shapes.npy'), np.array(shapes[field], dtype=np.int64))
+
+        meta = {'version': FEATURE_CACHE_VERSION,
+                'key': key_fields,
+                'num_instances': num_instances,
+                'fields': fields}
+        json.dump(meta, open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8'), indent=4)
+
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:  # another process finished building the same cache first
+            shutil.rmtree(tmp_path)
+
+
+    @staticmethod
+    def load_or_build(cache_dir: str, key_fields: Dict, num_instances: int, build_fn) -> 'FeatureCache':
+        """
+        Load the cache matching key_fields from cache_dir, or build it if it does not exist yet.
+        """
+        cache_path = os.path.join(cache_dir, FeatureCache.get_cache_key(key_fields))
+
+        if not os.path.exists(cache_path):
+            print(f'[INFO] Building feature cache at {cache_path}')
+            start_time = time.time()
+            os.makedirs(cache_dir, exist_ok=True)
+            FeatureCache.build(cache_path, key_fields=key_fields, num_instances=num_instances, build_fn=build_fn)
+            print(f'[INFO] Feature cache built. Time Elapse: {time.time() - start_time:.2f}s')
+
+        cache = FeatureCache(cache_path)
+        assert len(cache) == num_instances
+        print(f'[INFO] Loaded feature cache from {cache_path}')
+        return cache
+
+
+class EncoderCache:
+    """
+    Cache of the last hidden states of a frozen encoder (the ConceptNet encoder of KOALA, or its paragraph encoder
+    if it is not fine-tuned), one entry per distinct input sequence, keyed by the md5 digest of its token ids.
+    The cache directory should be specific to the encoder parameters (see KOALA.get_cache_path).
+    Recently used entries are kept in RAM (LRU), all entries are also appended to an on-disk store
+    which is memory-mapped, so that the cache survives across epochs, evaluations and runs.
+
+    Layout of a cache directory:
+        meta.json   - cache version, hidden size and dtype of the stored states
+        hidden.bin  - hidden states of all entries, concatenated, (total_tokens, hidden_size)
+        index.bin   - one record per entry: key digest, row offset in hidden.bin and number of tokens
+    An entry is written to hidden.bin before its index record, so an interrupted write is simply ignored.
+    """
+    index_dtype = np.dtype([('key', 'V16'), ('offset', '<i8'), ('length', '<i4')])  # 'S16' would strip trailing zero bytes
+
+    def __init__(self, cache_path: str, hidden_size: int, max_ram_mb: int = 1024, dtype: str = 'float32'):
+        os.makedirs(cache_path, exist_ok=True)
+        self.cache_path = cache_path
+        self.hidden_size = hidden_size
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = hidden_size * self.dtype.itemsize
+        self.max_ram_bytes = max_ram_mb * (1 << 20)
+        self.data_path = os.path.join(cache_path, 'hidden.bin')
+        self.index_path = os.path.join(cache_path, 'index.bin')
+
+        meta_path = os.path.join(cache_path, 'meta.json')
+        meta = {'version': ENCODER_CACHE_VERSION, 'hidden_size': hidden_size, 'dtype': str(self.dtype)}
+        if os.path.exists(meta_path) and json.load(open(meta_path, 'r', encoding='utf-8')) != meta:
+            print(f'[INFO] Rebuilding the incompatible encoder cache at {cache_path}')
+            for path in [meta_path, self.index_path, self.data_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if not os.path.exists(meta_path):
+            json.dump(meta, open(meta_path, 'w', encoding='utf-8'), indent=4)
+
+        self.ram_cache = OrderedDict()  # key -> tensor (length, hidden_size)
+        self.ram_bytes = 0
+        self.lock = threading.Lock()  # nn.DataParallel replicas share the cache across threads
+        self.data = None
+        self.index = {}
+        self.load_index()
+        self.hits, self.misses = 0, 0
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __getstate__(self):
+        state = {'cache_path': self.cache_path, 'hidden_size': self.hidden_size,
+                 'max_ram_mb': self.max_ram_bytes // (1 << 20), 'dtype': str(self.dtype)}
+        return state
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+    def load_index(self) -> None:
+        """
+        Read the entries written so far (also by other processes) and map the hidden states.
+        """
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as fin:
+            records = fin.read()
+        num_records = len(records) // self.index_dtype.itemsize  # ignore a partially written record
+        records = np.frombuffer(records, dtype=self.index_dtype, count=num_records)
+        self.index = {bytes(key): (offset, length) for key, offset, length
+                      in zip(records['key'], records['offset'].tolist(), records['length'].tolist())}
+        num_rows = os.path.getsize(self.data_path) // self.row_bytes
+        if num_rows > 0:
+            self.data = np.memmap(self.data_path, dtype=self.dtype, mode='r', shape=(num_rows, self.hidden_size))
+
+
+    @staticmethod
+    def get_key(token_ids: np.ndarray) -> bytes:
+        return hashlib.md5(token_ids.astype(np.int64).tobytes()).digest()
+
+
+    def get(self, key: bytes):
+        """
+        Return the cached hidden states of the sequence, or None if it is not cached.
+        """
+        with self.lock:
+            hidden = self.ram_cache.get(key)
+            if hidden is not None:
+                self.ram_cache.move_to_end(key)
+                self.hits += 1
+                return hidden
+
+            if key not in self.index:
+                self.misses += 1
+                return None
+            offset, length = self.index[key]
+            if self.data is None or offset + length > self.data.shape[0]:  # written after the file was mapped
+                self.load_index()
+            hidden = torch.from_numpy(np.array(self.data[offset:offset + length], dtype=np.float32))
+            self.add_to_ram(key, hidden)
+            self.hits += 1
+            return hidden
+
+
+    def put(self, key: bytes, hidden: torch.Tensor) -> None:
+        """
+        Add the hidden states of a sequence, size (length, hidden_size), to the cache.
+        """
+        values = hidden.detach().float().cpu().numpy().astype(self.dtype)  # a copy, not a view of a larger batch
+        hidden = torch.from_numpy(values.astype(np.float32))  # same values as the ones read back from disk
+        with self.lock:
+            if key in self.index:
+                return
+            with open(self.data_path, 'ab') as data_file, open(self.index_path, 'ab') as index_file:
+                if fcntl is not None:  # other processes may share the same cache directory
+                    fcntl.flock(index_file, fcntl.LOCK_EX)
+                data_file.seek(0, os.SEEK_END)
+                data_size = data_file.tell()
+                if data_size % self.row_bytes != 0:  # skip the partial row left by an interrupted write
+                    data_file.write(bytes(self.row_bytes - data_size % self.row_bytes))
+                    data_size += self.row_bytes - data_size % self.row_bytes
+                offset = data_size // self.row_bytes
+                data_file.write(values.tobytes())
+                data_file.flush()
+                record = np.array([(key, offset, len(values))], dtype=self.index_dtype)
+                index_file.write(record.tobytes())
+                if fcntl is not None:
+                    fcntl.flock(index_file, fcntl.LOCK_UN)
+            self.index[key] = (offset, len(values))
+            self.add_to_ram(key, hidden)
+
+
+    def add_to_ram(self, key: bytes, hidden: torch.Tensor) -> None:
+        self.ram_cache[key] = hidden
+        self.ram_bytes += hidden.numel() * hidden.element_size()
+        while self.ram_bytes > self.max_ram_bytes and len(self.ram_cache) > 1:
+            _, evicted = self.ram_cache.popitem(last=False)
+            self.ram_bytes -= evicted.numel() * evicted.element_size()
+
+
+    def encode(self, encoder, input_ids: torch.LongTensor, attention_mask: torch.LongTensor) -> torch.Tensor:
+        """
+        Get the last hidden states of the encoder from the cache,
+        and only run the encoder on the sequences that are not cached yet.
+        The encoder is run in eval mode, so that the cached states do not depend on dropout.
+        Args:
+            input_ids: size (batch, seq_len)
+            attention_mask: 1 for real tokens and 0 for padding, size (batch, seq_len)
+        Return:
+            last_hidden: size (batch, seq_len, hidden_size), hidden states of padding tokens are zeros
+        """
+        batch_size, seq_len = input_ids.size()
+        seq_lens = attention_mask.sum(dim=-1).tolist()
+        input_array = input_ids.cpu().numpy()
+        last_hidden = torch.zeros((batch_size, seq_len, self.hidden_size), dtype=torch.float)
+        keys, missed = {}, []
+
+        for i, length in enumerate(seq_lens):
+            keys[i] = self.get_key(input_array[i, :length])
+            hidden = self.get(keys[i])
+            if hidden is None:
+                missed.append(i)
+            else:
+                last_hidden[i, :length] = hidden
+
+        if missed:
+            miss_max_len = max(seq_lens[i] for i in missed)
+            miss_index = torch.tensor(missed, dtype=torch.long, device=input_ids.device)
+            was_training = encoder.training
+            encoder.eval()
+            with torch.no_grad():
+                outputs = encoder(input_ids[miss_index, :miss_max_len],
+                                  attention_mask=attention_mask[miss_index, :miss_max_len])
+            encoder.train(was_training)
+            miss_hidden = outputs[0].float().cpu()
+            for j, i in enumerate(missed):
+                self.put(keys[i], miss_hidden[j, :seq_lens[i]])
+                last_hidden[i, :seq_lens[i]] = self.get(keys[i])
+
+        return last_hidden.to(input_ids.device)
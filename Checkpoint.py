@@ -0,0 +1,206 @@
+'''
+ Checkpoint utilities: random states, background atomic writes and memory-mapped model files.
+'''
+
+import os
+import json
+import queue
+import random
+import threading
+import numpy as np
+import torch
+import torch.nn as nn
+from typing import List, Dict, Callable
+
+# dtype names of the safetensors layout
+FLAT_DTYPES = {torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+               torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8',
+               torch.uint8: 'U8', torch.bool: 'BOOL'}
+
+
+def get_rng_state() -> Dict:
+    """
+    Collect the states of all random number generators used in training (python, numpy, torch and cuda).
+    """
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict) -> None:
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(obj):
+    """
+    Copy all tensors of a (nested) state dict to CPU, so that they are not changed by later training steps.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, path: str) -> None:
+    """
+    torch.save to a temporary file which then replaces the target, so that the target is either
+    the complete old file or the complete new file, even if the process is killed while writing.
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as fout:
+        torch.save(obj, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints from a background thread, so that training does not wait for the disk.
+    save() takes a snapshot of the tensors in the calling thread and returns; the files are then written
+    in order by atomic_save. At most max_pending checkpoints are queued, after that save() waits.
+    Errors of the writer thread are raised by the next call of save(), wait() or close().
+    """
+    def __init__(self, max_pending: int = 4):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                atomic_save(obj, path)
+            except Exception as error:  # raised in the training thread
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+
+    def check_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Failed to write checkpoint') from error
+
+
+    def save(self, obj, path: str) -> None:
+        self.check_error()
+        self.queue.put((snapshot(obj), path))
+
+
+    def wait(self) -> None:
+        """
+        Block until all queued checkpoints are written.
+        """
+        self.queue.join()
+        self.check_error()
+
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        self.check_error()
+
+
+def save_flat_model(model: nn.Module, path: str, shared_modules: List[str] = ()) -> None:
+    """
+    Save all parameters and buffers of a model, including the non-persistent buffers that are not in its state dict,
+    to a flat file in the safetensors layout, which can be memory-mapped by load_flat_model:
+        8 bytes - size of the header, little-endian
+        header  - JSON, {tensor name: {'dtype', 'shape', 'data_offsets': [begin, end]}, '__metadata__': {...}}
+        data    - raw bytes of all tensors, back to back
+    shared_modules are submodules with the same structure (e.g., both BERT encoders of KOALA). If they are loaded
+    from the same pretrained weights, a tensor that is equal to the one with the same name in an earlier module
+    of the list is stored once, and its name is listed in __metadata__['aliases']. So is a tensor registered
+    under several names. Tensors with larger elements are stored first, so that every tensor is aligned to its
+    element size.
+    """
+    tensors = dict(model.named_parameters(remove_duplicate=False))
+    tensors.update(model.named_buffers(remove_duplicate=False))
+    arrays, aliases, stored = {}, {}, {}  # stored: id of a tensor -> name
+    for name, tensor in tensors.items():
+        if id(tensor) in stored:  # the same tensor registered under several names
+            aliases[name] = stored[id(tensor)]
+            continue
+        module, _, suffix = name.partition('.')
+        if module in shared_modules:
+            targets = [f'{other}.{suffix}' for other in shared_modules[:shared_modules.index(module)]]
+            target = next((target for target in targets if target in arrays and tensors[target].dtype == tensor.dtype
+                           and torch.equal(tensors[target], tensor)), None)
+            if target is not None:
+                aliases[name] = target
+                continue
+        stored[id(tensor)] = name
+        arrays[name] = tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy()
+
+    names = sorted(arrays, key=lambda name: -tensors[name].element_size())
+    header, offset = {}, 0
+    for name in names:
+        header[name] = {'dtype': FLAT_DTYPES[tensors[name].dtype], 'shape': list(tensors[name].shape),
+                        'data_offsets': [offset, offset + arrays[name].size]}
+        offset += arrays[name].size
+    header['__metadata__'] = {'format': 'pt', 'aliases': json.dumps(aliases)}
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-len(header) % 8)  # the data starts at a multiple of 8 bytes
+
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(len(header).to_bytes(8, 'little'))
+        fout.write(header)
+        for name in names:
+            fout.write(arrays[name].data)
+    os.replace(tmp_path, path)
+
+
+def load_flat_tensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Memory-map the tensors of a file saved by save_flat_model, including the aliases.
+    The mapping is copy-on-write, so pages are only read from disk when they are accessed,
+    and modifying a tensor does not change the file.
+    """
+    with open(path, 'rb') as fin:
+        header_size = int.from_bytes(fin.read(8), 'little')
+        header = json.loads(fin.read(header_size))
+    metadata = header.pop('__metadata__', {})
+
+    data_size = max([info['data_offsets'][1] for info in header.values()], default=0)
+    data = torch.from_numpy(np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size, shape=(data_size,)))
+    flat_dtypes = {name: dtype for dtype, name in FLAT_DTYPES.items()}
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info['data_offsets']
+        tensors[name] = data[begin:end].view(flat_dtypes[info['dtype']]).view(info['shape'])
+    for name, target in json.loads(metadata.get('aliases', '{}')).items():
+        tensors[name] = tensors[target]
+    return tensors
+
+
+def load_flat_model(build_model: Callable[[], nn.Module], path: str) -> nn.Module:
+    """
+    Build the model skeleton with build_model() on the meta device, which neither allocates nor initializes
+    the parameters, then assign the tensors memory-mapped from a file saved by save_flat_model.
+    Aliased tensors (e.g., identical encoders) share the same memory.
+    """
+    tensors = load_flat_tensors(path)
+    with torch.device('meta'):
+        model = build_model()
+
+    model.load_state_dict({name: tensors[name] for name in model.state_dict()}, assign=True)
+    for name, buffer in list(model.named_buffers()):  # non-persistent buffers are not in the state dict
+        if buffer.is_meta:
+            module_name, _, buffer_name = name.rpartition('.')
+            model.get_submodule(module_name).register_buffer(buffer_name, tensors[name], persistent=False)
+    return model
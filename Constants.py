@@ -13,6 +13,16 @@ PAD_STATE = -1
 
 NUM_STATES = len(state2idx)
 
+# state transitions that can appear in a gold state sequence (see compute_state_change_seq in preprocess.py),
+# used by -crf_constraints. O_D can not be the first state, since the entity is not created yet.
+START_STATES = ['O_C', 'E', 'M', 'C', 'D']
+STATE_TRANSITIONS = {'O_C': ['O_C', 'C'],
+                     'O_D': ['O_D', 'C'],
+                     'E': ['E', 'M', 'D'],
+                     'M': ['E', 'M', 'D'],
+                     'C': ['E', 'M', 'D'],
+                     'D': ['O_D', 'C']}
+
 MODEL_CLASSES = {
     'bert': (BertModel, BertTokenizer, BertConfig),
     'roberta': (RobertaModel, RobertaTokenizer, RobertaConfig),
@@ -10,9 +10,12 @@ import json
 import os
 import time
 import numpy as np
+import itertools
 from typing import List, Dict
 from Constants import *
 from utils import *
+from Cache import FeatureCache, file_md5
+from InstanceStore import InstanceStore, Instance
 
 
 class ProparaDataset(torch.utils.data.Dataset):
@@ -24,36 +27,94 @@ class ProparaDataset(torch.utils.data.Dataset):
         print(f'[INFO] Load data from {data_path}')
         start_time = time.time()
 
-        self.dataset = json.load(open(data_path, 'r', encoding='utf-8'))
+        self.dataset = InstanceStore(data_path)
         self.tokenizer = tokenizer
         self.cpnet_struc_input = opt.cpnet_struc_input
+        self.stem_vocab = StemVocab()
         self.cpnet = self.read_cpnet(opt.cpnet_path)
         self.verb_dict = json.load(open(opt.state_verb, 'r', encoding='utf-8'))
+        # verbs in verb_dict are already stemmed
+        self.state_token_ids = {'C': self.stem_vocab.get_ids(self.verb_dict['create']),
+                                'M': self.stem_vocab.get_ids(self.verb_dict['move']),
+                                'D': self.stem_vocab.get_ids(self.verb_dict['destroy'])}
         self.state2idx = state2idx
         self.idx2state = idx2state
         self.is_test = is_test
+        self.sparse_mask = opt.sparse_mask
+        self.instance_sizes = None
 
         print(f'[INFO] {len(self.dataset)} instances of data loaded. Time Elapse: {time.time() - start_time}s')
 
+        self.feature_cache = None
+        if opt.feature_cache:
+            key_fields = {'tokenizer': f'{type(tokenizer).__name__}-{opt.plm_model_name}',
+                          'cpnet_struc_input': self.cpnet_struc_input,
+                          'sparse_mask': self.sparse_mask,
+                          'cpnet': file_md5(opt.cpnet_path),
+                          'state_verb': file_md5(opt.state_verb),
+                          'data': self.dataset.fingerprint()}
+            self.feature_cache = FeatureCache.load_or_build(cache_dir=opt.feature_cache, key_fields=key_fields,
+                                                            num_instances=len(self.dataset),
+                                                            build_fn=lambda idx: self.build_features(self.dataset[idx]))
+
     
     def __len__(self):
         return len(self.dataset)
 
 
+    def get_instance_sizes(self) -> np.ndarray:
+        """
+        Get the size of each instance along the dimensions padded by Collate, used for length bucketing.
+        Return:
+            an int array of size (num_instances, 3), containing total_subwords, total_loc_cands and total_sents
+        """
+        if self.instance_sizes is not None:
+            return self.instance_sizes
+
+        if self.feature_cache is not None:
+            total_subwords = self.feature_cache.shapes['token_ids'][:, 0]
+        else:
+            para_subwords = {}  # the same paragraph is shared by the instances of all its entities
+            for instance in self.dataset:
+                if instance.para_id not in para_subwords:
+                    para_subwords[instance.para_id] = len(self.tokenizer.tokenize(instance.paragraph.text)) + 2
+            total_subwords = [para_subwords[instance.para_id] for instance in self.dataset]
+
+        total_loc_cands = [instance.total_loc_cands for instance in self.dataset]
+        total_sents = [instance.total_sents for instance in self.dataset]
+        self.instance_sizes = np.stack([total_subwords, total_loc_cands, total_sents], axis=-1).astype(np.int64)
+        return self.instance_sizes
+
+
     def read_cpnet(self, cpnet_path: str):
         """
         Read the retrieved ConceptNet triples for each instance.
+        Each distinct triple is tokenized only once and stored in a shared table:
+            self.cpnet_triples - tokenized triple strings, used for display
+            self.cpnet_stem_ids - stemmed content words of each triple, used for finding relevant triples
+            self.cpnet_token_ids, self.cpnet_offsets - token ids of all triples, concatenated,
+                                                       and the start offset of each triple
+        Return:
+            a dict mapping each instance to the indices of its triples in the table
         """
         cpnet = json.load(open(cpnet_path, 'r', encoding='utf-8'))
         cpnet_dict = {}
+        triple2idx = {}
+        self.cpnet_triples = []
+        self.cpnet_stem_ids = []
+        cpnet_token_ids = []
 
         for instance in cpnet:
             para_id = instance['id']
             entity = instance['entity']
             cpnet_triples = instance['cpnet']
-            cpnet_sents = []
+            cpnet_index = []
 
             for triple in cpnet_triples:
+                if triple in triple2idx:  # the same triple is often retrieved for several instances
+                    cpnet_index.append(triple2idx[triple])
+                    continue
+
                 fields = triple.split(', ')
                 assert len(fields) == 11 or len(fields) == 13
                 sentence = fields[10]
@@ -75,80 +136,135 @@ class ProparaDataset(torch.utils.data.Dataset):
                 else:
                     final_sent_tokens = [self.tokenizer.cls_token] + sent_tokens + [self.tokenizer.sep_token]
 
-                cpnet_sents.append(' '.join(final_sent_tokens))
+                triple2idx[triple] = len(self.cpnet_triples)
+                cpnet_index.append(len(self.cpnet_triples))
+                self.cpnet_triples.append(' '.join(final_sent_tokens))
+                self.cpnet_stem_ids.append(self.stem_vocab.encode(self.cpnet_triples[-1]))
+                cpnet_token_ids.append(self.tokenizer.convert_tokens_to_ids(final_sent_tokens))
+
+            cpnet_dict[f'{para_id}-{entity}'] = cpnet_index
 
-            cpnet_dict[f'{para_id}-{entity}'] = cpnet_sents
+        triple_lens = [len(ids) for ids in cpnet_token_ids]
+        self.cpnet_token_ids = np.fromiter(itertools.chain.from_iterable(cpnet_token_ids), dtype=np.int64,
+                                           count=sum(triple_lens))
+        self.cpnet_offsets = np.concatenate([[0], np.cumsum(triple_lens)]).astype(np.int64)
+        print(f'[INFO] {len(self.cpnet_triples)} distinct ConceptNet triples loaded')
 
         return cpnet_dict
 
 
-    def convert_wordmask_to_subwordmask(self, mask, offset_map):
+    def get_cpnet_triples(self, para_id: int, entity: str) -> List[str]:
         """
-        Map the word indices in 'mask' to subword indices
+        Get the tokenized ConceptNet triples of an instance.
         """
-        num_subword = len(offset_map)
-        return [1 if mask[offset_map[i]] == 1 else 0 for i in range(num_subword)]
+        return [self.cpnet_triples[idx] for idx in self.cpnet[f'{para_id}-{entity}']]
 
 
-    def get_word_mask(self, mention_idx: List[int], offset_map: List[int], para_len: int) -> List[int]:
+    def get_mask_matrix(self, rows: np.ndarray, cols: np.ndarray, num_masks: int,
+                        offset_map: List[int], para_len: int) -> np.ndarray:
         """
-        Given a list of mention positions of the entity/verb/location in a paragraph,
-        compute the mask of it.
+        Given the mention positions of the entity/verb/location in a paragraph,
+        compute all of their subword masks at once.
+        Args:
+            rows - index of the mask that each mentioned word belongs to
+            cols - word index of each mentioned word in the paragraph
+            offset_map - word index of each subword, size (num_subwords,)
+        Return:
+            a mask matrix of size (num_masks, num_subwords + 2), with positions for <CLS> & <SEP>
         """
-        word_mask =  [1 if i in mention_idx else 0 for i in range(para_len)]
-        subword_mask = self.convert_wordmask_to_subwordmask(mask=word_mask, offset_map=offset_map)
-        # prepare positions for <CLS> & <SEP>
-        subword_mask = [0] + subword_mask + [0]
+        in_range = (cols >= 0) & (cols < para_len)
+
+        word_mask = np.zeros((num_masks, para_len), dtype=np.int32)
+        word_mask[rows[in_range], cols[in_range]] = 1
+        subword_mask = np.zeros((num_masks, len(offset_map) + 2), dtype=np.int32)
+        subword_mask[:, 1:-1] = word_mask[:, offset_map]  # map the word indices to subword indices
         return subword_mask
 
 
-    def get_sentence_mention(self, sentence_list: List, para_len: int):
+    def build_masks(self, instance: Instance, offset_map: List[int]):
         """
-        Get the indexes of a given sentence.
+        Compute the sentence, entity, verb and location masks of an instance in one pass.
+        Return:
+            sentence_mask, entity_mask, verb_mask - size (num_sents, num_tokens)
+            loc_mask - size (num_cands, num_sents + 1, num_tokens), with an empty mask for location 0
         """
-        sentence_mentions = []
-        sentence_lengths = [x['total_tokens'] for x in sentence_list]
-        assert sum(sentence_lengths) == para_len
-        prev_tokens = 0
-
-        for length in sentence_lengths:
-            mention_idx = [idx for idx in range(prev_tokens, prev_tokens + length)]
-            sentence_mentions.append(mention_idx)
-            prev_tokens += length
-
-        return sentence_mentions
-
-
-    def __getitem__(self, index: int):
-
-        instance = self.dataset[index]
-
-        entity_name = instance['entity']  # used in the evaluation process
-        para_id = instance['id']  # used in the evaluation process
-        total_words = instance['total_tokens']  # used in compute mask vector
-        total_sents = instance['total_sents']
-        total_loc_cands = instance['total_loc_candidates']
-        loc_cand_list = instance['loc_cand_list']
-        loc_cand_list = ['?'] + loc_cand_list
+        paragraph = instance.paragraph
+        total_sents = instance.total_sents
+        total_loc_cands = instance.total_loc_cands
+        para_len = paragraph.total_words
+        assert paragraph.sentence_lens.sum() == para_len
+
+        # each sentence covers a consecutive span of words
+        sentence_rows = np.repeat(np.arange(total_sents), paragraph.sentence_lens)
+        entity_rows = instance.entity_mention.list_ids() + total_sents
+        verb_rows = instance.verb_mention.list_ids() + 2 * total_sents
+        # mentions of candidate c in sentence s go to loc_mask[c, s + 1]
+        loc_list_ids = instance.loc_mention.list_ids()
+        sent_idx, cand_idx = np.divmod(loc_list_ids, max(total_loc_cands, 1))
+        loc_rows = 3 * total_sents + cand_idx * (total_sents + 1) + sent_idx + 1
+
+        rows = np.concatenate([sentence_rows, entity_rows, verb_rows, loc_rows])
+        cols = np.concatenate([np.arange(para_len), instance.entity_mention.indices, instance.verb_mention.indices,
+                               instance.loc_mention.indices])
+        mask_matrix = self.get_mask_matrix(rows, cols, num_masks=3 * total_sents + total_loc_cands * (total_sents + 1),
+                                           offset_map=offset_map, para_len=para_len)
+        mask_matrix = torch.from_numpy(mask_matrix)
+        num_tokens = mask_matrix.size(-1)
+
+        sentence_mask = mask_matrix[:total_sents]
+        entity_mask = mask_matrix[total_sents:2 * total_sents]
+        verb_mask = mask_matrix[2 * total_sents:3 * total_sents]
+        loc_mask = mask_matrix[3 * total_sents:].view(total_loc_cands, total_sents + 1, num_tokens)
+
+        return sentence_mask, entity_mask, verb_mask, loc_mask
+
+
+    def build_features(self, instance: Instance) -> Dict[str, torch.Tensor]:
+        """
+        Build all tensors of an instance from its record in the instance store.
+        The output only depends on the dataset files and the tokenizer, so it can be cached on disk.
+        """
+        total_words = instance.paragraph.total_words  # used in compute mask vector
+        loc_cand_list = ['?'] + list(instance.loc_cand_list)
 
-        paragraph = instance['paragraph']
+        paragraph = instance.paragraph.text
         assert len(paragraph.strip().split()) == total_words
         tokens = self.tokenizer.tokenize(paragraph)
         if isinstance(self.tokenizer, BertTokenizer):
             offset_map = bert_subword_map(origin_tokens=paragraph.strip().split(), tokens=tokens)
         else:
             raise ValueError(f'Did not provide mapping function for tokenizer {type(self.tokenizer)}')
-
-        metadata = {'para_id': para_id,
-                    'entity': entity_name,
-                    'total_subwords': len(tokens)+2,  # subwords + <CLS> + <SEP>
-                    'total_sents': total_sents,
-                    'total_loc_cands': total_loc_cands,
-                    'loc_cand_list': loc_cand_list,
-                    'raw_gold_loc': instance['gold_loc_seq']
+        token_ids = self.tokenizer.convert_tokens_to_ids([self.tokenizer.cls_token] + tokens + [self.tokenizer.sep_token])
+
+        sentence_mask_list, entity_mask_list, verb_mask_list, loc_mask_list = \
+            self.build_masks(instance, offset_map=offset_map)
+        cpnet_index = self.cpnet[f'{instance.para_id}-{instance.entity}']
+
+        features = {'token_ids': torch.LongTensor(token_ids),
+                    'offset_map': torch.LongTensor(offset_map),
+                    'sentence_mask': sentence_mask_list,
+                    'entity_mask': entity_mask_list,
+                    'verb_mask': verb_mask_list,
+                    'loc_mask': loc_mask_list,
+                    'cpnet_index': torch.LongTensor(cpnet_index)
                     }
+        if instance.has_labels:
+            features.update(self.build_labels(instance, loc_cand_list=loc_cand_list, cpnet_index=cpnet_index))
 
-        gold_state_seq = torch.IntTensor([self.state2idx[label] for label in instance['gold_state_seq']])
+        if self.sparse_mask:
+            for field in ['verb_mask', 'loc_mask']:
+                span_mask = SpanMask.from_dense(features.pop(field))
+                features[f'{field}_tokens'] = span_mask.token_idx
+                features[f'{field}_segments'] = span_mask.segment_idx
+
+        return features
+
+
+    def build_labels(self, instance: Instance, loc_cand_list: List[str], cpnet_index: List[int]) -> Dict[str, torch.Tensor]:
+        """
+        Build the gold state and location sequences and the ConceptNet relevance labels of a labeled instance.
+        """
+        gold_state_seq = torch.IntTensor([self.state2idx[label] for label in instance.gold_state_seq])
 
         loc2idx = {candidate: idx for idx, candidate in enumerate(loc_cand_list)}
         loc2idx['-'] = NIL_LOC
@@ -157,54 +273,215 @@ class ProparaDataset(torch.utils.data.Dataset):
         # for train and dev sets, all gold locations should have been included in candidate set
         # for test set, the gold location may not in the candidate set
         gold_loc_seq = torch.IntTensor([loc2idx[loc] if loc in loc2idx else UNK_LOC
-                                            for loc in instance['gold_loc_seq']])
+                                            for loc in instance.gold_loc_seq])
 
         assert gold_loc_seq.size(-1) == gold_state_seq.size(-1) + 1
-        sentence_list = instance['sentence_list']
-        sentences = [x['sentence'] for x in sentence_list]
-        assert total_sents == len(sentence_list)
-        sentence_mention = self.get_sentence_mention(sentence_list, total_words)
-
-        # (num_sent, num_tokens)
-        sentence_mask_list = torch.IntTensor([self.get_word_mask(sentence_mention[i], offset_map, total_words)
-                                            for i in range(len(sentence_mention))])
-        # (num_sent, num_tokens)
-        entity_mask_list = torch.IntTensor([self.get_word_mask(sent['entity_mention'], offset_map, total_words)
-                                            for sent in sentence_list])
-        # (num_sent, num_tokens)
-        verb_mask_list = torch.IntTensor([self.get_word_mask(sent['verb_mention'], offset_map, total_words)
-                                          for sent in sentence_list])
-        # (num_cand, num_sent, num_tokens)
-        loc_mask_list = torch.IntTensor([[self.get_word_mask(sent['loc_mention_list'][idx], offset_map, total_words)
-                                          for sent in sentence_list] for idx in range(total_loc_cands)])
-        # add an empty mask vector for location 0
-        empty_mask = torch.zeros((total_loc_cands, 1, loc_mask_list.size(-1)), dtype=torch.int)
-        loc_mask_list = torch.cat([empty_mask, loc_mask_list], dim=1)
-
-        cpnet_triples = self.cpnet[f'{para_id}-{entity_name}']
+
         # (num_sents, num_cands)
-        state_rel_labels, loc_rel_labels = find_relevant_triple(gold_loc_seq=instance['gold_loc_seq'],
-                                                                gold_state_seq=instance['gold_state_seq'],
-                                                                verb_dict=self.verb_dict,
-                                                                cpnet_triples=cpnet_triples)
+        state_rel_labels, loc_rel_labels = find_relevant_triple(gold_loc_seq=instance.gold_loc_seq,
+                                                                gold_state_seq=instance.gold_state_seq,
+                                                                state_token_ids=self.state_token_ids,
+                                                                triple_token_ids=[self.cpnet_stem_ids[idx]
+                                                                                  for idx in cpnet_index],
+                                                                stem_vocab=self.stem_vocab)
+
+        return {'gold_loc_seq': gold_loc_seq,
+                'gold_state_seq': gold_state_seq,
+                'state_rel_labels': state_rel_labels,
+                'loc_rel_labels': loc_rel_labels
+                }
+
+
+    def __getitem__(self, index: int):
+
+        instance = self.dataset[index]
+
+        if self.feature_cache is not None:
+            features = self.feature_cache[index]  # zero-copy slices of the memory-mapped cache
+        else:
+            features = self.build_features(instance)
+
+        entity_name = instance.entity  # used in the evaluation process
+        para_id = instance.para_id  # used in the evaluation process
+        total_subwords = features['token_ids'].size(0)  # subwords + <CLS> + <SEP>
+        total_sents = instance.total_sents
+        total_loc_cands = instance.total_loc_cands
+        loc_cand_list = ['?'] + list(instance.loc_cand_list)
+
+        if self.sparse_mask:
+            verb_mask = SpanMask(token_idx=features['verb_mask_tokens'], segment_idx=features['verb_mask_segments'],
+                                 shape=(total_sents, total_subwords))
+            loc_mask = SpanMask(token_idx=features['loc_mask_tokens'], segment_idx=features['loc_mask_segments'],
+                                shape=(total_loc_cands, total_sents + 1, total_subwords))
+        else:
+            verb_mask = features['verb_mask']
+            loc_mask = features['loc_mask']
+
+        metadata = {'para_id': para_id,
+                    'entity': entity_name,
+                    'total_subwords': total_subwords,
+                    'total_sents': total_sents,
+                    'total_loc_cands': total_loc_cands,
+                    'loc_cand_list': loc_cand_list,
+                    'raw_gold_loc': list(instance.gold_loc_seq) if instance.has_labels else None
+                    }
 
         sample = {'metadata': metadata,
-                  'paragraph': paragraph,
-                  'sentences': sentences,
-                  'gold_loc_seq': gold_loc_seq,
-                  'gold_state_seq': gold_state_seq,
-                  'sentence_mask': sentence_mask_list,
-                  'entity_mask': entity_mask_list,
-                  'verb_mask': verb_mask_list,
-                  'loc_mask': loc_mask_list,
-                  'cpnet': cpnet_triples,
-                  'state_rel_labels': state_rel_labels,
-                  'loc_rel_labels': loc_rel_labels
+                  'paragraph': instance.paragraph.text,
+                  'sentences': list(instance.paragraph.sentences),
+                  'token_ids': features['token_ids'],
+                  'offset_map': features['offset_map'],
+                  'sentence_mask': features['sentence_mask'],
+                  'entity_mask': features['entity_mask'],
+                  'verb_mask': verb_mask,
+                  'loc_mask': loc_mask,
+                  'cpnet': self.get_cpnet_triples(para_id, entity_name),
+                  'cpnet_ids': [torch.from_numpy(self.cpnet_token_ids[self.cpnet_offsets[idx]:self.cpnet_offsets[idx + 1]])
+                                for idx in features['cpnet_index'].tolist()]
                 }
+        if instance.has_labels:
+            for field in ['gold_loc_seq', 'gold_state_seq', 'state_rel_labels', 'loc_rel_labels']:
+                sample[field] = features[field]
 
         return sample
 
 
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    A batch sampler that groups instances of similar sizes into the same batch, to reduce the padding done by Collate.
+    Instances are sorted by (total_subwords, total_loc_cands, total_sents).
+    If shuffle, instances are first shuffled and split into pools of pool_size batches, then sorted within each pool,
+    and the order of the batches is shuffled again. Otherwise, all instances are sorted.
+    """
+    def __init__(self, sizes: np.ndarray, batch_size: int, shuffle: bool, pool_size: int = 50):
+        self.sizes = sizes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.rng = np.random  # replaced by DistributedBatchSampler, so that all processes shuffle the same way
+
+
+    def __len__(self):
+        return (len(self.sizes) + self.batch_size - 1) // self.batch_size
+
+
+    def __iter__(self):
+        if self.shuffle:
+            order = self.rng.permutation(len(self.sizes))
+            pool_len = self.batch_size * self.pool_size
+            pools = [order[i:i + pool_len] for i in range(0, len(order), pool_len)]
+        else:
+            pools = [np.arange(len(self.sizes))]
+
+        batches = []
+        for pool in pools:
+            pool_sizes = self.sizes[pool]
+            # np.lexsort uses the last key as the primary key
+            pool = pool[np.lexsort((pool_sizes[:, 2], pool_sizes[:, 1], pool_sizes[:, 0]))]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+
+        if self.shuffle:
+            self.rng.shuffle(batches)
+        return iter(batches)
+
+
+class ParagraphBatchSampler(torch.utils.data.Sampler):
+    """
+    A batch sampler that puts the instances (entities) of the same paragraph into the same batch,
+    so that each paragraph only needs to be encoded once per batch.
+    The instances are ordered paragraph by paragraph and then cut into batches, so a paragraph is only split
+    at the boundary of two batches. If shuffle, the order of the paragraphs is shuffled every epoch.
+    """
+    def __init__(self, para_ids: List[int], batch_size: int, shuffle: bool):
+        self.num_instances = len(para_ids)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        groups = {}
+        for index, para_id in enumerate(para_ids):
+            groups.setdefault(para_id, []).append(index)
+        self.groups = list(groups.values())
+        self.rng = np.random  # replaced by DistributedBatchSampler, so that all processes shuffle the same way
+
+
+    def __len__(self):
+        return (self.num_instances + self.batch_size - 1) // self.batch_size
+
+
+    def __iter__(self):
+        group_order = self.rng.permutation(len(self.groups)) if self.shuffle else range(len(self.groups))
+        order = list(itertools.chain.from_iterable(self.groups[group_idx] for group_idx in group_order))
+        return iter([order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)])
+
+
+class DistributedBatchSampler(torch.utils.data.Sampler):
+    """
+    Shard the batches of a batch sampler over the processes of distributed training, process `rank` takes
+    every num_replicas-th batch. The wrapped sampler is shuffled with the same seed on all processes,
+    which changes every epoch (see set_epoch).
+    If pad, batches are repeated from the beginning so that all processes run the same number of steps
+    (required by DistributedDataParallel in training), otherwise the last shards may be shorter (for evaluation).
+    """
+    def __init__(self, batch_sampler, num_replicas: int, rank: int, pad: bool, seed: int = 1234):
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+        self.seed = seed
+        self.epoch = 0
+
+
+    def __len__(self):
+        if self.pad:
+            return (len(self.batch_sampler) + self.num_replicas - 1) // self.num_replicas
+        return len(range(self.rank, len(self.batch_sampler), self.num_replicas))
+
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+
+    def __iter__(self):
+        if hasattr(self.batch_sampler, 'rng'):
+            self.batch_sampler.rng = np.random.RandomState(self.seed + self.epoch)
+        batches = list(self.batch_sampler)
+        if self.pad and len(batches) % self.num_replicas != 0:
+            num_padded = self.num_replicas - len(batches) % self.num_replicas
+            batches += (batches * num_padded)[:num_padded]
+        return iter(batches[self.rank::self.num_replicas])
+
+
+class ResumableBatchSampler(torch.utils.data.Sampler):
+    """
+    Wrap the batch sampler of the training set, so that training can be resumed in the middle of an epoch.
+    All batches of an epoch are drawn as soon as the DataLoader iterator is created, thus the data order
+    only depends on the random states at that time (see train.py), and the first `start` batches
+    are skipped without being loaded. skip() applies until the next call of set_epoch().
+    """
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.start = 0
+
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+    def set_epoch(self, epoch: int) -> None:
+        self.start = 0
+        for sampler in [self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)]:
+            if hasattr(sampler, 'set_epoch'):  # DistributedBatchSampler or DistributedSampler
+                sampler.set_epoch(epoch)
+
+
+    def skip(self, num_batches: int) -> None:
+        self.start = num_batches
+
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)
+        return iter(batches[self.start:])
+
+
 # For paragraphs, we pad them to the max number of tokens in a batch
 # For sentences, we pad them to the max number of sentences in a batch
 # For location candidates, we pad them to the max number of location candidates in a batch
@@ -212,9 +489,16 @@ class Collate:
     """
     A variant of callate_fn that pads according to the longest sequence in
     a batch of sequences, turn List[Dict] -> Dict[List]
+    Each batched tensor is allocated once with the padded size of the batch,
+    and every instance is copied into its slice of it.
     """
-    def __init__(self):
-        pass
+    def __init__(self, pad_token_id: int, pin_memory: bool = False, dedup_paragraphs: bool = False):
+        self.pad_token_id = pad_token_id
+        # if true, token_ids only contains the distinct paragraphs of the batch,
+        # and para_index maps each instance to its paragraph in token_ids
+        self.dedup_paragraphs = dedup_paragraphs
+        # only pin in the main process, DataLoader workers hand their outputs over through shared memory
+        self.pin_memory = pin_memory
 
 
     def __call__(self, batch):
@@ -237,118 +521,128 @@ class Collate:
         max_cands = max([inst['metadata']['total_loc_cands'] for inst in batch])
         max_cpnet = max([len(inst['cpnet']) for inst in batch])
         batch_size = len(batch)
+        pin_memory = self.pin_memory and torch.utils.data.get_worker_info() is None
+
+        # padded size of each field (excluding the batch dimension) and its padding value
+        padded_fields = {'token_ids': ((max_tokens,), self.pad_token_id),
+                         'gold_loc_seq': ((max_sents + 1,), PAD_LOC),
+                         'gold_state_seq': ((max_sents,), PAD_STATE),
+                         'sentence_mask': ((max_sents, max_tokens), 0),
+                         'entity_mask': ((max_sents, max_tokens), 0),
+                         'verb_mask': ((max_sents, max_tokens), 0),
+                         'loc_mask': ((max_cands, max_sents + 1, max_tokens), 0),
+                         'state_rel_labels': ((max_sents, max_cpnet), 0),
+                         'loc_rel_labels': ((max_sents + 1, max_cpnet), 0)
+                         }
+        # unlabeled instances have no gold sequences or relevance labels
+        padded_fields = {field: spec for field, spec in padded_fields.items() if field in batch[0]}
+
+        collated = {'metadata': [inst['metadata'] for inst in batch],
+                    'paragraph': [inst['paragraph'] for inst in batch],  # unpadded, 1-dimension
+                    'sentences': [inst['sentences'] for inst in batch],  # unpadded, 2-dimension
+                    'cpnet': [self.pad_cpnet(inst['cpnet'], max_num = max_cpnet) for inst in batch]
+                    }
+
+        if self.dedup_paragraphs:
+            collated['token_ids'], collated['para_index'] = self.dedup_token_ids(batch, max_tokens = max_tokens,
+                                                                                 pin_memory = pin_memory)
+            padded_fields.pop('token_ids')
 
-        # pad according to max_len
-        batch = list(map(lambda x: self.pad_instance(x, max_sents = max_sents, 
-                                                        max_tokens = max_tokens, 
-                                                        max_cands = max_cands,
-                                                        max_cpnet = max_cpnet), batch))
-
-        metadata = list(map(lambda x: x['metadata'], batch))
-        paragraph = list(map(lambda x: x['paragraph'], batch))
-        sentences = list(map(lambda x: x['sentences'], batch))
-        cpnet = list(map(lambda x: x['cpnet'], batch))
-        gold_loc_seq = torch.stack(list(map(lambda x: x['gold_loc_seq'], batch)))
-        gold_state_seq = torch.stack(list(map(lambda x: x['gold_state_seq'], batch)))
-        sentence_mask = torch.stack(list(map(lambda x: x['sentence_mask'], batch)))
-        entity_mask = torch.stack(list(map(lambda x: x['entity_mask'], batch)))
-        verb_mask = torch.stack(list(map(lambda x: x['verb_mask'], batch)))
-        loc_mask = torch.stack(list(map(lambda x: x['loc_mask'], batch)))
-        state_rel_labels = torch.stack(list(map(lambda x: x['state_rel_labels'], batch)))
-        loc_rel_labels = torch.stack(list(map(lambda x: x['loc_rel_labels'], batch)))
+        for field, (shape, pad_val) in padded_fields.items():
+            values = [inst[field] for inst in batch]
+            if isinstance(values[0], SpanMask):
+                collated[field] = SpanMask.stack(values, shape = shape)
+                if pin_memory:
+                    collated[field] = collated[field].pin_memory()
+            else:
+                collated[field] = self.pad_stack(values, shape = shape, pad_val = pad_val, pin_memory = pin_memory)
+
+        collated['cpnet_ids'], collated['cpnet_mask'] = self.pad_cpnet_ids([inst['cpnet_ids'] for inst in batch],
+                                                                        max_num = max_cpnet, pin_memory = pin_memory)
 
         # check the dimension of the data
-        assert len(metadata) == len(paragraph) == len(sentences) == len(cpnet) == batch_size
-        assert gold_state_seq.size() == (batch_size, max_sents)
-        assert gold_loc_seq.size() == (batch_size, max_sents + 1)
-        assert sentence_mask.size() == entity_mask.size() == verb_mask.size() == (batch_size, max_sents, max_tokens)
-        assert loc_mask.size() == (batch_size, max_cands, max_sents + 1, max_tokens)
-        assert state_rel_labels.size() == (batch_size, max_sents, max_cpnet)
-        assert loc_rel_labels.size() == (batch_size, max_sents + 1, max_cpnet)
-
-        return {'metadata': metadata,
-                'paragraph': paragraph,  # unpadded, 1-dimension
-                'sentences': sentences,  # unpadded, 2-dimension
-                'gold_loc_seq': gold_loc_seq,
-                'gold_state_seq': gold_state_seq,
-                'sentence_mask': sentence_mask,
-                'entity_mask': entity_mask,
-                'verb_mask': verb_mask,
-                'loc_mask': loc_mask,
-                'cpnet': cpnet,
-                'state_rel_labels': state_rel_labels,
-                'loc_rel_labels': loc_rel_labels
-                }
+        assert len(collated['metadata']) == len(collated['cpnet']) == batch_size
+        assert collated['cpnet_ids'].size()[:2] == collated['cpnet_mask'].size() == (batch_size, max_cpnet)
+        for field, (shape, _) in padded_fields.items():
+            assert collated[field].size() == (batch_size, *shape)
+
+        return collated
 
-    def pad_instance(self, instance: Dict, max_sents: int, max_tokens: int,
-                     max_cands: int, max_cpnet: int) -> Dict:
-        """
-        Pad the data fields of a certain instance.
 
-        args: 
-            instance - instance to pad
-            max_sents -  maximum number of sentences in this batch
-            max_tokens -  maximum number of tokens in this batch
+    def pad_stack(self, tensors: List[torch.Tensor], shape, pad_val: int = 0, pin_memory: bool = False) -> torch.Tensor:
         """
-        instance['gold_state_seq'] = self.pad_tensor(instance['gold_state_seq'], pad = max_sents, dim = 0, pad_val = PAD_STATE)
-        instance['gold_loc_seq'] = self.pad_tensor(instance['gold_loc_seq'], pad = max_sents + 1, dim = 0, pad_val = PAD_LOC)
+        Stack a list of tensors into a tensor of size (batch, *shape), padding each of them to 'shape' at the end.
 
-        instance['sentence_mask'] = self.pad_mask_list(instance['sentence_mask'], max_sents = max_sents, max_tokens = max_tokens)
-        instance['entity_mask'] = self.pad_mask_list(instance['entity_mask'], max_sents = max_sents, max_tokens = max_tokens)
-        instance['verb_mask'] = self.pad_mask_list(instance['verb_mask'], max_sents = max_sents, max_tokens = max_tokens)
-        instance['loc_mask'] = self.pad_mask_list(instance['loc_mask'], max_sents = max_sents + 1,
-                                                     max_tokens = max_tokens, max_cands = max_cands)
+        args:
+            tensors - tensors to stack, with the same number of dimensions as 'shape'
+            shape - the size to pad each tensor to
+            pad_val - value of the padded elements
 
-        instance['state_rel_labels'] = self.pad_rel_labels(instance['state_rel_labels'], max_sents = max_sents,
-                                                           max_cpnet = max_cpnet)
-        instance['loc_rel_labels'] = self.pad_rel_labels(instance['loc_rel_labels'], max_sents=max_sents + 1,
-                                                         max_cpnet=max_cpnet)
-        instance['cpnet'] = self.pad_cpnet(instance['cpnet'], max_num = max_cpnet)
+        return:
+            a new tensor of size (batch, *shape)
+        """
+        output = torch.empty(len(tensors), *shape, dtype = tensors[0].dtype, pin_memory = pin_memory)
+        output.fill_(pad_val)
+        for i, vec in enumerate(tensors):
+            output[(i,) + tuple(slice(0, size) for size in vec.size())] = vec
+        return output
 
-        return instance
 
-    
-    def pad_mask_list(self, vec: torch.Tensor, max_sents: int, max_tokens: int, max_cands: int = None) -> torch.Tensor:
-        """
-        Pad a tensor of mask list
+    def dedup_token_ids(self, batch: List[Dict], max_tokens: int, pin_memory: bool = False):
         """
-        tmp_vec = self.pad_tensor(vec, pad = max_tokens, dim = -1)
-        tmp_vec = self.pad_tensor(tmp_vec, pad = max_sents, dim = -2)
-        if max_cands is not None:
-            tmp_vec = self.pad_tensor(tmp_vec, pad = max_cands, dim = -3)
+        Pad and stack the token ids of the distinct paragraphs in a batch.
 
-        return tmp_vec
+        return:
+            token_ids - size (num_paragraphs, max_tokens)
+            para_index - size (batch,), index of the paragraph of each instance in token_ids
+        """
+        para2idx = {}
+        para_index = [para2idx.setdefault(inst['metadata']['para_id'], len(para2idx)) for inst in batch]
+        first_instances = {}
+        for inst, idx in zip(batch, para_index):
+            first_instances.setdefault(idx, inst)
 
+        token_ids = self.pad_stack([first_instances[idx]['token_ids'] for idx in range(len(para2idx))],
+                                   shape = (max_tokens,), pad_val = self.pad_token_id, pin_memory = pin_memory)
+        para_index = torch.LongTensor(para_index)
+        if pin_memory:
+            para_index = para_index.pin_memory()
+        return token_ids, para_index
 
-    def pad_rel_labels(self, vec: torch.Tensor, max_sents: int, max_cpnet: int) -> torch.Tensor:
-        """
-        Pad state_rel_labels or loc_rel_labels
-        """
-        tmp_vec = self.pad_tensor(vec, pad = max_cpnet, dim = -1)
-        tmp_vec = self.pad_tensor(tmp_vec, pad = max_sents, dim = -2)
-        return tmp_vec
 
-    
-    def pad_tensor(self, vec: torch.Tensor, pad: int, dim: int, pad_val: int = 0) -> torch.Tensor:
+    def pad_cpnet_ids(self, cpnet_ids: List[List[torch.LongTensor]], max_num: int, pin_memory: bool = False):
         """
-        Pad a tensor on a given dimension to a given size.
+        Pad the token ids of the cpnet triples to the max number of triples and the max triple length in a batch.
 
         args:
-            vec - tensor to pad
-            pad - the size to pad to
-            dim - dimension to pad
+            cpnet_ids - token ids of each triple of each instance
+            max_num - maximum number of triples in this batch
 
         return:
-            a new tensor padded to 'pad' in dimension 'dim'
+            padded_ids - size (batch, max_num, max_len), padded with pad_token_id
+            cpnet_mask - size (batch, max_num), 1 for real triples and 0 for padded ones
         """
-        pad_size = list(vec.size())
-        pad_size[dim] = pad - vec.size(dim)
-        pad_vec = torch.zeros(*pad_size, dtype = vec.dtype)
+        batch_size = len(cpnet_ids)
+        num_triples = [len(triples) for triples in cpnet_ids]
+        all_triples = list(itertools.chain.from_iterable(cpnet_ids))
+        triple_lens = torch.LongTensor([len(ids) for ids in all_triples])
+        max_len = max(triple_lens.tolist(), default = 0)
+
+        padded_ids = torch.empty(batch_size, max_num, max_len, dtype = torch.long, pin_memory = pin_memory)
+        padded_ids.fill_(self.pad_token_id)
+        cpnet_mask = torch.zeros(batch_size, max_num, dtype = torch.int, pin_memory = pin_memory)
+        for i in range(batch_size):
+            cpnet_mask[i, :num_triples[i]] = 1
 
-        if pad_val != 0:
-            pad_vec.fill_(pad_val)
+        if all_triples:
+            # row of each triple in the flattened (batch * max_num, max_len) output, then row & column of each token
+            triple_rows = cpnet_mask.view(-1).nonzero().squeeze(dim = -1)
+            token_rows = torch.repeat_interleave(triple_rows, triple_lens)
+            triple_starts = torch.cumsum(triple_lens, dim = 0) - triple_lens
+            token_cols = torch.arange(token_rows.size(0)) - torch.repeat_interleave(triple_starts, triple_lens)
+            padded_ids.view(batch_size * max_num, max_len)[token_rows, token_cols] = torch.cat(all_triples)
 
-        return torch.cat([vec, pad_vec], dim = dim)
+        return padded_ids, cpnet_mask
 
 
     def pad_cpnet(self, data: List[str], max_num: int):
@@ -356,5 +650,3 @@ class Collate:
         Pad the cpnet triples to max number.
         """
         return data + ['' for _ in range(max_num - len(data))]
-
-        
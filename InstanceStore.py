@@ -0,0 +1,250 @@
+'''
+ Compact in-memory storage of dataset instances, with lazily loaded shards.
+'''
+
+import os
+import sys
+import json
+import hashlib
+import weakref
+import numpy as np
+from typing import List, Dict, Tuple
+from Cache import file_md5
+
+
+def intern_labels(labels: List[str]) -> Tuple[str]:
+    """
+    Intern a gold label sequence, which is shared by many instances. Unlabeled instances give None.
+    """
+    if labels is None:
+        return None
+    return tuple(sys.intern(label) for label in labels)
+
+
+class Mentions:
+    """
+    A list of mention lists (word indices), stored as one flat index array plus the offset of each list.
+    """
+    __slots__ = ('indices', 'offsets')
+
+    def __init__(self, mention_lists: List[List[int]]):
+        self.offsets = np.zeros(len(mention_lists) + 1, dtype=np.int32)
+        self.offsets[1:] = np.cumsum([len(mentions) for mentions in mention_lists])
+        self.indices = np.fromiter((idx for mentions in mention_lists for idx in mentions),
+                                   dtype=np.int32, count=self.offsets[-1])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.indices[self.offsets[index]:self.offsets[index + 1]]
+
+    def list_ids(self) -> np.ndarray:
+        """
+        The index of the mention list that each element of self.indices belongs to.
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+
+class Paragraph:
+    """
+    A paragraph and its sentences, shared by the instances of all entities in the paragraph.
+    """
+    __slots__ = ('para_id', 'text', 'total_words', 'sentences', 'sentence_lens', '__weakref__')
+
+    def __init__(self, para_id: int, text: str, total_words: int, sentences: Tuple[str], sentence_lens: np.ndarray):
+        self.para_id = para_id
+        self.text = text
+        self.total_words = total_words
+        self.sentences = sentences
+        self.sentence_lens = sentence_lens  # number of words of each sentence
+
+
+class Instance:
+    """
+    A (paragraph, entity) instance.
+    Mention indices are word indices in the paragraph. The location mentions of candidate c in sentence s
+    are stored at loc_mention[s * total_loc_cands + c].
+    gold_loc_seq and gold_state_seq are None for unlabeled data.
+    """
+    __slots__ = ('paragraph', 'entity', 'loc_cand_list', 'gold_loc_seq', 'gold_state_seq',
+                 'entity_mention', 'verb_mention', 'loc_mention')
+
+    def __init__(self, paragraph: Paragraph, entity: str, loc_cand_list: Tuple[str], gold_loc_seq: Tuple[str],
+                 gold_state_seq: Tuple[str], entity_mention: Mentions, verb_mention: Mentions, loc_mention: Mentions):
+        self.paragraph = paragraph
+        self.entity = entity
+        self.loc_cand_list = loc_cand_list
+        self.gold_loc_seq = gold_loc_seq
+        self.gold_state_seq = gold_state_seq
+        self.entity_mention = entity_mention
+        self.verb_mention = verb_mention
+        self.loc_mention = loc_mention
+
+    @property
+    def para_id(self) -> int:
+        return self.paragraph.para_id
+
+    @property
+    def total_sents(self) -> int:
+        return len(self.paragraph.sentences)
+
+    @property
+    def total_loc_cands(self) -> int:
+        return len(self.loc_cand_list)
+
+    @property
+    def has_labels(self) -> bool:
+        return self.gold_state_seq is not None
+
+
+class InstanceStore:
+    """
+    Compact in-memory store of the instances of a dataset.
+    data_path is either a json file (a list of instances, as written by preprocess.py),
+    or a directory of such json files and/or jsonl files (one instance per line), which are used as shards.
+    Shards are parsed on first access. Their numbers of instances are stored next to them (see get_shard_sizes).
+    Paragraphs are interned by para_id, so their text and sentences are stored once for all entities.
+    """
+
+    # numbers of instances of the shards, stored in the directory of the shards
+    shard_index_file = 'koala_shard_index.json'
+
+    def __init__(self, data_path: str):
+        if os.path.isdir(data_path):
+            self.shard_paths = [os.path.join(data_path, filename) for filename in sorted(os.listdir(data_path))
+                                if (filename.endswith('.json') or filename.endswith('.jsonl'))
+                                and filename != self.shard_index_file]
+        else:
+            self.shard_paths = [data_path]
+        assert self.shard_paths, f'No json or jsonl shard found in {data_path}'
+
+        self.paragraphs = weakref.WeakValueDictionary()
+        self.shards = [None for _ in self.shard_paths]
+        self.shard_offsets = np.concatenate([[0], np.cumsum(self.get_shard_sizes())]).astype(np.int64)
+
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+
+    def __getstate__(self):
+        # weak dicts cannot be pickled, paragraphs are re-interned from the loaded shards instead
+        state = self.__dict__.copy()
+        state['paragraphs'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.paragraphs = weakref.WeakValueDictionary()
+        for shard in self.shards:
+            for instance in shard or []:
+                self.paragraphs[instance.para_id] = instance.paragraph
+
+
+    def __getitem__(self, index: int) -> Instance:
+        if index < 0:
+            index += len(self)
+        shard_idx = int(np.searchsorted(self.shard_offsets, index, side='right')) - 1
+        if self.shards[shard_idx] is None:
+            self.load_shard(shard_idx)
+        return self.shards[shard_idx][index - self.shard_offsets[shard_idx]]
+
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+    def get_shard_sizes(self) -> List[int]:
+        """
+        Number of instances of each shard. Counting them means reading a jsonl shard or parsing a json shard,
+        so the numbers are stored in the directory of the shards (shard_index_file) with the sizes and modification
+        times of the shards, and a shard is only counted again when it changes.
+        """
+        index_path = os.path.join(os.path.dirname(self.shard_paths[0]), self.shard_index_file)
+        index = {}
+        if os.path.exists(index_path):
+            index = json.load(open(index_path, 'r', encoding='utf-8'))
+
+        shard_sizes, updated = [], False
+        for shard_path in self.shard_paths:
+            filename = os.path.basename(shard_path)
+            key = [os.path.getsize(shard_path), os.path.getmtime(shard_path)]
+            if filename not in index or index[filename]['key'] != key:
+                with open(shard_path, 'r', encoding='utf-8') as fin:
+                    if shard_path.endswith('.jsonl'):
+                        num_instances = sum(1 for line in fin if line.strip())
+                    else:
+                        num_instances = len(json.load(fin))
+                index[filename] = {'key': key, 'num_instances': num_instances}
+                updated = True
+            shard_sizes.append(index[filename]['num_instances'])
+
+        if updated:
+            try:
+                tmp_path = f'{index_path}.tmp{os.getpid()}'
+                json.dump(index, open(tmp_path, 'w', encoding='utf-8'), indent=4)
+                os.replace(tmp_path, index_path)
+            except OSError:  # e.g., a read-only directory, the shards are counted every time
+                pass
+        return shard_sizes
+
+
+    def load_shard(self, shard_idx: int) -> None:
+        shard_path = self.shard_paths[shard_idx]
+        with open(shard_path, 'r', encoding='utf-8') as fin:
+            if shard_path.endswith('.jsonl'):
+                raw_instances = [json.loads(line) for line in fin if line.strip()]
+            else:
+                raw_instances = json.load(fin)
+        self.shards[shard_idx] = [self.convert_instance(raw_instance) for raw_instance in raw_instances]
+
+
+    def convert_instance(self, raw: Dict) -> Instance:
+        """
+        Convert a raw json instance to a compact Instance record.
+        """
+        para_id = raw['id']
+        sentence_list = raw['sentence_list']
+        assert raw['total_sents'] == len(sentence_list)
+
+        paragraph = self.paragraphs.get(para_id)
+        if paragraph is None:
+            paragraph = Paragraph(para_id=para_id, text=raw['paragraph'], total_words=raw['total_tokens'],
+                                  sentences=tuple(sent['sentence'] for sent in sentence_list),
+                                  sentence_lens=np.array([sent['total_tokens'] for sent in sentence_list], dtype=np.int32))
+            self.paragraphs[para_id] = paragraph
+
+        total_loc_cands = raw['total_loc_candidates']
+        loc_mention = [mentions for sent in sentence_list for mentions in sent['loc_mention_list'][:total_loc_cands]]
+        assert len(loc_mention) == len(sentence_list) * total_loc_cands
+
+        return Instance(paragraph=paragraph,
+                        entity=sys.intern(raw['entity']),
+                        loc_cand_list=tuple(sys.intern(loc) for loc in raw['loc_cand_list']),
+                        gold_loc_seq=intern_labels(raw.get('gold_loc_seq')),
+                        gold_state_seq=intern_labels(raw.get('gold_state_seq')),
+                        entity_mention=Mentions([sent['entity_mention'] for sent in sentence_list]),
+                        verb_mention=Mentions([sent['verb_mention'] for sent in sentence_list]),
+                        loc_mention=Mentions(loc_mention))
+
+
+    def get_para_ids(self) -> List[int]:
+        """
+        Get the para_id of every instance. This loads all shards.
+        """
+        return [instance.para_id for instance in self]
+
+
+    def fingerprint(self) -> str:
+        """
+        md5 digest of the content of all shards, used as a key of the feature cache.
+        """
+        if len(self.shard_paths) == 1:
+            return file_md5(self.shard_paths[0])
+        md5 = hashlib.md5()
+        for shard_path in self.shard_paths:
+            md5.update(f'{os.path.basename(shard_path)}:{file_md5(shard_path)};'.encode('utf-8'))
+        return md5.hexdigest()
@@ -15,15 +15,19 @@ import time
 import numpy as np
 from typing import List, Dict
 from Constants import *
-import itertools
 from utils import *
+from Cache import EncoderCache
 from torchcrf import CRF
 import argparse
+import transformers
 import pdb
 
 
 class KOALA(nn.Module):
 
+    # verified hashes of the encoders, stored in the directory of their pretrained weights (see get_encoder_hash)
+    encoder_hash_file = 'koala_encoder_hash.json'
+
     def __init__(self, opt: argparse.Namespace, is_test: bool):
 
         super(KOALA, self).__init__()
@@ -41,16 +45,22 @@ class KOALA(nn.Module):
 
         self.plm_config = plm_config_class.from_pretrained(opt.plm_model_name)
         self.plm_tokenizer = plm_tokenizer_class.from_pretrained(opt.plm_model_name)
+        # pretrained weights (name or path) of the encoders, None if the parameters are loaded from a checkpoint
+        self.encoder_sources = {'cpnet_encoder': None, 'embed_encoder': None}
+        self.encoder_hashes = {}  # hash_state_dict of the frozen encoders, computed on first use
 
         # ConceptNet encoder
-        if is_test:
-            self.cpnet_encoder = plm_model_class(config=self.plm_config)  # use saved parameters
-            print(f'[INFO] Loaded an empty {opt.plm_model_name} for ConceptNet encoder during testing')
+        if is_test:  # no parameters until load_checkpoint_state_dict, so that they are not initialized for nothing
+            with torch.device('meta'):
+                self.cpnet_encoder = plm_model_class(config=self.plm_config)
+            print(f'[INFO] Created an empty {opt.plm_model_name} for ConceptNet encoder during testing')
         elif opt.cpnet_plm_path:
             self.cpnet_encoder = plm_model_class.from_pretrained(opt.cpnet_plm_path)
+            self.encoder_sources['cpnet_encoder'] = opt.cpnet_plm_path
             print(f'[INFO] Loaded {opt.cpnet_plm_path} for ConceptNet encoder')
         else:
             self.cpnet_encoder = plm_model_class.from_pretrained(opt.plm_model_name)
+            self.encoder_sources['cpnet_encoder'] = opt.plm_model_name
             print(f'[INFO] Loaded {opt.plm_model_name} for ConceptNet encoder')
         for param in self.cpnet_encoder.parameters():
             param.requires_grad = False
@@ -58,14 +68,17 @@ class KOALA(nn.Module):
         self.CpnetEncoder = FixedSentEncoder(opt)
 
         if is_test:
-            self.embed_encoder = plm_model_class(config=self.plm_config)  # use saved parameters
-            print(f'[INFO] Loaded an empty {opt.plm_model_name} for embedding language model during testing')
+            with torch.device('meta'):
+                self.embed_encoder = plm_model_class(config=self.plm_config)
+            print(f'[INFO] Created an empty {opt.plm_model_name} for embedding language model during testing')
         elif opt.wiki_plm_path:
             assert not opt.no_wiki, "Specified -no_wiki option but used a pre-fine-tuned BERT"
             self.embed_encoder = plm_model_class.from_pretrained(opt.wiki_plm_path)
+            self.encoder_sources['embed_encoder'] = opt.wiki_plm_path
             print(f'[INFO] Loaded {opt.wiki_plm_path} for embedding language model')
         else:
             self.embed_encoder = plm_model_class.from_pretrained(opt.plm_model_name)
+            self.encoder_sources['embed_encoder'] = opt.plm_model_name
             print(f'[INFO] Loaded {opt.plm_model_name} for embedding language model')
         if not is_test and not opt.finetune:
             for param in self.embed_encoder.parameters():
@@ -74,7 +87,7 @@ class KOALA(nn.Module):
 
         # state tracking modules
         self.StateTracker = StateTracker(opt)
-        self.CRFLayer = CRF(NUM_STATES, batch_first = True)
+        self.CRFLayer = ConstrainedCRF(NUM_STATES, batch_first = True, constrained = opt.crf_constraints)
 
         # location prediction modules
         self.LocationPredictor = LocationPredictor(opt)
@@ -83,71 +96,241 @@ class KOALA(nn.Module):
 
         self.is_test = is_test
         self.use_cuda = not opt.no_cuda
+        self.precision = opt.precision
+        self.packed_lstm = opt.packed_lstm
+        self.embed_cache = None  # EncoderCache of the frozen paragraph encoder, set by set_embed_cache
+        self.attn_recorder = None  # set an AttentionRecorder to record the ConceptNet attention weights
+
+
+    def get_cache_path(self, cache_dir: str, name: str, dtype: str = 'float32') -> str:
+        """
+        Directory of the hidden state cache of a frozen encoder, keyed by the hash of its parameters (get_encoder_hash).
+        Hidden states computed in lower precision or stored in a different dtype are cached separately.
+        """
+        cache_name = self.get_encoder_hash(name)
+        if self.precision != 'fp32':
+            cache_name += f'-{self.precision}'
+        if dtype != 'float32':
+            cache_name += f'-{dtype}'
+        return os.path.join(cache_dir, cache_name)
+
+
+    def get_frozen_encoders(self) -> List[str]:
+        """
+        Names of the encoders that are not trained and are loaded from pretrained weights.
+        """
+        return [name for name, source in self.encoder_sources.items() if source is not None
+                and not any(param.requires_grad for param in getattr(self, name).parameters())]
+
+
+    def get_encoder_hash(self, name: str) -> str:
+        """
+        hash_state_dict of a frozen encoder, computed once per model. If the encoder is loaded from a local directory
+        or from a model downloaded from the huggingface hub (see get_pretrained_dir), the hash is also stored in that
+        directory (encoder_hash_file) with the sizes and modification times of the files, so that it is only computed
+        again when the pretrained weights change.
+        """
+        if name in self.encoder_hashes:
+            return self.encoder_hashes[name]
+        encoder, source = getattr(self, name), self.encoder_sources[name]
+        source_dir = get_pretrained_dir(source) if source is not None else None
+        if source_dir is None:
+            self.encoder_hashes[name] = hash_state_dict(encoder)
+            return self.encoder_hashes[name]
+
+        hash_path = os.path.join(source_dir, self.encoder_hash_file)
+        files = {filename: [os.path.getsize(os.path.join(source_dir, filename)),
+                            os.path.getmtime(os.path.join(source_dir, filename))]
+                 for filename in sorted(os.listdir(source_dir)) if filename != self.encoder_hash_file
+                 and os.path.isfile(os.path.join(source_dir, filename))}
+        key = {'model_class': type(encoder).__name__, 'transformers': transformers.__version__, 'files': files}
+        if os.path.exists(hash_path):
+            stored = json.load(open(hash_path, 'r', encoding='utf-8'))
+            if stored['key'] == key:
+                self.encoder_hashes[name] = stored['hash']
+                return stored['hash']
+
+        self.encoder_hashes[name] = hash_state_dict(encoder)
+        try:
+            tmp_path = f'{hash_path}.tmp{os.getpid()}'
+            json.dump({'key': key, 'hash': self.encoder_hashes[name]}, open(tmp_path, 'w', encoding='utf-8'), indent=4)
+            os.replace(tmp_path, hash_path)
+        except OSError:  # e.g., a read-only directory, the hash is computed every time
+            pass
+        return self.encoder_hashes[name]
+
+
+    def checkpoint_state_dict(self, save_frozen: bool = False) -> Dict:
+        """
+        State dict to save in checkpoints. Parameters of the frozen encoders are not saved (unless save_frozen),
+        instead the checkpoint refers to the pretrained weights they are loaded from, by name or path and by
+        the hash of the parameters. Load the checkpoint with load_checkpoint_state_dict.
+        Return:
+            {'state_dict': state dict without the frozen encoders,
+             'frozen_encoders': {encoder name: {'source': name or path, 'hash': hash of the parameters}}}
+        """
+        frozen_encoders = {} if save_frozen else \
+            {name: {'source': self.encoder_sources[name], 'hash': self.get_encoder_hash(name)}
+             for name in self.get_frozen_encoders()}
+        state_dict = {key: value for key, value in self.state_dict().items()
+                      if key.split('.')[0] not in frozen_encoders}
+        return {'state_dict': state_dict, 'frozen_encoders': frozen_encoders}
+
+
+    def load_checkpoint_state_dict(self, checkpoint: Dict) -> None:
+        """
+        Load a checkpoint saved by checkpoint_state_dict, or a full state dict of KOALA (the former checkpoint format).
+        Frozen encoders are loaded from the pretrained weights the checkpoint refers to, unless they are already
+        loaded from there, and their parameters must have the same hash as in training.
+        """
+        if 'frozen_encoders' not in checkpoint:
+            self.build_encoders(['cpnet_encoder', 'embed_encoder'])
+            self.load_state_dict(checkpoint)
+            self.encoder_sources = {name: None for name in self.encoder_sources}
+            self.encoder_hashes = {}
+            return
+
+        plm_model_class = MODEL_CLASSES[self.opt.plm_model_class][0]
+        for name, reference in checkpoint['frozen_encoders'].items():
+            if self.encoder_sources[name] != reference['source']:
+                encoder = plm_model_class.from_pretrained(reference['source'])
+                for param in encoder.parameters():
+                    param.requires_grad = False
+                setattr(self, name, encoder)
+                self.encoder_sources[name] = reference['source']
+                self.encoder_hashes.pop(name, None)
+                print(f'[INFO] Loaded {reference["source"]} for {name}')
+            if self.get_encoder_hash(name) != reference['hash']:
+                raise RuntimeError(f'Parameters of {reference["source"]} differ from the ones of {name} in the checkpoint')
+
+        loaded_encoders = [name for name in self.encoder_sources if name not in checkpoint['frozen_encoders']]
+        self.build_encoders(loaded_encoders)
+        missing_keys, unexpected_keys = self.load_state_dict(checkpoint['state_dict'], strict = False)
+        for name in loaded_encoders:  # the parameters may differ from the pretrained ones
+            self.encoder_hashes.pop(name, None)
+        missing_keys = [key for key in missing_keys if key.split('.')[0] not in checkpoint['frozen_encoders']]
+        if missing_keys or unexpected_keys:
+            raise RuntimeError(f'Error(s) in loading checkpoint: missing keys {missing_keys}, '
+                               f'unexpected keys {unexpected_keys}')
+
+
+    def build_encoders(self, names: List[str]) -> None:
+        """
+        In test mode, the encoders are created on the meta device without parameters. Create the ones that
+        are loaded from a state dict (instead of pretrained weights) before loading it.
+        """
+        plm_model_class = MODEL_CLASSES[self.opt.plm_model_class][0]
+        for name in names:
+            if any(param.is_meta for param in getattr(self, name).parameters()):
+                setattr(self, name, plm_model_class(config=self.plm_config))
+
+
+    def train(self, mode: bool = True):
+        """
+        Same as nn.Module.train, but a frozen encoder with a hidden state cache (-cpnet_cache, -embed_cache) stays
+        in eval mode (without dropout), like the encoder that computes the cached states, so that the states
+        computed on a cache miss are the same as the ones read from the cache.
+        """
+        super(KOALA, self).train(mode)
+        if self.CpnetEncoder.hidden_cache is not None:
+            self.cpnet_encoder.eval()
+        if self.embed_cache is not None:
+            self.embed_encoder.eval()
+        return self
+
+
+    def set_cpnet_cache(self, cache_dir: str, max_ram_mb: int = 1024):
+        """
+        Cache the hidden states of the frozen ConceptNet encoder under cache_dir, so that each triple is only
+        encoded once. Call this after the model parameters are loaded, since the cache is keyed by their hash.
+        """
+        cache_path = self.get_cache_path(cache_dir, 'cpnet_encoder')
+        self.CpnetEncoder.hidden_cache = EncoderCache(cache_path, hidden_size = self.embed_size, max_ram_mb = max_ram_mb)
+        print(f'[INFO] ConceptNet encoder cache at {cache_path}, {len(self.CpnetEncoder.hidden_cache)} triples cached')
+
+
+    def set_embed_cache(self, cache_dir: str, max_ram_mb: int = 1024, dtype: str = 'float32'):
+        """
+        Cache the last hidden states of the paragraph encoder under cache_dir, so that each paragraph is only
+        encoded once and the rest of the model is trained from the stored states. Only valid without -finetune.
+        If both encoders have the same parameters, their caches share the same directory.
+        """
+        assert not any(param.requires_grad for param in self.embed_encoder.parameters()), \
+            'Cannot cache the hidden states of a fine-tuned paragraph encoder'
+        cache_path = self.get_cache_path(cache_dir, 'embed_encoder', dtype = dtype)
+        self.embed_cache = EncoderCache(cache_path, hidden_size = self.embed_size, max_ram_mb = max_ram_mb, dtype = dtype)
+        print(f'[INFO] Paragraph encoder cache at {cache_path}, {len(self.embed_cache)} sequences cached')
+
+
+    def embed(self, token_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """
+        Last-layer hidden states of the paragraph encoder, size (batch, max_tokens, plm_hidden_size),
+        read from self.embed_cache if it is set.
+        """
+        with precision_autocast(self.precision, device_type = token_ids.device.type):
+            if self.embed_cache is not None:
+                return self.embed_cache.encode(self.embed_encoder, token_ids, attention_mask)
+            plm_outputs = self.embed_encoder(token_ids, attention_mask=attention_mask)
+            return plm_outputs[0]  # hidden states at the last layer
 
 
     def forward(self, token_ids: torch.Tensor, entity_mask: torch.IntTensor,
                 verb_mask: torch.IntTensor, loc_mask: torch.IntTensor, gold_loc_seq: torch.IntTensor,
                 gold_state_seq: torch.IntTensor,num_cands: torch.IntTensor, sentence_mask: torch.IntTensor,
-                cpnet_triples: List, state_rel_labels: torch.IntTensor, loc_rel_labels: torch.IntTensor):
+                cpnet_ids: torch.LongTensor, cpnet_mask: torch.IntTensor,
+                state_rel_labels: torch.IntTensor, loc_rel_labels: torch.IntTensor,
+                para_index: torch.LongTensor = None, decode: bool = True):
         """
         Args:
             token_ids: size (batch * max_wiki, max_ctx_tokens)
             *_mask: size (batch, max_sents, max_tokens)
             loc_mask: size (batch, max_cands, max_sents + 1, max_tokens), +1 for location 0
+            verb_mask and loc_mask can also be SpanMasks of the above sizes (-sparse_mask)
             gold_loc_seq: size (batch, max_sents)
             gold_state_seq: size (batch, max_sents)
+            cpnet_ids: token ids of ConceptNet triples, size (batch, max_cpnet, max_cpnet_len)
+            cpnet_mask: 1 for real triples and 0 for padded ones, size (batch, max_cpnet)
             state_rel_labels: size (batch, max_sents, max_cpnet)
             loc_rel_labels: size (batch, max_sents, max_cpnet)
             num_cands: size (batch,)
+            para_index: index of the paragraph of each instance in token_ids, size (batch,). If given,
+                        token_ids only contains the distinct paragraphs of the batch, size (num_paras, max_tokens)
+            decode: if false, skip the decoding of state and location sequences (only allowed in training),
+                    then the numbers of correct predictions are returned as None
         """
-        assert entity_mask.size(-2) == verb_mask.size(-2) == loc_mask.size(-2) - 1\
-               == gold_state_seq.size(-1) == gold_loc_seq.size(-1) - 1
-        assert entity_mask.size(-1) == verb_mask.size(-1) == loc_mask.size(-1)
+        assert decode or not self.is_test
+        assert entity_mask.size(-2) == gold_state_seq.size(-1) == gold_loc_seq.size(-1) - 1
         batch_size = entity_mask.size(0)
-        max_tokens = entity_mask.size(-1)
         max_sents = gold_state_seq.size(-1)
         max_cands = loc_mask.size(-3)
 
-        attention_mask = (token_ids != self.plm_tokenizer.pad_token_id).to(torch.int)
-        plm_outputs = self.embed_encoder(token_ids, attention_mask=attention_mask)
-        embeddings = plm_outputs[0]  # hidden states at the last layer, (batch, max_tokens, plm_hidden_size)
-
-        token_rep, _ = self.TokenEncoder(embeddings)  # (batch, max_tokens, 2*hidden_size)
-        token_rep = self.Dropout(token_rep)
-        assert token_rep.size() == (batch_size, max_tokens, 2 * self.hidden_size)
-
-        cpnet_rep = self.CpnetEncoder(cpnet_triples, tokenizer=self.plm_tokenizer, encoder=self.cpnet_encoder)
+        tag_logits, state_attn_probs, masked_loc_logits, loc_attn_probs, _ = \
+            self.encode(token_ids = token_ids, entity_mask = entity_mask, verb_mask = verb_mask, loc_mask = loc_mask,
+                        num_cands = num_cands, sentence_mask = sentence_mask, cpnet_ids = cpnet_ids,
+                        cpnet_mask = cpnet_mask, para_index = para_index)
 
         # state change prediction
-        # size (batch, max_sents, NUM_STATES)
-        tag_logits, state_attn_probs = self.StateTracker(encoder_out = token_rep, entity_mask = entity_mask,
-                                                         verb_mask = verb_mask, sentence_mask = sentence_mask,
-                                                         cpnet_triples = cpnet_triples, cpnet_rep = cpnet_rep)
         tag_mask = (gold_state_seq != PAD_STATE) # mask the padded part so they won't count in loss
         log_likelihood = self.CRFLayer(emissions = tag_logits, tags = gold_state_seq.long(), mask = tag_mask, reduction = 'token_mean')
 
         state_loss = -log_likelihood  # State classification loss is negative log likelihood
-        pred_state_seq = self.CRFLayer.decode(emissions=tag_logits, mask=tag_mask)
-        assert len(pred_state_seq) == batch_size
-        correct_state_pred, total_state_pred = compute_state_accuracy(pred=pred_state_seq, gold=gold_state_seq.tolist(),
-                                                        pad_value=PAD_STATE)
+        if decode:
+            pred_state_seq = self.CRFLayer.decode(emissions=tag_logits, mask=tag_mask)
+            assert len(pred_state_seq) == batch_size
+            correct_state_pred, total_state_pred = compute_state_accuracy(pred=pred_state_seq, gold=gold_state_seq.tolist(),
+                                                            pad_value=PAD_STATE)
+        else:
+            correct_state_pred, total_state_pred = None, tag_mask.sum().item()
 
         # location prediction
-        # size (batch, max_cands, max_sents + 1)
-        empty_mask = torch.zeros((batch_size, 1, max_tokens), dtype=torch.int)
-        if self.use_cuda:
-            empty_mask = empty_mask.cuda()
-        entity_mask = torch.cat([empty_mask, entity_mask], dim=1)
-        loc_logits, loc_attn_probs = self.LocationPredictor(encoder_out = token_rep, entity_mask = entity_mask,
-                                                            loc_mask = loc_mask, sentence_mask = sentence_mask,
-                                                            cpnet_triples = cpnet_triples, cpnet_rep = cpnet_rep)
-        loc_logits = loc_logits.transpose(-1, -2)  # size (batch, max_sents + 1, max_cands)
-        masked_loc_logits = self.mask_loc_logits(loc_logits = loc_logits, num_cands = num_cands)  # (batch, max_sents + 1, max_cands)
         masked_gold_loc_seq = self.mask_undefined_loc(gold_loc_seq = gold_loc_seq, mask_value = PAD_LOC)  # (batch, max_sents + 1)
         loc_loss = self.CrossEntropy(input = masked_loc_logits.view(batch_size * (max_sents + 1), max_cands + 1),
                                      target = masked_gold_loc_seq.view(batch_size * (max_sents + 1)).long())
-        correct_loc_pred, total_loc_pred = compute_loc_accuracy(logits = masked_loc_logits, gold = masked_gold_loc_seq,
-                                                                pad_value = PAD_LOC)
+        if decode:
+            correct_loc_pred, total_loc_pred = compute_loc_accuracy(logits = masked_loc_logits, gold = masked_gold_loc_seq,
+                                                                    pad_value = PAD_LOC)
+        else:
+            correct_loc_pred, total_loc_pred = None, torch.sum(masked_gold_loc_seq != PAD_LOC).item()
 
         if loc_attn_probs is not None:
             loc_attn_probs = self.get_gold_attn_probs(loc_attn_probs, gold_loc_seq)
@@ -161,6 +344,94 @@ class KOALA(nn.Module):
                correct_loc_pred, total_loc_pred, total_attn_pred
 
 
+    def predict(self, token_ids: torch.Tensor, entity_mask: torch.IntTensor, verb_mask: torch.IntTensor,
+                loc_mask: torch.IntTensor, num_cands: torch.IntTensor, sentence_mask: torch.IntTensor,
+                cpnet_ids: torch.LongTensor, cpnet_mask: torch.IntTensor, para_index: torch.LongTensor = None):
+        """
+        Label-free inference: only run the encoders, CRF Viterbi decoding and the argmax over location candidates.
+        Args:
+            same as the input fields of forward()
+        Return:
+            pred_state_seq - predicted state ids of each instance, List[List[int]] of length num_sents
+            pred_loc_seq - predicted location candidate ids of each instance, List[List[int]] of length num_sents + 1
+        """
+        tag_logits, _, masked_loc_logits, _, num_sents = \
+            self.encode(token_ids = token_ids, entity_mask = entity_mask, verb_mask = verb_mask, loc_mask = loc_mask,
+                        num_cands = num_cands, sentence_mask = sentence_mask, cpnet_ids = cpnet_ids,
+                        cpnet_mask = cpnet_mask, para_index = para_index)
+        max_sents = tag_logits.size(1)
+
+        sent_range = torch.arange(max_sents, device = num_sents.device)
+        tag_mask = sent_range.unsqueeze(dim = 0) < num_sents.unsqueeze(dim = -1)  # (batch, max_sents)
+        pred_state_seq = self.CRFLayer.decode(emissions = tag_logits, mask = tag_mask)
+
+        argmax_loc = torch.argmax(masked_loc_logits, dim = -1).tolist()  # (batch, max_sents + 1)
+        pred_loc_seq = [inst[:length + 1] for inst, length in zip(argmax_loc, num_sents.tolist())]
+
+        return pred_state_seq, pred_loc_seq
+
+
+    def encode(self, token_ids: torch.Tensor, entity_mask: torch.IntTensor, verb_mask: torch.IntTensor,
+               loc_mask: torch.IntTensor, num_cands: torch.IntTensor, sentence_mask: torch.IntTensor,
+               cpnet_ids: torch.LongTensor, cpnet_mask: torch.IntTensor, para_index: torch.LongTensor = None):
+        """
+        Run the encoders and both decoders up to the emission scores, shared by forward() and predict().
+        Return:
+            tag_logits - emission scores of the CRF, size (batch, max_sents, NUM_STATES)
+            state_attn_probs - size (batch, max_sents, max_cpnet), or None
+            masked_loc_logits - scores of the location candidates, where padded candidates are -inf,
+                                size (batch, max_sents + 1, max_cands)
+            loc_attn_probs - size (batch, max_cands, max_sents + 1, max_cpnet), or None
+            num_sents - number of sentences of each instance, size (batch,)
+        """
+        assert entity_mask.size(-2) == verb_mask.size(-2) == loc_mask.size(-2) - 1
+        assert entity_mask.size(-1) == verb_mask.size(-1) == loc_mask.size(-1)
+        batch_size = entity_mask.size(0)
+        max_tokens = entity_mask.size(-1)
+
+        attention_mask = (token_ids != self.plm_tokenizer.pad_token_id).to(torch.int)
+        with precision_autocast(self.precision, device_type = token_ids.device.type):
+            embeddings = self.embed(token_ids, attention_mask)  # (batch, max_tokens, plm_hidden_size)
+
+            # (batch, max_tokens, 2*hidden_size)
+            token_rep = run_packed_lstm(self.TokenEncoder, embeddings, lengths = attention_mask.sum(dim = -1),
+                                        pack = self.packed_lstm)
+        token_rep = token_rep.float()
+        if para_index is not None:  # each paragraph is encoded once, then copied to all of its entities
+            token_rep = token_rep.index_select(0, para_index)
+        token_rep = self.Dropout(token_rep)
+        assert token_rep.size() == (batch_size, max_tokens, 2 * self.hidden_size)
+
+        cpnet_rep = self.CpnetEncoder(cpnet_ids, tokenizer=self.plm_tokenizer, encoder=self.cpnet_encoder)
+        num_sents = (sentence_mask.sum(dim = -1) > 0).sum(dim = -1)  # (batch,)
+
+        # state change prediction
+        # size (batch, max_sents, NUM_STATES)
+        tag_logits, state_attn_probs = self.StateTracker(encoder_out = token_rep, entity_mask = entity_mask,
+                                                         verb_mask = verb_mask, sentence_mask = sentence_mask,
+                                                         cpnet_mask = cpnet_mask, cpnet_rep = cpnet_rep,
+                                                         num_sents = num_sents)
+
+        # location prediction
+        # size (batch, max_cands, max_sents + 1)
+        empty_mask = torch.zeros((batch_size, 1, max_tokens), dtype=torch.int)
+        if self.use_cuda:
+            empty_mask = empty_mask.cuda()
+        entity_mask = torch.cat([empty_mask, entity_mask], dim=1)
+        loc_logits, loc_attn_probs = self.LocationPredictor(encoder_out = token_rep, entity_mask = entity_mask,
+                                                            loc_mask = loc_mask, sentence_mask = sentence_mask,
+                                                            cpnet_mask = cpnet_mask, cpnet_rep = cpnet_rep,
+                                                            num_sents = num_sents, num_cands = num_cands)
+        loc_logits = loc_logits.transpose(-1, -2)  # size (batch, max_sents + 1, max_cands)
+        masked_loc_logits = self.mask_loc_logits(loc_logits = loc_logits, num_cands = num_cands)  # (batch, max_sents + 1, max_cands)
+
+        if self.attn_recorder is not None:
+            self.attn_recorder.record(state_attn_probs, loc_attn_probs, num_sents = num_sents, num_cands = num_cands,
+                                      cpnet_mask = cpnet_mask)
+
+        return tag_logits, state_attn_probs, masked_loc_logits, loc_attn_probs, num_sents
+
+
     def get_attn_loss(self, state_attn_probs, loc_attn_probs, state_rel_labels, loc_rel_labels):
         """
         Compute attention loss. state_attn_probs or loc_attn_probs can be None if ConceptNet
@@ -195,19 +466,21 @@ class KOALA(nn.Module):
         """
         Get the attention weights of ConceptNet triples with the gold location, among all location candidates.
         Pick arbitrary one if no gold location at this timestep.
+        Args:
+            loc_attn_probs: size (batch, max_cands, max_sents + 1, max_cpnet)
+            gold_loc_seq: size (batch, max_sents + 1)
+        Return:
+            size (batch, max_sents + 1, max_cpnet)
         """
         batch_size = gold_loc_seq.size(0)
         max_sents = gold_loc_seq.size(1)
         max_cpnet = loc_attn_probs.size(-1)
-        pick_loc_seq = gold_loc_seq.masked_fill(mask=(gold_loc_seq < 0), value=0)
-        gold_attn_probs = []
+        pick_loc_seq = gold_loc_seq.masked_fill(mask=(gold_loc_seq < 0), value=0).long()
 
-        for i in range(batch_size):
-            for j in range(max_sents):
-                gold_attn_probs.append(loc_attn_probs[i][pick_loc_seq[i][j]][j])
-
-        gold_attn_probs = torch.stack(gold_attn_probs, dim=0)
-        return gold_attn_probs.view(batch_size, max_sents, max_cpnet)
+        # gold_attn_probs[i][j] = loc_attn_probs[i][pick_loc_seq[i][j]][j]
+        pick_index = pick_loc_seq.view(batch_size, 1, max_sents, 1).expand(batch_size, 1, max_sents, max_cpnet)
+        gold_attn_probs = loc_attn_probs.gather(dim=1, index=pick_index).squeeze(dim=1)
+        return gold_attn_probs
 
 
     def mask_loc_logits(self, loc_logits, num_cands: torch.IntTensor):
@@ -250,32 +523,6 @@ class KOALA(nn.Module):
         return masked_gold_loc_seq
 
 
-    @staticmethod
-    def expand_dim_3d(vec: torch.Tensor, loc_cands: int):
-        """
-        Expand a 3-dim vector in the batch dimension (dimension 0)
-        """
-        assert len(vec.size()) == 3
-        batch_size = vec.size(0)
-        seq_len = vec.size(1)
-        rep_size = vec.size(2)
-        vec = vec.unsqueeze(1).repeat(1, loc_cands, 1, 1)
-        vec = vec.view(batch_size * loc_cands, seq_len, rep_size)
-        return vec
-
-    @staticmethod
-    def expand_dim_2d(vec: torch.Tensor, loc_cands: int):
-        """
-        Expand a 2-dim vector in the batch dimension (dimension 0)
-        """
-        assert len(vec.size()) == 2
-        batch_size = vec.size(0)
-        seq_len = vec.size(1)
-        vec = vec.unsqueeze(1).repeat(1, loc_cands, 1)
-        vec = vec.view(batch_size * loc_cands, seq_len)
-        return vec
-
-
 class StateTracker(nn.Module):
     """
     State tracking decoder: sentence-level Bi-LSTM + linear + CRF
@@ -290,16 +537,19 @@ class StateTracker(nn.Module):
         self.Hidden2Tag = Linear(d_in = 2 * opt.hidden_size, d_out = NUM_STATES, dropout = 0)
         self.CpnetMemory = CpnetMemory(opt, query_size = 4 * opt.hidden_size, input_size = 4 * opt.hidden_size)
         self.cpnet_inject = opt.cpnet_inject
+        self.precision = opt.precision
+        self.packed_lstm = opt.packed_lstm
 
 
-    def forward(self, encoder_out, entity_mask, verb_mask, sentence_mask, cpnet_triples, cpnet_rep):
+    def forward(self, encoder_out, entity_mask, verb_mask, sentence_mask, cpnet_mask, cpnet_rep, num_sents):
         """
         Args:
             encoder_out: output of the encoder, size (batch, max_tokens, 2 * hidden_size)
             entity_mask: size (batch, max_sents, max_tokens)
             verb_mask: size (batch, max_sents, max_tokens)
             sentence_mask: size(batch, max_sents, max_tokens)
-            cpnet_triples: List, (batch, num_cpnet)
+            cpnet_mask: size (batch, num_cpnet), 1 for real triples and 0 for padded ones
+            num_sents: number of sentences of each instance, size (batch,)
         """
         batch_size = encoder_out.size(0)
         max_sents = entity_mask.size(-2)
@@ -310,8 +560,11 @@ class StateTracker(nn.Module):
         attn_probs = None
         if self.cpnet_inject in ['state', 'both']:
             decoder_in, attn_probs = self.CpnetMemory(encoder_out, decoder_in, entity_mask,
-                                          sentence_mask, cpnet_triples, cpnet_rep)
-        decoder_out, _ = self.Decoder(decoder_in)  # (batch, max_sents, 2 * hidden_size), forward & backward concatenated
+                                          sentence_mask, cpnet_mask, cpnet_rep)
+        # (batch, max_sents, 2 * hidden_size), forward & backward concatenated
+        with precision_autocast(self.precision, device_type = decoder_in.device.type):
+            decoder_out = run_packed_lstm(self.Decoder, decoder_in, lengths = num_sents, pack = self.packed_lstm)
+        decoder_out = decoder_out.float()
         decoder_out = self.Dropout(decoder_out)
         tag_logits = self.Hidden2Tag(decoder_out)  # (batch, max_sents, num_tags)
         assert tag_logits.size() == (batch_size, max_sents, NUM_STATES)
@@ -329,8 +582,8 @@ class StateTracker(nn.Module):
         assert entity_mask.size(-1) == encoder_out.size(-2)
 
         max_sents = entity_mask.size(-2)
-        entity_rep = self.get_masked_mean(source = encoder_out, mask = entity_mask, batch_size = batch_size)  # (batch, max_sents, 2 * hidden_size)
-        verb_rep = self.get_masked_mean(source = encoder_out, mask = verb_mask, batch_size = batch_size)  # (batch, max_sents, 2 * hidden_size)
+        entity_rep = masked_mean(source = encoder_out, mask = entity_mask)  # (batch, max_sents, 2 * hidden_size)
+        verb_rep = masked_mean(source = encoder_out, mask = verb_mask)  # (batch, max_sents, 2 * hidden_size)
         concat_rep = torch.cat([entity_rep, verb_rep], dim = -1)  # (batch, max_sents, 4 * hidden_size)
 
         assert concat_rep.size() == (batch_size, max_sents, 4 * self.hidden_size)
@@ -341,32 +594,6 @@ class StateTracker(nn.Module):
         return masked_rep
 
 
-    def get_masked_mean(self, source, mask, batch_size: int):
-        """
-        Args:
-            source - input tensors, size(batch, tokens, 2 * hidden_size)
-            mask - binary masked vectors, size(batch, sents, tokens)
-        Return:
-            the average of unmasked input tensors, size (batch, sents, 2 * hidden_size)
-        """
-        max_sents = mask.size(-2)
-
-        bool_mask = (mask.unsqueeze(dim = -1) == 0)  # turn binary masks to boolean values
-        masked_source = source.unsqueeze(dim = 1).masked_fill(bool_mask, value = 0)
-        masked_source = torch.sum(masked_source, dim = -2)  # sum the unmasked vectors
-        assert masked_source.size() == (batch_size, max_sents, 2 * self.hidden_size)
-
-        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # compute the denominator of average op
-        masked_mean = torch.div(input = masked_source, other = num_unmasked_tokens)  # average the unmasked vectors
-
-        # division op may cause nan while encoutering 0, so replace nan with 0
-        is_nan = torch.isnan(masked_mean)
-        masked_mean = masked_mean.masked_fill(is_nan, value = 0)
-
-        assert masked_mean.size() == (batch_size, max_sents, 2 * self.hidden_size)
-        return masked_mean
-
-
 class LocationPredictor(nn.Module):
     """
     Location prediction decoder: sentence-level Bi-LSTM + linear + softmax
@@ -381,36 +608,52 @@ class LocationPredictor(nn.Module):
         self.Hidden2Score = Linear(d_in = 2 * opt.hidden_size, d_out = 1, dropout = 0)
         self.CpnetMemory = CpnetMemory(opt, query_size=4 * opt.hidden_size, input_size=4 * opt.hidden_size)
         self.cpnet_inject = opt.cpnet_inject
+        self.precision = opt.precision
+        self.packed_lstm = opt.packed_lstm
         unk_vec = torch.empty(2 * opt.hidden_size)
         nn.init.uniform_(unk_vec, -math.sqrt(1 / opt.hidden_size), math.sqrt(1 / opt.hidden_size))
         self.unk_vec = nn.Parameter(unk_vec, requires_grad=True)  # learnable vector for '?' location
 
 
-    def forward(self, encoder_out, entity_mask, loc_mask, sentence_mask, cpnet_triples, cpnet_rep):
+    def forward(self, encoder_out, entity_mask, loc_mask, sentence_mask, cpnet_mask, cpnet_rep, num_sents, num_cands):
         """
         Args:
             encoder_out: output of the encoder, size (batch, max_tokens, 2 * hidden_size)
             entity_mask: size (batch, max_sents, max_tokens)
             sentence_mask: size(batch, max_sents, max_tokens)
-            cpnet_triples: List, (batch, num_cpnet)
+            cpnet_mask: size (batch, num_cpnet), 1 for real triples and 0 for padded ones
             loc_mask: size (batch, max_cands, max_sents, max_tokens)
+            num_sents: number of sentences of each instance (without location 0), size (batch,)
+            num_cands: number of location candidates of each instance (with the unk location), size (batch,)
         """
         batch_size = encoder_out.size(0)
         max_cands = loc_mask.size(-3) + 1
         max_sents = loc_mask.size(-2)
 
         decoder_in = self.get_masked_input(encoder_out, entity_mask, loc_mask, batch_size = batch_size)
-        decoder_in = decoder_in.view(batch_size * max_cands, max_sents, 4 * self.hidden_size)
         attn_probs = None
         if self.cpnet_inject in ['location', 'both']:
-            decoder_in, attn_probs = self.CpnetMemory(encoder_out=KOALA.expand_dim_3d(encoder_out, max_cands),
+            # all candidates of an instance attend to the same triples, so they are merged into the query dimension
+            # instead of copying the triples of each instance max_cands times
+            decoder_in = decoder_in.view(batch_size, max_cands * max_sents, 4 * self.hidden_size)
+            decoder_in, attn_probs = self.CpnetMemory(encoder_out=encoder_out,
                                           decoder_in=decoder_in,
-                                          entity_mask=KOALA.expand_dim_3d(entity_mask, max_cands),
-                                          sentence_mask=KOALA.expand_dim_3d(sentence_mask, max_cands),
-                                          cpnet_triples=cpnet_triples,
+                                          entity_mask=entity_mask,
+                                          sentence_mask=sentence_mask,
+                                          cpnet_mask=cpnet_mask,
                                           cpnet_rep=cpnet_rep,
-                                          loc_mask = loc_mask)
-        decoder_out, _ = self.Decoder(decoder_in)  # (batch, max_sents, 2 * hidden_size), forward & backward concatenated
+                                          num_cands = max_cands)
+        decoder_in = decoder_in.view(batch_size * max_cands, max_sents, 4 * self.hidden_size)
+
+        # only run the decoder on the real candidates of each instance, padded candidates get zero outputs
+        # (also without -packed_lstm, since the logits of padded candidates are masked anyway)
+        cand_range = torch.arange(max_cands, device = num_cands.device).unsqueeze(dim = 0)
+        seq_lens = (num_sents + 1).unsqueeze(dim = -1) * (cand_range < num_cands.unsqueeze(dim = -1))  # (batch, max_cands)
+        # (batch * max_cands, max_sents, 2 * hidden_size), forward & backward concatenated
+        with precision_autocast(self.precision, device_type = decoder_in.device.type):
+            decoder_out = run_packed_lstm(self.Decoder, decoder_in, lengths = seq_lens.view(batch_size * max_cands),
+                                          pack = self.packed_lstm)
+        decoder_out = decoder_out.float()
         assert decoder_out.size() == (batch_size * max_cands, max_sents, 2 * self.hidden_size)
 
         decoder_out = decoder_out.view(batch_size, max_cands, max_sents, 2 * self.hidden_size)
@@ -430,9 +673,9 @@ class LocationPredictor(nn.Module):
         max_sents = loc_mask.size(-2)
 
         # (batch, max_sents, 2 * hidden_size)
-        entity_rep = self.get_masked_mean(source = encoder_out, mask = entity_mask, batch_size = batch_size)
+        entity_rep = masked_mean(source = encoder_out, mask = entity_mask)
         # (batch, max_cands, max_sents, 2 * hidden_size)
-        loc_rep = self.get_masked_loc_mean(source = encoder_out, mask = loc_mask, batch_size = batch_size)
+        loc_rep = masked_mean(source = encoder_out, mask = loc_mask)
         unk_vec = self.unk_vec.expand(batch_size, max_sents, 2 * self.hidden_size)
         entity_existence = find_allzero_rows(vector = entity_mask).unsqueeze(dim = -1)  # (batch, max_sents, 1)
         unk_vec = unk_vec.masked_fill(mask=entity_existence, value=0).unsqueeze(dim=1)  # (batch, 1, max_sents, 2*hidden)
@@ -447,60 +690,6 @@ class LocationPredictor(nn.Module):
         return concat_rep
 
 
-    def get_masked_loc_mean(self, source, mask, batch_size: int):
-        """
-        Args:
-            source - input tensors, size(batch, tokens, 2 * hidden_size)
-            mask - binary masked vectors, size(batch, cands, sents, tokens)
-        Return:
-            the average of unmasked input tensors, size (batch, cands, sents, 2 * hidden_size)
-        """
-        max_sents = mask.size(-2)
-        max_cands = mask.size(-3)
-
-        bool_mask = (mask.unsqueeze(dim = -1) == 0)  # turn binary masks to boolean values
-        source = source.unsqueeze(dim = 1).unsqueeze(dim = 1)  # expand source to (batch, 1, 1, tokens, 2*hidden)
-        masked_source = source.masked_fill(bool_mask, value = 0)  # (batch, cands, sents, tokens, 2*hidden)
-        masked_source = torch.sum(masked_source, dim = -2)  # (batch, cands, sents, 2*hidden)
-        assert masked_source.size() == (batch_size, max_cands, max_sents, 2 * self.hidden_size)
-
-        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # (batch, cands, sents, 1)
-        masked_mean = torch.div(input = masked_source, other = num_unmasked_tokens)  # (batch, cands, sents, 2*hidden)
-
-        # division op may cause nan while encoutering 0, so replace nan with 0
-        is_nan = torch.isnan(masked_mean)
-        masked_mean = masked_mean.masked_fill(is_nan, value = 0)
-
-        assert masked_mean.size() == (batch_size, max_cands, max_sents, 2 * self.hidden_size)
-        return masked_mean
-
-
-    def get_masked_mean(self, source, mask, batch_size: int):
-        """
-        Args:
-            source - input tensors, size(batch, tokens, 2 * hidden_size)
-            mask - binary masked vectors, size(batch, sents, tokens)
-        Return:
-            the average of unmasked input tensors, size (batch, sents, 2 * hidden_size)
-        """
-        max_sents = mask.size(-2)
-
-        bool_mask = (mask.unsqueeze(dim = -1) == 0)  # turn binary masks to boolean values
-        masked_source = source.unsqueeze(dim = 1).masked_fill(bool_mask, value = 0)  # for masked tokens, turn its value to 0
-        masked_source = torch.sum(masked_source, dim = -2)  # sum the unmasked token representations
-        assert masked_source.size() == (batch_size, max_sents, 2 * self.hidden_size)
-
-        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # compute the denominator of average op (number of unmasked tokens)
-        masked_mean = torch.div(input = masked_source, other = num_unmasked_tokens)  # average the unmasked vectors
-
-        # division op may cause nan while encoutering 0, so replace nan with 0
-        is_nan = torch.isnan(masked_mean)
-        masked_mean = masked_mean.masked_fill(is_nan, value = 0)
-
-        assert masked_mean.size() == (batch_size, max_sents, 2 * self.hidden_size)
-        return masked_mean
-
-
 class CpnetMemory(nn.Module):
 
     def __init__(self, opt, query_size: int, input_size: int):
@@ -514,37 +703,29 @@ class CpnetMemory(nn.Module):
                                           input_size=self.input_size, dropout=opt.dropout)
 
 
-    def forward(self, encoder_out, decoder_in, entity_mask, sentence_mask, cpnet_triples: List[List[str]],
-                cpnet_rep, loc_mask = None):
+    def forward(self, encoder_out, decoder_in, entity_mask, sentence_mask, cpnet_mask: torch.IntTensor,
+                cpnet_rep, num_cands: int = None):
         """
         Args:
             encoder_out: size (batch, max_tokens, 2 * hidden_size)
             decoder_in: (batch, max_sents, 4 * hidden_size) for state tracking,
-                        (batch * max_cands, max_sents, 4 * hidden_size) for location prediciton
+                        (batch, max_cands * max_sents, 4 * hidden_size) for location prediciton
             entity_mask: size(batch, max_sents, max_tokens)
             sentence_mask: size(batch, max_sents, max_tokens)
-            cpnet_triples: List, (batch, num_cpnet)
+            cpnet_mask: size (batch, num_cpnet), 1 for real triples and 0 for padded ones
+            num_cands: max_cands for location prediction
         """
         assert encoder_out.size(0) == decoder_in.size(0) == entity_mask.size(0) == \
-                sentence_mask.size(0)
-        batch_size = encoder_out.size(0)
-        ori_batch_size = cpnet_rep.size(0)
+                sentence_mask.size(0) == cpnet_rep.size(0)
 
         # use the embedding of the current sentence as the attention query
         # (batch, max_sents, 2 * hidden_size)
-        # query = self.get_masked_mean(source=encoder_out, mask=sentence_mask, batch_size=batch_size)
+        # query = masked_mean(source=encoder_out, mask=sentence_mask)
         query = decoder_in
-        attn_mask = self.get_attn_mask(cpnet_triples)
-        if self.use_cuda:
-            attn_mask = attn_mask.cuda()
+        attn_mask = cpnet_mask
 
-        if loc_mask is not None:
-            assert cpnet_rep.size(0) != batch_size, batch_size % cpnet_rep.size(0) == 0
-            max_cands = batch_size // cpnet_rep.size(0)
-            cpnet_rep = KOALA.expand_dim_3d(cpnet_rep, loc_cands=max_cands)
-            attn_mask = KOALA.expand_dim_2d(attn_mask, loc_cands=max_cands)
         update_in, attn_probs = self.AttnUpdate(query=query, values=cpnet_rep, ori_input=decoder_in, attn_mask=attn_mask,
-                                    ori_batch_size = ori_batch_size)
+                                    num_cands = num_cands)
 
         # mask_vec = torch.sum(entity_mask, dim=-1, keepdim=True)
         # if loc_mask is not None:
@@ -554,40 +735,6 @@ class CpnetMemory(nn.Module):
         return update_in, attn_probs
 
 
-    def get_masked_mean(self, source, mask, batch_size: int):
-        """
-        Args:
-            source - input tensors, size(batch, tokens, 2 * hidden_size)
-            mask - binary masked vectors, size(batch, sents, tokens)
-        Return:
-            the average of unmasked input tensors, size (batch, sents, 2 * hidden_size)
-        """
-        max_sents = mask.size(-2)
-
-        bool_mask = (mask.unsqueeze(dim = -1) == 0)  # turn binary masks to boolean values
-        masked_source = source.unsqueeze(dim = 1).masked_fill(bool_mask, value = 0)  # for masked tokens, turn its value to 0
-        masked_source = torch.sum(masked_source, dim = -2)  # sum the unmasked token representations
-        assert masked_source.size() == (batch_size, max_sents, 2 * self.hidden_size)
-
-        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # compute the denominator of average op (number of unmasked tokens)
-        masked_mean = torch.div(input = masked_source, other = num_unmasked_tokens)  # average the unmasked vectors
-
-        # division op may cause nan while encoutering 0, so replace nan with 0
-        is_nan = torch.isnan(masked_mean)
-        masked_mean = masked_mean.masked_fill(is_nan, value = 0)
-
-        assert masked_mean.size() == (batch_size, max_sents, 2 * self.hidden_size)
-        return masked_mean
-
-
-    def get_attn_mask(self, cpnet_triples: List):
-        attn_mask = []
-        for instance in cpnet_triples:
-            attn_mask.append(list(map(lambda x: x != '', instance)))
-        return torch.tensor(attn_mask, dtype=torch.int)
-
-
-
 class GatedAttnUpdate(nn.Module):
     """
     Attention + gate update
@@ -607,47 +754,42 @@ class GatedAttnUpdate(nn.Module):
         self.concat_fc = Linear(input_size + value_size, input_size, dropout=dropout)
         self.Dropout = nn.Dropout(p=dropout)
 
-        self.attn_log = []
-
-    def forward(self, query, values, ori_input, attn_mask, ori_batch_size: int):
+    def forward(self, query, values, ori_input, attn_mask, num_cands: int = None):
         """
-        :param query: (batch, max_sents, query_size)
+        :param query: (batch, max_sents, query_size), or (batch, num_cands * max_sents, query_size)
+                      for location prediction, where all candidates attend to the same values
         :param values: (batch, num_cpnet, value_size)
         :param attn_mask: (batch, num_cpnet), 0 for pad values
-        :param ori_input: (batch, max_sents, input_size), input vector to be merged with context vector
-        :return:
+        :param ori_input: same size as query but with input_size, input vector to be merged with context vector
+        :param num_cands: number of candidates merged into the query dimension, None for state tracking
+        :return: the updated input, and the attention weights of size (batch, max_sents, num_cpnet)
+                 or (batch, num_cands, max_sents, num_cpnet)
         """
         assert query.size(0) == values.size(0), query.size(1) == ori_input.size(1)
         assert len(query.size()) == len(values.size()) == len(ori_input.size()) == 3
         batch_size = query.size(0)
         num_cpnet = values.size(1)
-        max_sents = query.size(1)
+        num_queries = query.size(1)
         assert query.size(-1) == self.query_size
         assert values.size(-1) == self.value_size
         assert ori_input.size(-1) == self.input_size
 
         # attention
-        attn_vec = self.attn_vec.unsqueeze(0).expand(batch_size, -1, -1)  # (batch, query_size, value_size)
-        # similarity score, (batch, max_sents, num_cpnet)
-        S = torch.bmm(torch.bmm(query, attn_vec), values.transpose(1, 2))
+        # similarity score, (batch, num_queries, num_cpnet)
+        S = torch.bmm(torch.matmul(query, self.attn_vec), values.transpose(1, 2))
 
         if attn_mask is not None:
             attn_mask = attn_mask.unsqueeze(1)
             S = S.masked_fill(attn_mask == 0, float('-inf'))
-        probs = F.softmax(S, dim=-1)  # attention weights, (batch, max_sents, num_cpnet)
-        if ori_batch_size != batch_size:
-            self.attn_log.extend(probs.view(ori_batch_size, -1, max_sents, num_cpnet).tolist())
-        else:
-            self.attn_log.extend(probs.tolist())
+        probs = F.softmax(S, dim=-1)  # attention weights, (batch, num_queries, num_cpnet)
         is_nan = torch.isnan(probs)
         probs = probs.masked_fill(is_nan, value=0)  # if no valid triple exist, the system will output nan
-        C = torch.bmm(probs, values).squeeze(dim=-1)  # weighted sum, (batch, max_sents, value_size)
-        assert C.size() == (batch_size, max_sents, self.value_size)
+        C = torch.bmm(probs, values)  # weighted sum, (batch, num_queries, value_size)
+        assert C.size() == (batch_size, num_queries, self.value_size)
 
         # select attention weights for attention loss
-        # for location prediction, only select one case since they are the same
-        if ori_batch_size != batch_size:
-            select_probs = probs.view(ori_batch_size, -1, max_sents, num_cpnet)
+        if num_cands is not None:
+            select_probs = probs.view(batch_size, num_cands, num_queries // num_cands, num_cpnet)
         else:
             select_probs = probs
 
@@ -656,7 +798,7 @@ class GatedAttnUpdate(nn.Module):
         gate_vec = torch.sigmoid(self.gate_fc(concat_vec))
         cand_input = self.concat_fc(concat_vec)
         final_input = torch.mul(gate_vec, cand_input) + torch.mul(1 - gate_vec, ori_input)
-        assert final_input.size() == (batch_size, max_sents, self.input_size)
+        assert final_input.size() == (batch_size, num_queries, self.input_size)
 
         return final_input, select_probs
 
@@ -669,81 +811,162 @@ class FixedSentEncoder(nn.Module):
         super(FixedSentEncoder, self).__init__()
         self.embed_size = MODEL_HIDDEN[opt.plm_model_name]
         self.hidden_size = opt.hidden_size
-        self.lm_batch_size = opt.batch_size
+        self.lm_token_budget = opt.cpnet_token_budget  # max number of (padded) tokens in a mini-batch of triples
         self.LSTM = nn.LSTM(input_size=self.embed_size, hidden_size=self.hidden_size,
                             num_layers=1, batch_first=True, bidirectional=True)
 
         self.use_cuda = not opt.no_cuda
+        self.precision = opt.precision
+        self.packed_lstm = opt.packed_lstm
         self.Dropout = nn.Dropout(p=opt.dropout)
+        self.hidden_cache = None  # EncoderCache of the frozen encoder, set by KOALA.set_cpnet_cache
 
 
-    def forward(self, input: List[List[str]], tokenizer, encoder):
+    def forward(self, input: torch.LongTensor, tokenizer, encoder):
         """
         Args:
-            input: size(batch, num_cpnet), each is a list of untokenized strings.
-        """
-        batch_size = len(input)
-        num_cpnet = len(input[0])
-        all_sents = itertools.chain.from_iterable(input)  # batch * num_cpnet
-        input_ids = list(map(lambda s: tokenizer.convert_tokens_to_ids(s.split()), all_sents))  # should already add special tokens
-        input_batches = [input_ids[batch_idx * self.lm_batch_size: (batch_idx + 1) * self.lm_batch_size]
-                         for batch_idx in range(len(input_ids) // self.lm_batch_size + 1)]
-        sent_embed = []
-
-        for batch_input_ids in input_batches:
-            mini_batch_size = len(batch_input_ids)
-            if not batch_input_ids:
-                continue
-
-            batch_input_ids, attention_mask, max_len = \
-                FixedSentEncoder.pad_to_longest(batch=batch_input_ids,
-                                                pad_id=tokenizer.pad_token_id)
-            if self.use_cuda:
-                batch_input_ids = batch_input_ids.cuda()
-                attention_mask = attention_mask.cuda()
-
-            with torch.no_grad():
-                outputs = encoder(batch_input_ids, attention_mask=attention_mask)
-
-            last_hidden = outputs[0]  # (batch, seq_len, hidden_size)
-            assert last_hidden.size() == (mini_batch_size, max_len, self.embed_size)
-
-            encoder_out, _ = self.LSTM(last_hidden)
-            encoder_out = self.Dropout(encoder_out)
-            special_token_mask = batch_input_ids > tokenizer.sep_token_id
-
-            for i in range(last_hidden.size(0)):
-                embedding = encoder_out[i]  # (max_length, hidden_size)
-                real_tokens = special_token_mask[i]
-                token_embed = embedding[real_tokens]  # get rid of <CLS> and <SEP>
-                mean_embed = torch.mean(token_embed, dim=0)
-                is_nan = torch.isnan(mean_embed)
-                mean_embed = mean_embed.masked_fill(is_nan, value=0)
-                sent_embed.append(mean_embed)
-
-        sent_embed = torch.stack(sent_embed, dim=0)
-        assert sent_embed.size() == (batch_size * num_cpnet, 2 * self.hidden_size)
+            input: token ids of the triples, size (batch, num_cpnet, max_len), special tokens should already be added.
+                   Padded triples (all tokens are padding) get a zero embedding.
+        Return:
+            sent_embed: size (batch, num_cpnet, 2 * hidden_size)
+        """
+        batch_size, num_cpnet, max_len = input.size()
+        input_ids = input.view(batch_size * num_cpnet, max_len)
+        real_index = (input_ids != tokenizer.pad_token_id).any(dim=-1).nonzero(as_tuple=True)[0]
+        sent_embed = torch.zeros((batch_size * num_cpnet, 2 * self.hidden_size), device=input.device)
+
+        if real_index.numel() > 0:
+            # each distinct triple in the batch is only encoded once
+            unique_ids, inverse = torch.unique(input_ids[real_index], dim=0, return_inverse=True)
+            unique_embed = self.encode_unique(unique_ids, tokenizer=tokenizer, encoder=encoder)
+            sent_embed[real_index] = unique_embed[inverse]
+
         sent_embed = self.Dropout(sent_embed)
         sent_embed = sent_embed.view(batch_size, num_cpnet, 2 * self.hidden_size)
 
         return sent_embed
 
 
-    @staticmethod
-    def pad_to_longest(batch: List, pad_id: int) -> (torch.LongTensor, torch.FloatTensor):
+    def encode_unique(self, input_ids: torch.LongTensor, tokenizer, encoder):
         """
-        Pad the sentences to the longest length in a batch
+        Encode triples in mini-batches of at most lm_token_budget (padded) tokens, each mini-batch
+        is padded to its longest triple. Triples are sorted by length to reduce padding.
+        Args:
+            input_ids: token ids of non-empty triples, size (num_triples, max_len)
+        Return:
+            sent_embed: mean of the BiLSTM outputs over the real tokens (except <CLS> and <SEP>),
+                        size (num_triples, 2 * hidden_size)
+        """
+        attention_mask = (input_ids != tokenizer.pad_token_id).long()  # avoid computing attention on padding tokens
+        triple_lens = attention_mask.sum(dim=-1)
+        order = torch.argsort(triple_lens, descending=True)
+        sorted_lens = triple_lens[order].tolist()
+        sent_embed = torch.zeros((input_ids.size(0), 2 * self.hidden_size), device=input_ids.device)
+
+        start = 0
+        while start < len(sorted_lens):
+            mini_max_len = sorted_lens[start]  # lengths are sorted, so the first triple is the longest
+            end = start + max(1, self.lm_token_budget // mini_max_len)
+            index = order[start:end]
+            batch_input_ids = input_ids[index, :mini_max_len]
+            batch_attention_mask = attention_mask[index, :mini_max_len]
+
+            with precision_autocast(self.precision, device_type = input_ids.device.type):
+                if self.hidden_cache is not None:
+                    last_hidden = self.hidden_cache.encode(encoder, batch_input_ids, batch_attention_mask)
+                else:
+                    with torch.no_grad():
+                        outputs = encoder(batch_input_ids, attention_mask=batch_attention_mask)
+                    last_hidden = outputs[0]  # (batch, seq_len, hidden_size)
+                assert last_hidden.size() == (index.size(0), mini_max_len, self.embed_size)
+
+                encoder_out = run_packed_lstm(self.LSTM, last_hidden, lengths = batch_attention_mask.sum(dim = -1),
+                                              pack = self.packed_lstm)
+            encoder_out = self.Dropout(encoder_out.float())
+
+            # get rid of <CLS>, <SEP> and padding, triples with no real token get zeros
+            real_tokens = (batch_input_ids > tokenizer.sep_token_id).to(encoder_out.dtype)
+            token_sum = torch.bmm(real_tokens.unsqueeze(1), encoder_out).squeeze(1)
+            token_cnt = real_tokens.sum(dim=-1, keepdim=True).clamp(min=1)
+            sent_embed[index] = token_sum / token_cnt
+            start = end
+
+        return sent_embed
+
+
+class ConstrainedCRF(CRF):
+    """
+    CRF with batched Viterbi decoding on tensors, including the backtracking.
+    If constrained, transitions that never appear in gold state sequences (e.g., O_C -> E) are forbidden
+    during decoding. Training (the log-likelihood) is not affected, and the parameters are the same as CRF.
+    """
+    def __init__(self, num_tags: int, batch_first: bool = True, constrained: bool = False):
+
+        super(ConstrainedCRF, self).__init__(num_tags, batch_first = batch_first)
+        self.constrained = constrained
+
+        # not saved in checkpoints, so that constraints can be switched on for trained models
+        start_allowed = torch.zeros(num_tags, dtype = torch.bool)
+        start_allowed[[state2idx[state] for state in START_STATES]] = True
+        trans_allowed = torch.zeros(num_tags, num_tags, dtype = torch.bool)
+        for prev_state, next_states in STATE_TRANSITIONS.items():
+            trans_allowed[state2idx[prev_state], [state2idx[state] for state in next_states]] = True
+        self.register_buffer('start_allowed', start_allowed, persistent = False)
+        self.register_buffer('trans_allowed', trans_allowed, persistent = False)
+
+
+    def decode(self, emissions: torch.Tensor, mask: torch.Tensor = None) -> List[List[int]]:
+        """
+        Same as CRF.decode, but the best paths are found by viterbi_decode and only copied to lists at the end.
         """
-        batch_size = len(batch)
-        max_length = max([len(batch[i]) for i in range(batch_size)])
+        best_tags = self.viterbi_decode(emissions, mask)
+        lengths = (best_tags != PAD_STATE).sum(dim = -1)
+        return [tags[:length] for tags, length in zip(best_tags.tolist(), lengths.tolist())]
 
-        pad_batch = [batch[i] + [pad_id for _ in range(max_length - len(batch[i]))] for i in range(batch_size)]
-        pad_batch = torch.tensor(pad_batch, dtype=torch.long)
-        # avoid computing attention on padding tokens
-        attention_mask = torch.ones_like(pad_batch).masked_fill(mask=(pad_batch==pad_id), value=0)
-        assert pad_batch.size() == attention_mask.size() == (batch_size, max_length)
 
-        return pad_batch, attention_mask, max_length
+    def viterbi_decode(self, emissions: torch.Tensor, mask: torch.Tensor = None) -> torch.LongTensor:
+        """
+        Args:
+            emissions: size (batch, max_sents, num_tags)
+            mask: 1 for real sentences, size (batch, max_sents). The first sentence of each instance must be real.
+        Return:
+            best tag sequences, padded with PAD_STATE, size (batch, max_sents)
+        """
+        assert self.batch_first
+        self._validate(emissions, mask = mask)
+        batch_size, max_sents, _ = emissions.size()
+        if mask is None:
+            mask = emissions.new_ones((batch_size, max_sents), dtype = torch.bool)
+        mask = mask.to(torch.bool)
+
+        start_transitions, transitions = self.start_transitions, self.transitions
+        if self.constrained:
+            start_transitions = start_transitions.masked_fill(~self.start_allowed, float('-inf'))
+            transitions = transitions.masked_fill(~self.trans_allowed, float('-inf'))
+
+        # score[b, j]: score of the best path of instance b that ends with tag j at the current sentence
+        score = start_transitions + emissions[:, 0]  # (batch, num_tags)
+        history = []  # history[i - 1][b, j]: best previous tag if instance b has tag j at sentence i
+        for i in range(1, max_sents):
+            # (batch, num_tags, num_tags), from tag (dim 1) to tag (dim 2)
+            next_score = score.unsqueeze(dim = 2) + transitions + emissions[:, i].unsqueeze(dim = 1)
+            next_score, indices = next_score.max(dim = 1)
+            score = torch.where(mask[:, i].unsqueeze(dim = 1), next_score, score)  # padded sentences keep the score
+            history.append(indices)
+        score = score + self.end_transitions
+
+        # backtrack all instances at once, starting from the best tag at the last real sentence
+        num_sents = mask.sum(dim = -1)
+        best_tags = emissions.new_full((batch_size, max_sents), PAD_STATE, dtype = torch.long)
+        cur_tag = score.argmax(dim = -1)  # (batch,)
+        for i in range(max_sents - 1, 0, -1):
+            is_real = i < num_sents
+            best_tags[:, i] = torch.where(is_real, cur_tag, best_tags[:, i])
+            prev_tag = history[i - 1].gather(1, cur_tag.unsqueeze(dim = 1)).squeeze(dim = 1)
+            cur_tag = torch.where(is_real, prev_tag, cur_tag)
+        best_tags[:, 0] = cur_tag
+
+        return best_tags
 
 
 class Linear(nn.Module):
@@ -0,0 +1,190 @@
+'''
+ Micro-benchmarks of the data pipeline and the model.
+'''
+
+import time
+import argparse
+import torch
+import numpy as np
+from torch.utils.data import DataLoader
+from typing import List, Dict
+from Constants import *
+from Dataset import *
+from Model import KOALA
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-task', type=str, choices=['getitem', 'padding', 'throughput'], default='getitem', help='which benchmark to run')
+parser.add_argument('-dataset', type=str, default='data/train.json', help='path to the dataset')
+parser.add_argument('-plm_model_class', type=str, default='bert', help='pre-trained language model class')
+parser.add_argument('-plm_model_name', type=str, default='bert-base-uncased', help='pre-trained language model name')
+parser.add_argument('-cpnet_path', type=str, default="ConceptNet/result/retrieval.json", help="path to conceptnet triples")
+parser.add_argument('-cpnet_struc_input', action='store_true', default=False,
+                    help='specify to use structural input format for ConceptNet triples')
+parser.add_argument('-state_verb', type=str, default='ConceptNet/result/state_verb_cut.json', help='path to state verb dict')
+parser.add_argument('-sparse_mask', action='store_true', default=False, help="store verb and location masks as indices")
+parser.add_argument('-repeat', type=int, default=3, help='number of passes over the dataset')
+parser.add_argument('-batch_size', type=int, default=32, help='batch size')
+parser.add_argument('-hidden_size', type=int, default=256, help="hidden size of lstm")
+parser.add_argument('-cpnet_token_budget', type=int, default=2048, help='max tokens per forward pass of the ConceptNet encoder')
+parser.add_argument('-precision', type=str, choices=['fp32', 'bf16'], default='fp32', help='autocast precision of the encoders')
+parser.add_argument('-crf_constraints', action='store_true', default=False, help='forbid invalid state transitions in decoding')
+parser.add_argument('-packed_lstm', action='store_true', default=False, help='run the LSTMs on packed sequences')
+parser.add_argument('-cpnet_plm_path', type=str, default=None, help='path to pre-fine-tuned knowledge encoder')
+parser.add_argument('-wiki_plm_path', type=str, default=None, help='path to pre-fine-tuned text encoder')
+parser.add_argument('-finetune', action='store_true', default=False, help='if true, fine-tune the bert encoder')
+parser.add_argument('-no_cuda', action='store_true', default=False, help="if true, will only use cpu")
+parser.add_argument('-max_batches', type=int, default=None, help='only run the first batches of each pass')
+opt = parser.parse_args()
+opt.feature_cache = None  # always measure the uncached path
+opt.dropout = 0.4
+opt.cpnet_inject = 'both'
+opt.no_wiki = opt.wiki_plm_path is None
+
+plm_model_class, plm_tokenizer_class, plm_config_class = MODEL_CLASSES[opt.plm_model_class]
+plm_tokenizer = plm_tokenizer_class.from_pretrained(opt.plm_model_name)
+
+
+class ListMaskDataset(ProparaDataset):
+    """
+    ProparaDataset with the original list-based mask construction, which builds
+    every mask separately with a membership test per token. Used as the baseline.
+    """
+    def get_word_mask(self, mention_idx: List[int], offset_map: List[int], para_len: int) -> List[int]:
+        word_mask = [1 if i in mention_idx else 0 for i in range(para_len)]
+        subword_mask = [1 if word_mask[offset_map[i]] == 1 else 0 for i in range(len(offset_map))]
+        return [0] + subword_mask + [0]
+
+    def build_masks(self, instance, offset_map: List[int]):
+        paragraph = instance.paragraph
+        total_sents, total_loc_cands, para_len = instance.total_sents, instance.total_loc_cands, paragraph.total_words
+        sent_starts = np.cumsum(paragraph.sentence_lens) - paragraph.sentence_lens
+        sentence_mention = [list(range(start, start + length)) for start, length in zip(sent_starts, paragraph.sentence_lens)]
+        sentence_mask = torch.IntTensor([self.get_word_mask(mention, offset_map, para_len)
+                                         for mention in sentence_mention])
+        entity_mask = torch.IntTensor([self.get_word_mask(instance.entity_mention[i].tolist(), offset_map, para_len)
+                                       for i in range(total_sents)])
+        verb_mask = torch.IntTensor([self.get_word_mask(instance.verb_mention[i].tolist(), offset_map, para_len)
+                                     for i in range(total_sents)])
+        loc_mask = torch.IntTensor([[self.get_word_mask(instance.loc_mention[i * total_loc_cands + idx].tolist(),
+                                                        offset_map, para_len)
+                                     for i in range(total_sents)] for idx in range(total_loc_cands)])
+        empty_mask = torch.zeros((total_loc_cands, 1, loc_mask.size(-1)), dtype=torch.int)
+        loc_mask = torch.cat([empty_mask, loc_mask], dim=1)
+        return sentence_mask, entity_mask, verb_mask, loc_mask
+
+
+def time_getitem(dataset, repeat: int) -> float:
+    """
+    Average latency of dataset.__getitem__ in milliseconds.
+    """
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for index in range(len(dataset)):
+            dataset[index]
+    return (time.perf_counter() - start_time) / (repeat * len(dataset)) * 1000
+
+
+def benchmark_getitem():
+    baseline_set = ListMaskDataset(opt.dataset, opt=opt, tokenizer=plm_tokenizer, is_test=False)
+    dataset = ProparaDataset(opt.dataset, opt=opt, tokenizer=plm_tokenizer, is_test=False)
+
+    for index in range(len(dataset)):
+        baseline, sample = baseline_set[index], dataset[index]
+        for field in ['sentence_mask', 'entity_mask', 'verb_mask', 'loc_mask']:
+            if isinstance(sample[field], SpanMask):
+                assert torch.equal(baseline[field].to_dense(), sample[field].to_dense())
+            else:
+                assert torch.equal(baseline[field], sample[field])
+
+    baseline_time = time_getitem(baseline_set, opt.repeat)
+    new_time = time_getitem(dataset, opt.repeat)
+    print(f'__getitem__ latency on {opt.dataset} ({len(dataset)} instances):\n'
+          f'list-based masks: {baseline_time:.3f}ms, vectorized masks: {new_time:.3f}ms '
+          f'({baseline_time / new_time:.2f}x)')
+
+
+def padding_ratio(dataset, batches: List[List[int]]) -> (float, float):
+    """
+    Padding ratio of paragraph tokens and location mask workload over the given batches.
+    """
+    padding = np.zeros(4, dtype=np.int64)
+    for batch in batches:
+        padding += count_padding([dataset[index]['metadata'] for index in batch])
+    real_tokens, padded_tokens, real_loc, padded_loc = padding
+    return 1 - real_tokens / padded_tokens, 1 - real_loc / padded_loc
+
+
+def benchmark_padding():
+    dataset = ProparaDataset(opt.dataset, opt=opt, tokenizer=plm_tokenizer, is_test=False)
+    sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(dataset), batch_size=opt.batch_size,
+                                            drop_last=False)
+    bucket_sampler = BucketBatchSampler(dataset.get_instance_sizes(), batch_size=opt.batch_size, shuffle=True)
+
+    token_ratio, loc_ratio = padding_ratio(dataset, list(sampler))
+    bucket_token_ratio, bucket_loc_ratio = padding_ratio(dataset, list(bucket_sampler))
+    print(f'Padding ratio on {opt.dataset} with batch size {opt.batch_size}:\n'
+          f'random batches: {token_ratio*100:.2f}% of tokens, {loc_ratio*100:.2f}% of location mask workload\n'
+          f'bucketed batches: {bucket_token_ratio*100:.2f}% of tokens, {bucket_loc_ratio*100:.2f}% of location mask workload')
+
+
+def run_model(model, data_loader, train: bool) -> float:
+    """
+    Run the model over the batches of data_loader, and return the throughput in instances per second.
+    """
+    model.train(train)
+    num_instances = 0
+    start_time = time.perf_counter()
+
+    for batch_idx, batch in enumerate(data_loader):
+        if opt.max_batches is not None and batch_idx >= opt.max_batches:
+            break
+        inputs = {field: batch[field] for field in ['token_ids', 'entity_mask', 'verb_mask', 'loc_mask', 'gold_loc_seq',
+                                                    'gold_state_seq', 'sentence_mask', 'cpnet_ids', 'cpnet_mask',
+                                                    'state_rel_labels', 'loc_rel_labels']}
+        inputs['num_cands'] = torch.IntTensor([meta['total_loc_cands'] + 1 for meta in batch['metadata']])
+        inputs['para_index'] = batch.get('para_index')
+        if not opt.no_cuda:
+            inputs = {field: value.cuda() if value is not None else None for field, value in inputs.items()}
+
+        with torch.set_grad_enabled(train):
+            result = model(**inputs)
+        if train:
+            state_loss, loc_loss, attn_loss = result[:3]
+            (state_loss + loc_loss + attn_loss).backward()
+            model.zero_grad()
+        num_instances += len(batch['metadata'])
+
+    if not opt.no_cuda:
+        torch.cuda.synchronize()
+    return num_instances / (time.perf_counter() - start_time)
+
+
+def benchmark_throughput():
+    dataset = ProparaDataset(opt.dataset, opt=opt, tokenizer=plm_tokenizer, is_test=False)
+    model = KOALA(opt=opt, is_test=False)
+    if not opt.no_cuda:
+        model.cuda()
+
+    para_ids = dataset.dataset.get_para_ids()
+    print(f'Throughput on {opt.dataset} ({len(dataset)} instances, {len(set(para_ids))} paragraphs) '
+          f'with batch size {opt.batch_size}:')
+    for train in [True, False]:
+        shuffle = train
+        data_loader = DataLoader(dataset, batch_size=opt.batch_size, shuffle=shuffle,
+                                 collate_fn=Collate(pad_token_id=plm_tokenizer.pad_token_id))
+        grouped_loader = DataLoader(dataset, batch_sampler=ParagraphBatchSampler(para_ids, batch_size=opt.batch_size,
+                                                                                 shuffle=shuffle),
+                                    collate_fn=Collate(pad_token_id=plm_tokenizer.pad_token_id, dedup_paragraphs=True))
+        throughput = run_model(model, data_loader, train=train)
+        grouped_throughput = run_model(model, grouped_loader, train=train)
+        print(f'{"train" if train else "test"}: {throughput:.1f} instances/s per-instance encoding, '
+              f'{grouped_throughput:.1f} instances/s paragraph-grouped encoding ({grouped_throughput / throughput:.2f}x)')
+
+
+if __name__ == "__main__":
+    if opt.task == 'getitem':
+        benchmark_getitem()
+    elif opt.task == 'padding':
+        benchmark_padding()
+    elif opt.task == 'throughput':
+        benchmark_throughput()
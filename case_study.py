@@ -11,6 +11,8 @@ from torch.utils.data import DataLoader
 from allennlp.modules.elmo import batch_to_ids
 from Dataset import *
 from Model import *
+from AttentionRecorder import AttentionRecorder
+from Checkpoint import load_flat_model
 from predict import predict_loc0, predict_consistent_loc
 import os
 import re
@@ -34,14 +36,23 @@ parser.add_argument('-cpnet_struc_input', action='store_true', default=False,
 parser.add_argument('-state_verb', type=str, default='ConceptNet/result/state_verb_cut.json', help='path to state verb dict')
 parser.add_argument('-cpnet_inject', choices=['state', 'location', 'both', 'none'], default='both',
                     help='where to inject ConceptNet commonsense')
+parser.add_argument('-cpnet_token_budget', type=int, default=2048, help='max tokens per forward pass of the ConceptNet encoder')
+parser.add_argument('-precision', type=str, choices=['fp32', 'bf16'], default='fp32', help='autocast precision of the encoders')
+parser.add_argument('-crf_constraints', action='store_true', default=False, help='forbid invalid state transitions in decoding')
+parser.add_argument('-packed_lstm', action='store_true', default=False, help='run the LSTMs on packed sequences')
 parser.add_argument('-wiki_plm_path', type=str, default=None, help='specify to use pre-finetuned language model')
 parser.add_argument('-no_wiki', action='store_true', default=False, help='specify to exclude wiki')
 
 
-parser.add_argument('-restore', type=str, default=None, help="restoring model path")
+parser.add_argument('-restore', type=str, default=None,
+                    help="restoring model path, or a .safetensors model file written by train.py -export_model")
 parser.add_argument('-test_set', type=str, default="data/test.json", help="path to test set")
 parser.add_argument('-output', type=str, default=None, help="path to store prediction outputs")
+parser.add_argument('-attn_output', type=str, default=None,
+                    help="if specified, also save the attention weights to {attn_output}.*.npy")
 parser.add_argument('-no_cuda', action='store_true', default=False, help="if true, will only use cpu")
+parser.add_argument('-feature_cache', type=str, default=None, help="directory to cache the pre-computed tensors")
+parser.add_argument('-sparse_mask', action='store_true', default=False, help="store verb and location masks as indices")
 opt = parser.parse_args()
 
 plm_model_class, plm_tokenizer_class, plm_config_class = MODEL_CLASSES[opt.plm_model_class]
@@ -84,14 +95,12 @@ def get_output(metadata: Dict, pred_state_seq: List[int], pred_loc_seq: List[int
 
 
 def write_output(output: List[Dict], output_filepath: str, sentences: List[List[str]],
-                 state_attn_log: List, loc_attn_log: List, cpnet_cands: int):
+                 attn_recorder: AttentionRecorder, cpnet_cands: int):
     """
     Reads the headers of prediction file from dummy_filepath and fill in the blanks with prediction.
     Prediction will be stored according to output_filepath.
     """
-    print_attn = False
-    if state_attn_log and loc_attn_log:
-        print_attn = True
+    print_attn = opt.cpnet_inject == 'both'  # both state and location attention are recorded
 
     output_file = open(output_filepath, 'w', encoding='utf-8')
     columns = ['para_id', 'timestep', 'entity', 'state', 'gold_state', 'location', 'gold_location', 'sentence']
@@ -122,8 +131,7 @@ def write_output(output: List[Dict], output_filepath: str, sentences: List[List[
         total_sents = instance['total_sents']
         gold_loc_seq = instance['gold_loc_seq']
         if print_attn:
-            state_attn_list = state_attn_log[i]
-            loc_attn_list = loc_attn_log[i]
+            state_attn_list, loc_attn_list = attn_recorder.get(i)
 
         correct_state, correct_loc = 0, 0
 
@@ -167,7 +175,8 @@ def write_output(output: List[Dict], output_filepath: str, sentences: List[List[
 
 def test(test_set, model):
     print('[INFO] Start testing...')
-    test_batch = DataLoader(dataset = test_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate())
+    test_batch = DataLoader(dataset = test_set, batch_size = opt.batch_size, shuffle = False,
+                            collate_fn = Collate(pad_token_id = plm_tokenizer.pad_token_id))
 
     start_time = time.time()
     report_state_correct, report_state_pred = 0, 0
@@ -180,8 +189,7 @@ def test(test_set, model):
         for batch in test_batch:
 
             paragraphs = batch['paragraph']
-            token_ids = plm_tokenizer.batch_encode_plus(paragraphs, add_special_tokens=True,
-                                                        return_tensors='pt')['input_ids']
+            token_ids = batch['token_ids']
             all_sentences.extend(batch['sentences'])
             sentence_mask = batch['sentence_mask']
             entity_mask = batch['entity_mask']
@@ -190,6 +198,8 @@ def test(test_set, model):
             gold_loc_seq = batch['gold_loc_seq']
             gold_state_seq = batch['gold_state_seq']
             cpnet_triples = batch['cpnet']
+            cpnet_ids = batch['cpnet_ids']
+            cpnet_mask = batch['cpnet_mask']
             state_rel_labels = batch['state_rel_labels']
             loc_rel_labels = batch['loc_rel_labels']
             metadata = batch['metadata']
@@ -206,11 +216,14 @@ def test(test_set, model):
                 gold_state_seq = gold_state_seq.cuda()
                 state_rel_labels = state_rel_labels.cuda()
                 loc_rel_labels = loc_rel_labels.cuda()
+                cpnet_ids = cpnet_ids.cuda()
+                cpnet_mask = cpnet_mask.cuda()
                 num_cands = num_cands.cuda()
 
             test_result = model(token_ids=token_ids, entity_mask=entity_mask, verb_mask=verb_mask,
                                 loc_mask=loc_mask, gold_loc_seq=gold_loc_seq, gold_state_seq=gold_state_seq,
-                                num_cands=num_cands, sentence_mask=sentence_mask, cpnet_triples=cpnet_triples,
+                                num_cands=num_cands, sentence_mask=sentence_mask,
+                                cpnet_ids=cpnet_ids, cpnet_mask=cpnet_mask,
                                 state_rel_labels=state_rel_labels, loc_rel_labels=loc_rel_labels)
 
             pred_state_seq, pred_loc_seq, test_state_correct, test_state_pred,\
@@ -240,11 +253,9 @@ def test(test_set, model):
            f'State Prediction Accuracy: {state_accuracy * 100:.3f}%, '
            f'Location Accuracy: {loc_accuracy * 100:.3f}%')
 
-    state_attn_log = model.StateTracker.CpnetMemory.AttnUpdate.attn_log
-    loc_attn_log = model.LocationPredictor.CpnetMemory.AttnUpdate.attn_log
-
+    model.attn_recorder.flush()
     write_output(output = output_result, output_filepath = opt.output, sentences = all_sentences,
-                 state_attn_log = state_attn_log, loc_attn_log = loc_attn_log, cpnet_cands = cpnet_cands)
+                 attn_recorder = model.attn_recorder, cpnet_cands = cpnet_cands)
     print(f'[INFO] Test finished. Time elapse: {time.time() - start_time}s')
 
 
@@ -253,12 +264,21 @@ if __name__ == "__main__":
 
     print('[INFO] Start loading trained model...')
     restore_start_time = time.time()
-    model = KOALA(opt=opt, is_test=True)
-    model_state_dict = torch.load(opt.restore)
-    model.load_state_dict(model_state_dict)
+    if opt.restore.endswith('.safetensors'):  # written by train.py -export_model, no need to initialize the model
+        model = load_flat_model(lambda: KOALA(opt=opt, is_test=True), opt.restore)
+    else:
+        model = KOALA(opt=opt, is_test=True)
+        model_state_dict = torch.load(opt.restore)
+        model.load_checkpoint_state_dict(model_state_dict)
     model.eval()
     print(f'[INFO] Loaded model from {opt.restore}, time elapse: {time.time() - restore_start_time}s')
 
     if not opt.no_cuda:
         model.cuda()
+
+    instance_sizes = test_set.get_instance_sizes()  # tokens, location candidates, sentences
+    model.attn_recorder = AttentionRecorder(capacity = len(test_set), max_sents = int(instance_sizes[:, 2].max()),
+                                            max_cands = int(instance_sizes[:, 1].max()) + 1,  # +1 for unk
+                                            max_cpnet = max(len(triples) for triples in test_set.cpnet.values()),
+                                            output_path = opt.attn_output)
     test(test_set, model)
\ No newline at end of file
@@ -11,6 +11,7 @@ import argparse
 import json
 from tqdm import tqdm
 from Dataset import *
+from AttentionRecorder import AttentionRecorder
 from Constants import *
 from typing import Dict, List
 import torch
@@ -23,12 +24,17 @@ parser.add_argument('-output', type=str, default='predict/rellabel_test.tsv')
 parser.add_argument('-cpnet_path', type=str, default="ConceptNet/result/retrieval.json", help="path to conceptnet triples")
 parser.add_argument('-state_verb', type=str, default='ConceptNet/result/state_verb_cut.json', help='path to state verb dict')
 parser.add_argument('-batch_size', type=int, default=64)
+parser.add_argument('-plm_model_name', type=str, default='bert-base-uncased', help='pre-trained language model name')
+parser.add_argument('-feature_cache', type=str, default=None, help="directory to cache the pre-computed tensors")
+parser.add_argument('-attn_file', type=str, default=None,
+                    help="attention weights saved by case_study.py -attn_output on the same dataset, printed after the labels")
 opt = parser.parse_args()
 opt.cpnet_struc_input = False  # add this arg to circumvent errors
+opt.sparse_mask = False
 
 
 def get_output(metadata: Dict, state_rel_labels: List[List[int]], loc_rel_labels: List[List[int]],
-               gold_state_seq: List[int], cpnet_triples: List[str]) -> Dict:
+               gold_state_seq: List[int], gold_loc_seq: List[int], cpnet_triples: List[str]) -> Dict:
     """
     Get the predicted output from generated sequences by the model.
     """
@@ -37,6 +43,7 @@ def get_output(metadata: Dict, state_rel_labels: List[List[int]], loc_rel_labels
     total_sents = metadata['total_sents']
 
     gold_state_seq = [idx2state[idx] for idx in gold_state_seq if idx != PAD_STATE]
+    gold_loc_ids = gold_loc_seq
     gold_loc_seq = metadata['raw_gold_loc']  # gold locations in string form
 
     result = {'id': para_id,
@@ -44,6 +51,7 @@ def get_output(metadata: Dict, state_rel_labels: List[List[int]], loc_rel_labels
               'total_sents': total_sents,
               'gold_state_seq': gold_state_seq,
               'gold_loc_seq': gold_loc_seq,
+              'gold_loc_ids': gold_loc_ids,
               'state_rel_labels': state_rel_labels,
               'loc_rel_labels': loc_rel_labels,
               'cpnet': cpnet_triples
@@ -51,7 +59,8 @@ def get_output(metadata: Dict, state_rel_labels: List[List[int]], loc_rel_labels
     return result
 
 
-def write_output(output: List[Dict], output_filepath: str, sentences: List[List[str]], cpnet_cands: int):
+def write_output(output: List[Dict], output_filepath: str, sentences: List[List[str]], cpnet_cands: int,
+                 attn_recorder: AttentionRecorder = None):
     """
     Reads the headers of prediction file from dummy_filepath and fill in the blanks with prediction.
     Prediction will be stored according to output_filepath.
@@ -79,6 +88,9 @@ def write_output(output: List[Dict], output_filepath: str, sentences: List[List[
         gold_state_seq = instance['gold_state_seq']
         gold_state_seq.insert(0, 'N/A')
         gold_loc_seq = instance['gold_loc_seq']
+        gold_loc_ids = instance['gold_loc_ids']
+        if attn_recorder is not None:
+            state_attn_list, loc_attn_list = attn_recorder.get(i)
 
         for step_i in range(total_sents + 1):  # number of states: total_sents + 1
             gold_state = gold_state_seq[step_i]
@@ -88,6 +100,11 @@ def write_output(output: List[Dict], output_filepath: str, sentences: List[List[
             if step_i > 0:
                 fields += [f'{state_label} / {loc_label}' for state_label, loc_label in
                            zip(state_rel_labels[step_i-1], loc_rel_labels[step_i])]  # shift right to avoid location 0
+            if step_i > 0 and attn_recorder is not None:
+                loc_attn = loc_attn_list[gold_loc_ids[step_i]][step_i] if gold_loc_ids[step_i] >= 0 else None
+                fields[6:] = [f'{field} ({state_attn:.2f}/{loc_attn[triple_i]:.2f})' if loc_attn is not None
+                              else f'{field} ({state_attn:.2f}/-)'
+                              for triple_i, (field, state_attn) in enumerate(zip(fields[6:], state_attn_list[step_i-1]))]
 
             output_file.write('\t'.join(fields) + '\n')
 
@@ -95,14 +112,18 @@ def write_output(output: List[Dict], output_filepath: str, sentences: List[List[
 
 
 def main():
-    plm_tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+    plm_tokenizer = BertTokenizer.from_pretrained(opt.plm_model_name)
     dataset = ProparaDataset(opt.dataset, opt=opt, tokenizer=plm_tokenizer, is_test=True)
-    data_batch = DataLoader(dataset=dataset, batch_size=opt.batch_size, shuffle=False, collate_fn=Collate())
+    data_batch = DataLoader(dataset=dataset, batch_size=opt.batch_size, shuffle=False, collate_fn=Collate(pad_token_id=plm_tokenizer.pad_token_id))
 
     output_result = []
     all_sentences = []
     cpnet_cands = 0
     all_labels = []
+    attn_recorder = None
+    if opt.attn_file is not None:
+        attn_recorder = AttentionRecorder.load(opt.attn_file)
+        assert len(attn_recorder) == len(dataset), 'The attention weights are recorded on a different dataset'
 
     for batch in tqdm(data_batch):
         gold_state_seq = batch['gold_state_seq']
@@ -118,13 +139,14 @@ def main():
         for i in range(batch_size):
             pred_instance = get_output(metadata=metadata[i],
                                        gold_state_seq=gold_state_seq[i].tolist(),
+                                       gold_loc_seq=batch['gold_loc_seq'][i].tolist(),
                                        cpnet_triples=cpnet_triples[i],
                                        state_rel_labels=state_rel_labels[i].tolist(),
                                        loc_rel_labels=loc_rel_labels[i].tolist())
             output_result.append(pred_instance)
 
     write_output(output=output_result, output_filepath=opt.output,
-                 sentences = all_sentences, cpnet_cands = cpnet_cands)
+                 sentences = all_sentences, cpnet_cands = cpnet_cands, attn_recorder = attn_recorder)
 
     # TODO: count the labeled ratio by timestep (use total_sents)
     all_labels = torch.cat(all_labels, dim=0)
@@ -0,0 +1,371 @@
+import os
+import json
+import unittest
+import unittest.mock
+import argparse
+import tempfile
+import itertools
+import numpy as np
+import torch
+
+from utils import SpanMask, span_masked_mean, masked_mean, run_packed_lstm, StemVocab, find_relevant_triple, hash_state_dict, \
+    get_pretrained_dir
+from Cache import EncoderCache
+from Constants import NUM_STATES, START_STATES, STATE_TRANSITIONS, idx2state
+from Model import KOALA, ConstrainedCRF
+from InstanceStore import InstanceStore
+from Dataset import BucketBatchSampler, DistributedBatchSampler, ResumableBatchSampler
+from Checkpoint import CheckpointWriter, save_flat_model, load_flat_model
+from torchcrf import CRF
+
+
+def random_mask(*size, density: float = 0.2) -> torch.IntTensor:
+    return (torch.rand(*size) < density).to(torch.int)
+
+
+class TestSpanMask(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1234)
+
+    def test_dense_roundtrip(self):
+        mask = random_mask(3, 4, 10)
+        self.assertTrue(torch.equal(SpanMask.from_dense(mask).to_dense(), mask))
+
+    def test_stack(self):
+        masks = [random_mask(2, 3, 7), random_mask(4, 1, 5), random_mask(1, 2, 9)]
+        shape = (4, 3, 9)
+        stacked = SpanMask.stack([SpanMask.from_dense(mask) for mask in masks], shape=shape)
+        dense = torch.zeros(len(masks), *shape, dtype=torch.int)
+        for i, mask in enumerate(masks):
+            dense[i, :mask.size(0), :mask.size(1), :mask.size(2)] = mask
+        self.assertEqual(stacked.size(), dense.size())
+        self.assertTrue(torch.equal(stacked.to_dense(), dense))
+
+    def test_sentence_mean(self):
+        source = torch.randn(4, 12, 16)
+        mask = random_mask(4, 5, 12)
+        mask[0, 1] = 0  # unmentioned sentence
+        expected = (source.unsqueeze(1) * mask.unsqueeze(-1)).sum(dim=-2) / mask.sum(dim=-1, keepdim=True).clamp(min=1)
+        dense_mean = masked_mean(source, mask)
+        sparse_mean = masked_mean(source, SpanMask.from_dense(mask))
+        self.assertTrue(torch.allclose(dense_mean, expected, rtol=0, atol=1e-6))
+        self.assertTrue(torch.allclose(dense_mean, sparse_mean, rtol=0, atol=1e-6))
+        self.assertTrue(torch.equal(dense_mean[0, 1], torch.zeros(16)))
+
+    def test_location_mean(self):
+        source = torch.randn(3, 12, 16, requires_grad=True)
+        mask = random_mask(3, 6, 5, 12)
+        mask[:, :, 0] = 0  # location 0
+        dense_mean = masked_mean(source, mask)
+        sparse_mean = masked_mean(source, SpanMask.from_dense(mask))
+        self.assertEqual(dense_mean.size(), (3, 6, 5, 16))
+        self.assertTrue(torch.allclose(dense_mean, sparse_mean, rtol=0, atol=1e-6))
+        dense_mean.sum().backward()
+        self.assertFalse(torch.isnan(source.grad).any())  # all-zero masks must not produce nan gradients
+
+    def test_empty_mask(self):
+        source = torch.randn(2, 6, 4)
+        mask = SpanMask.from_dense(torch.zeros(2, 3, 6, dtype=torch.int))
+        self.assertTrue(torch.equal(span_masked_mean(source, mask), torch.zeros(2, 3, 4)))
+
+
+class TestPackedLSTM(unittest.TestCase):
+
+    def test_matches_unpadded(self):
+        torch.manual_seed(1234)
+        lstm = torch.nn.LSTM(input_size=6, hidden_size=5, batch_first=True, bidirectional=True)
+        source = torch.randn(4, 7, 6)
+        lengths = torch.tensor([7, 3, 0, 5])
+        with torch.no_grad():
+            output = run_packed_lstm(lstm, source, lengths)
+            self.assertEqual(output.size(), (4, 7, 10))
+            for i, length in enumerate(lengths.tolist()):
+                if length > 0:
+                    expected, _ = lstm(source[i:i+1, :length])
+                    self.assertTrue(torch.allclose(output[i, :length], expected[0], atol=1e-6))
+                self.assertTrue(torch.equal(output[i, length:], torch.zeros(7 - length, 10)))
+
+    def test_matches_padded(self):
+        torch.manual_seed(1234)
+        lstm = torch.nn.LSTM(input_size=6, hidden_size=5, batch_first=True, bidirectional=True)
+        source = torch.randn(4, 7, 6)
+        lengths = torch.tensor([7, 3, 0, 5])
+        with torch.no_grad():
+            output = run_packed_lstm(lstm, source, lengths, pack=False)
+            expected, _ = lstm(source)
+            self.assertTrue(torch.allclose(output[lengths > 0], expected[lengths > 0], atol=1e-6))
+            self.assertTrue(torch.equal(output[2], torch.zeros(7, 10)))
+
+
+class TestRelevantTriple(unittest.TestCase):
+
+    def test_labels(self):
+        vocab = StemVocab()
+        state_token_ids = {'C': vocab.get_ids(['form']), 'M': vocab.get_ids(['move']), 'D': vocab.get_ids(['destroy'])}
+        triples = ['[CLS] rain forms in clouds [SEP]', '[CLS] water moves to the ground [SEP]', '[CLS] the a [SEP]']
+        triple_token_ids = [vocab.encode(triple) for triple in triples]
+        state_rel_labels, loc_rel_labels = find_relevant_triple(gold_loc_seq=['-', 'cloud', 'ground', 'ground'],
+                                                                gold_state_seq=['C', 'M', 'E'],
+                                                                state_token_ids=state_token_ids,
+                                                                triple_token_ids=triple_token_ids,
+                                                                stem_vocab=vocab)
+        self.assertEqual(state_rel_labels.tolist(), [[1, 0, 0], [0, 1, 0], [0, 0, 0]])
+        self.assertEqual(loc_rel_labels.tolist(), [[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 0]])
+
+    def test_no_triples(self):
+        vocab = StemVocab()
+        state_rel_labels, loc_rel_labels = find_relevant_triple(gold_loc_seq=['-', 'cloud'], gold_state_seq=['C'],
+                                                                state_token_ids={}, triple_token_ids=[],
+                                                                stem_vocab=vocab)
+        self.assertEqual(state_rel_labels.size(), (1, 0))
+        self.assertEqual(loc_rel_labels.size(), (2, 0))
+
+
+class TestEncoderCache(unittest.TestCase):
+
+    def test_persistence(self):
+        sequences = [np.array([101, 2000 + i, 102]) for i in range(20)]
+        hidden = [torch.randn(len(seq), 4) for seq in sequences]
+        with tempfile.TemporaryDirectory() as cache_path:
+            cache = EncoderCache(cache_path, hidden_size=4)
+            for seq, value in zip(sequences, hidden):
+                cache.put(EncoderCache.get_key(seq), value)
+            self.assertIsNone(cache.get(EncoderCache.get_key(np.array([101, 102]))))
+
+            reloaded = EncoderCache(cache_path, hidden_size=4)
+            self.assertEqual(len(reloaded), len(sequences))
+            for seq, value in zip(sequences, hidden):
+                self.assertTrue(torch.equal(reloaded.get(EncoderCache.get_key(seq)), value))
+
+            rebuilt = EncoderCache(cache_path, hidden_size=4, dtype='float16')  # incompatible with the stored states
+            self.assertEqual(len(rebuilt), 0)
+            rebuilt.put(EncoderCache.get_key(sequences[0]), hidden[0])
+            self.assertEqual(len(EncoderCache(cache_path, hidden_size=4, dtype='float16')), 1)
+
+    def test_ram_budget(self):
+        with tempfile.TemporaryDirectory() as cache_path:
+            cache = EncoderCache(cache_path, hidden_size=1024, max_ram_mb=1)
+            for i in range(10):
+                cache.put(EncoderCache.get_key(np.array([i])), torch.randn(64, 1024))
+            self.assertLessEqual(cache.ram_bytes, 1 << 20)
+            self.assertEqual(cache.get(EncoderCache.get_key(np.array([0]))).size(), (64, 1024))  # evicted, read from disk
+
+    def test_encode(self):
+        class Encoder(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.embedding = torch.nn.Embedding(10, 4)
+                self.dropout = torch.nn.Dropout(p=0.5)
+                self.num_inputs = 0
+
+            def forward(self, input_ids, attention_mask):
+                self.num_inputs += input_ids.size(0)
+                return (self.dropout(self.embedding(input_ids)),)
+
+        encoder = Encoder().train()
+        input_ids = torch.tensor([[1, 2, 3], [4, 5, 0], [1, 2, 3]])
+        attention_mask = (input_ids != 0).long()
+        with tempfile.TemporaryDirectory() as cache_path:
+            cache = EncoderCache(cache_path, hidden_size=4)
+            last_hidden = cache.encode(encoder, input_ids, attention_mask)
+            self.assertEqual(encoder.num_inputs, 3)
+            self.assertTrue(encoder.training)
+            with torch.no_grad():
+                expected = encoder.embedding(input_ids) * attention_mask.unsqueeze(-1)  # no dropout, zero padding
+            self.assertTrue(torch.equal(last_hidden, expected))
+            self.assertTrue(torch.equal(cache.encode(encoder, input_ids[1:], attention_mask[1:]), expected[1:]))
+            self.assertEqual(encoder.num_inputs, 3)  # all cached
+
+
+class TestViterbi(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1234)
+        self.emissions = torch.randn(16, 6, NUM_STATES)
+        lengths = torch.randint(1, 7, (16,))
+        self.mask = torch.arange(6).unsqueeze(0) < lengths.unsqueeze(1)
+
+    def test_matches_torchcrf(self):
+        crf = ConstrainedCRF(NUM_STATES, batch_first=True)
+        reference = CRF(NUM_STATES, batch_first=True)
+        reference.load_state_dict(crf.state_dict())
+        self.assertEqual(crf.decode(self.emissions, self.mask), reference.decode(self.emissions, self.mask))
+
+    def test_constraints(self):
+        crf = ConstrainedCRF(NUM_STATES, batch_first=True, constrained=True)
+        for emissions, length in zip(self.emissions, self.mask.sum(dim=-1).tolist()):
+            best_score, best_path = float('-inf'), None
+            for path in itertools.product(range(NUM_STATES), repeat=length):  # enumerate all valid paths
+                states = [idx2state[idx] for idx in path]
+                if states[0] not in START_STATES or \
+                        any(next_state not in STATE_TRANSITIONS[state] for state, next_state in zip(states, states[1:])):
+                    continue
+                score = crf._compute_score(emissions[:length].unsqueeze(1), torch.tensor(path).unsqueeze(1),
+                                           torch.ones(length, 1, dtype=torch.bool)).item()
+                if score > best_score:
+                    best_score, best_path = score, list(path)
+            self.assertEqual(crf.decode(emissions[:length].unsqueeze(0)), [best_path])
+
+
+
+class TestGoldAttnProbs(unittest.TestCase):
+
+    def test_matches_loop(self):
+        torch.manual_seed(1234)
+        loc_attn_probs = torch.rand(4, 5, 7, 9, requires_grad=True)
+        gold_loc_seq = torch.randint(-3, 5, (4, 7))
+        pick_loc_seq = gold_loc_seq.masked_fill(gold_loc_seq < 0, 0)
+        expected = torch.stack([loc_attn_probs[i][pick_loc_seq[i][j]][j] for i in range(4) for j in range(7)]).view(4, 7, 9)
+        expected_grad, = torch.autograd.grad(expected.sum(), loc_attn_probs)
+
+        gold_attn_probs = KOALA.get_gold_attn_probs(None, loc_attn_probs, gold_loc_seq)
+        gold_attn_grad, = torch.autograd.grad(gold_attn_probs.sum(), loc_attn_probs)
+        self.assertTrue(torch.equal(gold_attn_probs, expected))
+        self.assertTrue(torch.equal(gold_attn_grad, expected_grad))
+
+
+class TestEncoderHash(unittest.TestCase):
+
+    def test_stored_hash(self):
+        def get_hash(encoder, source):
+            model = argparse.Namespace(encoder_hashes={}, encoder_sources={'encoder': source}, encoder=encoder,
+                                       encoder_hash_file=KOALA.encoder_hash_file)
+            return KOALA.get_encoder_hash(model, 'encoder')
+
+        encoder = torch.nn.Linear(3, 2)
+        with tempfile.TemporaryDirectory() as source:
+            weight_path = os.path.join(source, 'model.bin')
+            torch.save(encoder.state_dict(), weight_path)
+            self.assertEqual(get_hash(encoder, source), hash_state_dict(encoder))
+            self.assertTrue(os.path.exists(os.path.join(source, KOALA.encoder_hash_file)))
+            self.assertEqual(get_hash(torch.nn.Linear(3, 2), source), hash_state_dict(encoder))  # not computed again
+
+            other = torch.nn.Linear(3, 2)
+            torch.save(other.state_dict(), weight_path)
+            os.utime(weight_path, ns=(0, 0))  # the weights changed
+            self.assertEqual(get_hash(other, source), hash_state_dict(other))
+
+    def test_hub_snapshot(self):
+        try:
+            from huggingface_hub import constants
+        except ImportError:
+            self.skipTest('huggingface_hub is not installed')
+        encoder = torch.nn.Linear(3, 2)
+        with tempfile.TemporaryDirectory() as hub_cache, unittest.mock.patch.object(constants, 'HF_HUB_CACHE', hub_cache):
+            repo_dir = os.path.join(hub_cache, 'models--koala--encoder')
+            snapshot_dir = os.path.join(repo_dir, 'snapshots', 'abc')
+            os.makedirs(snapshot_dir)
+            os.makedirs(os.path.join(repo_dir, 'refs'))
+            open(os.path.join(repo_dir, 'refs', 'main'), 'w').write('abc')
+            torch.save(encoder.state_dict(), os.path.join(snapshot_dir, 'model.bin'))
+            self.assertEqual(get_pretrained_dir('koala/encoder'), snapshot_dir)
+            self.assertIsNone(get_pretrained_dir('koala/missing'))
+
+            model = argparse.Namespace(encoder_hashes={}, encoder_sources={'encoder': 'koala/encoder'}, encoder=encoder,
+                                       encoder_hash_file=KOALA.encoder_hash_file)
+            self.assertEqual(KOALA.get_encoder_hash(model, 'encoder'), hash_state_dict(encoder))
+            self.assertTrue(os.path.exists(os.path.join(snapshot_dir, KOALA.encoder_hash_file)))
+
+
+class TestInstanceStore(unittest.TestCase):
+
+    def test_shard_index(self):
+        raw_instances = json.load(open('data/dev.json', 'r', encoding='utf-8'))[:10]
+        with tempfile.TemporaryDirectory() as data_dir:
+            json.dump(raw_instances[:6], open(os.path.join(data_dir, 'a.json'), 'w', encoding='utf-8'))
+            with open(os.path.join(data_dir, 'b.jsonl'), 'w', encoding='utf-8') as fout:
+                fout.writelines(json.dumps(raw) + '\n' for raw in raw_instances[6:])
+
+            store = InstanceStore(data_dir)
+            self.assertEqual(len(store), 10)
+            self.assertEqual(store.shards, [None, None])  # no shard is parsed until it is accessed
+            self.assertEqual(store[7].entity, raw_instances[7]['entity'])
+            self.assertEqual(store.shards[0], None)
+
+            index_path = os.path.join(data_dir, InstanceStore.shard_index_file)
+            index = json.load(open(index_path, 'r', encoding='utf-8'))
+            index['a.json']['num_instances'] = 5
+            json.dump(index, open(index_path, 'w', encoding='utf-8'))
+            self.assertEqual(len(InstanceStore(data_dir)), 9)  # counted from the index
+            os.utime(os.path.join(data_dir, 'a.json'), ns=(0, 0))  # the shard changed
+            self.assertEqual(len(InstanceStore(data_dir)), 10)
+
+
+class TestDistributedBatchSampler(unittest.TestCase):
+
+    def get_shards(self, pad: bool, epoch: int):
+        sizes = np.random.RandomState(0).randint(1, 100, size=(50, 3))
+        shards = []
+        for rank in range(3):
+            sampler = DistributedBatchSampler(BucketBatchSampler(sizes, batch_size=4, shuffle=True),
+                                              num_replicas=3, rank=rank, pad=pad)
+            sampler.set_epoch(epoch)
+            shards.append(list(sampler))
+            self.assertEqual(len(sampler), len(shards[-1]))
+        return shards
+
+    def test_shards(self):
+        shards = self.get_shards(pad=False, epoch=0)
+        self.assertEqual([len(shard) for shard in shards], [5, 4, 4])  # 13 batches
+        indices = sorted(index for shard in shards for batch in shard for index in batch)
+        self.assertEqual(indices, list(range(50)))  # every process shuffled the same way
+
+        padded_shards = self.get_shards(pad=True, epoch=0)
+        self.assertEqual([len(shard) for shard in padded_shards], [5, 5, 5])
+        self.assertEqual(padded_shards[0], shards[0])
+        self.assertNotEqual(self.get_shards(pad=False, epoch=1), shards)
+
+
+class TestResume(unittest.TestCase):
+
+    def test_skip(self):
+        sampler = ResumableBatchSampler(torch.utils.data.BatchSampler(range(10), batch_size=3, drop_last=False))
+        sampler.skip(2)
+        self.assertEqual(list(sampler), [[6, 7, 8], [9]])
+        self.assertEqual(list(sampler), [[6, 7, 8], [9]])  # until the next epoch
+        sampler.set_epoch(1)
+        self.assertEqual(len(list(sampler)), len(sampler))
+
+    def test_writer(self):
+        weight = torch.zeros(3)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'resume.pt')
+            writer = CheckpointWriter()
+            writer.save({'weight': weight, 'step': 1}, path)
+            weight += 1  # a later training step
+            writer.close()
+            state = torch.load(path)
+            self.assertTrue(torch.equal(state['weight'], torch.zeros(3)))
+            self.assertEqual(state['step'], 1)
+            self.assertEqual(os.listdir(cache_dir), ['resume.pt'])
+
+
+class TestFlatModel(unittest.TestCase):
+
+    @staticmethod
+    def build_model() -> torch.nn.Module:
+        return torch.nn.ModuleDict({'crf': ConstrainedCRF(NUM_STATES, constrained=True), 'head': torch.nn.Linear(4, 3),
+                                    'cpnet_encoder': torch.nn.Linear(4, 3), 'embed_encoder': torch.nn.Linear(4, 3)})
+
+    def test_roundtrip(self):
+        model = self.build_model()
+        model['embed_encoder'].load_state_dict(model['cpnet_encoder'].state_dict())
+        model['head'].load_state_dict(model['cpnet_encoder'].state_dict())
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'model.safetensors')
+            save_flat_model(model, path, shared_modules=['cpnet_encoder', 'embed_encoder'])
+            loaded = load_flat_model(self.build_model, path)
+            loaded_tensors = dict(itertools.chain(loaded.named_parameters(remove_duplicate=False), loaded.named_buffers()))
+            for name, tensor in itertools.chain(model.named_parameters(), model.named_buffers()):
+                self.assertTrue(torch.equal(loaded_tensors[name], tensor))
+            # only the equal tensors of the shared modules are stored once
+            self.assertEqual(loaded['embed_encoder'].weight.data_ptr(), loaded['cpnet_encoder'].weight.data_ptr())
+            self.assertNotEqual(loaded['head'].weight.data_ptr(), loaded['cpnet_encoder'].weight.data_ptr())
+            emissions = torch.randn(2, 5, NUM_STATES)
+            self.assertTrue(torch.equal(loaded['crf'].viterbi_decode(emissions), model['crf'].viterbi_decode(emissions)))
+            del loaded  # release the memory map before the directory is removed
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,21 +8,24 @@ import time
 print('[INFO] Starting import...')
 import_start_time = time.time()
 import torch
+import torch.distributed as dist
 import json
 import os
 import pdb
 import random
+import contextlib
 import numpy as np
 from typing import List, Dict
 from Constants import *
 import argparse
 # from torchsummaryX import summary
 from tensorboardX import SummaryWriter
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler, BatchSampler, RandomSampler, SequentialSampler
 from utils import *
 from predict import *
 from Dataset import *
 from Model import *
+from Checkpoint import *
 print(f'[INFO] Import modules time: {time.time() - import_start_time}s')
 torch.set_printoptions(precision=3, edgeitems=6, sci_mode=False, threshold=3000)
 
@@ -40,6 +43,13 @@ parser.add_argument('-loc_loss', type=float, default=0.3, help="hyper-parameter
 parser.add_argument('-attn_loss', type=float, default=0.5, help="hyper-parameter to weight attention loss")
 parser.add_argument('-max_grad_norm', default=1.0, type=float, help="Max gradient norm")
 parser.add_argument('-grad_accum_step', default=1, type=int, help='gradient accumulation steps')
+parser.add_argument('-precision', type=str, choices=['fp32', 'bf16'], default='fp32',
+                    help='bf16: run the language models and LSTMs under bfloat16 autocast, on both CPU and GPU')
+parser.add_argument('-crf_constraints', action='store_true', default=False,
+                    help='forbid state transitions that never appear in gold state sequences (e.g., O_C -> E) in decoding')
+parser.add_argument('-packed_lstm', action='store_true', default=False,
+                    help='run the LSTMs on packed sequences, so that padding does not reach their backward direction. '
+                         'Changes the outputs of a trained model, so use it in both training and testing')
 
 # training parameters
 parser.add_argument('-mode', type=str, choices=['train', 'test'], default='train', help="train or test")
@@ -47,17 +57,55 @@ parser.add_argument('-ckpt_dir', type=str, default=None, help="directory to save
 parser.add_argument('-save_mode', type=str, choices=['best', 'all', 'none', 'last', 'best-last'], default='best',
                     help="best (default): save checkpoints when reaching new best score; all: save all checkpoints; "
                          "none: don't save; best-last: save both the best and the last checkpoint")
+parser.add_argument('-save_frozen_encoders', action='store_true', default=False,
+                    help="also save the frozen BERT encoders in checkpoints, instead of a reference to their pretrained weights")
+parser.add_argument('-save_resume', action='store_true', default=False,
+                    help="at each report, save the state needed to resume training (-resume) to resume.pt in -ckpt_dir")
+parser.add_argument('-resume', action='store_true', default=False,
+                    help="resume an interrupted training from the last report, using the state saved by -save_resume "
+                         "in -ckpt_dir, and keep saving it")
 parser.add_argument('-epoch', type=int, default=100, help="number of epochs, use -1 to rely on early stopping only")
 parser.add_argument('-impatience', type=int, default=20,
                     help='number of evaluation rounds for early stopping, use -1 to disable early stopping')
 parser.add_argument('-report', type=int, default=2, help="report frequence per epoch, should be at least 1")
-parser.add_argument('-train_set', type=str, default="data/train.json", help="path to training set")
-parser.add_argument('-dev_set', type=str, default="data/dev.json", help="path to dev set")
+parser.add_argument('-skip_train_decode', action='store_true', default=False,
+                    help="only decode predictions on the last batch before each report to compute training accuracy")
+parser.add_argument('-train_set', type=str, default="data/train.json", help="path to training set, or a directory of json/jsonl shards")
+parser.add_argument('-dev_set', type=str, default="data/dev.json", help="path to dev set, or a directory of json/jsonl shards")
 parser.add_argument('-no_cuda', action='store_true', default=False, help="if true, will only use cpu")
+parser.add_argument('-dist_backend', type=str, choices=['nccl', 'gloo'], default=None,
+                    help="backend of distributed training launched by torchrun, default: gloo with -no_cuda, otherwise nccl")
+parser.add_argument('-feature_cache', type=str, default=None,
+                    help="directory to cache the pre-computed tensors of each dataset, built on first use")
+parser.add_argument('-sparse_mask', action='store_true', default=False,
+                    help="if true, store verb and location masks as token indices instead of dense tensors")
+parser.add_argument('-num_workers', type=int, default=0, help="number of worker processes for data loading")
+parser.add_argument('-prefetch_factor', type=int, default=2, help="number of batches loaded in advance by each worker")
+parser.add_argument('-pin_memory', action='store_true', default=False,
+                    help="if true, load batches into pinned memory for faster host-to-gpu copy")
+parser.add_argument('-bucket_batch', action='store_true', default=False,
+                    help="if true, batch together instances of similar lengths to reduce padding")
+parser.add_argument('-group_by_paragraph', action='store_true', default=False,
+                    help="if true, batch together the entities of the same paragraph and encode each paragraph once")
+parser.add_argument('-cpnet_cache', type=str, default=None,
+                    help="directory to cache the hidden states of the frozen ConceptNet encoder for each triple")
+parser.add_argument('-cpnet_cache_ram', type=int, default=1024,
+                    help="memory budget (MB) of the recently used ConceptNet hidden states kept in RAM")
+parser.add_argument('-embed_cache', type=str, default=None,
+                    help="directory to store the hidden states of the frozen paragraph encoder (without -finetune), "
+                         "which is run once over the train and dev sets before training")
+parser.add_argument('-embed_cache_ram', type=int, default=1024,
+                    help="memory budget (MB) of the recently used paragraph hidden states kept in RAM")
+parser.add_argument('-embed_cache_dtype', type=str, choices=['float32', 'float16'], default='float32',
+                    help="dtype of the stored paragraph hidden states, float16 halves the size of the store")
 
 # test parameters
-parser.add_argument('-test_set', type=str, default="data/test.json", help="path to test set")
-parser.add_argument('-restore', type=str, default=None, help="path to saved checkpoint")
+parser.add_argument('-test_set', type=str, default="data/test.json", help="path to test set, or a directory of json/jsonl shards")
+parser.add_argument('-restore', type=str, default=None,
+                    help="path to saved checkpoint, or in test mode, to a .safetensors model file written by -export_model")
+parser.add_argument('-export_model', type=str, default=None,
+                    help="in test mode, also write the restored model to this .safetensors file, "
+                         "which is memory-mapped for a faster startup when passed to -restore")
 parser.add_argument('-dummy_test', type=str, default="data/dummy-predictions.tsv", help="path to prediction file template")
 parser.add_argument('-output', type=str, default=None, help="path to store prediction outputs")
 
@@ -72,6 +120,8 @@ parser.add_argument('-state_verb', type=str, default='ConceptNet/result/state_ve
                     help='path to co-appearance verb set of entity states')
 parser.add_argument('-cpnet_inject', choices=['state', 'location', 'both', 'none'], default='both',
                     help='where to inject ConceptNet commonsense, select "none" to avoid infusing ConceptNet')
+parser.add_argument('-cpnet_token_budget', type=int, default=2048,
+                    help='max number of (padded) tokens per forward pass of the ConceptNet encoder')
 parser.add_argument('-wiki_plm_path', type=str, default=None,
                     help='specify to use pre-fine-tuned text encoder on Wiki paragraphs')
 parser.add_argument('-finetune', action='store_true', default=False, help='if true, fine-tune the bert encoder')
@@ -79,10 +129,25 @@ parser.add_argument('-no_wiki', action='store_true', default=False, help='if tru
 
 opt = parser.parse_args()
 
-try:
-    opt.n_gpu = len(os.environ["CUDA_VISIBLE_DEVICES"].split(','))
-except KeyError:  # did not specify device from cmd
-    opt.n_gpu = 1
+# distributed training (one process per GPU, or several CPU processes with -no_cuda), launched by torchrun
+opt.world_size = int(os.environ.get('WORLD_SIZE', 1))
+opt.rank = int(os.environ.get('RANK', 0))
+opt.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+opt.distributed = opt.world_size > 1
+
+if opt.distributed:
+    assert opt.mode == 'train', "test mode should be run in a single process"
+    if opt.dist_backend is None:
+        opt.dist_backend = 'gloo' if opt.no_cuda else 'nccl'
+    dist.init_process_group(backend = opt.dist_backend)
+    if not opt.no_cuda:
+        torch.cuda.set_device(opt.local_rank)
+    opt.n_gpu = 1  # each process drives a single device
+else:
+    try:
+        opt.n_gpu = len(os.environ["CUDA_VISIBLE_DEVICES"].split(','))
+    except KeyError:  # did not specify device from cmd
+        opt.n_gpu = 1
 opt.batch_size = opt.per_gpu_batch_size * opt.n_gpu
 
 if opt.cpnet_inject == 'none':
@@ -91,13 +156,34 @@ if opt.cpnet_inject == 'none':
 if opt.cpnet_struc_input:
     assert opt.cpnet_plm_path is not None
 
+if opt.pin_memory and opt.no_cuda:
+    print('[WARNING] -pin_memory has no effect with -no_cuda')
+    opt.pin_memory = False
+
+if opt.sparse_mask:
+    assert opt.no_cuda or opt.n_gpu == 1, "-sparse_mask does not support nn.DataParallel"
+
+if opt.group_by_paragraph:
+    assert opt.no_cuda or opt.n_gpu == 1, "-group_by_paragraph does not support nn.DataParallel"
+    assert not opt.bucket_batch, "-group_by_paragraph and -bucket_batch cannot be used together"
+
+if opt.resume:
+    opt.save_resume = True
+
+if opt.mode == 'train' and opt.save_resume:
+    assert opt.ckpt_dir, "-save_resume and -resume need a -ckpt_dir to store the training state"
+
+if opt.mode == 'train' and opt.restore is not None:
+    assert not opt.restore.endswith('.safetensors'), \
+        "models exported by -export_model can only be restored in test mode, use a .pt checkpoint to resume training"
+
 plm_model_class, plm_tokenizer_class, plm_config_class = MODEL_CLASSES[opt.plm_model_class]
 plm_tokenizer = plm_tokenizer_class.from_pretrained(opt.plm_model_name)
 
-if opt.ckpt_dir and not os.path.exists(opt.ckpt_dir):
+if opt.ckpt_dir and opt.rank == 0 and not os.path.exists(opt.ckpt_dir):
     os.mkdir(opt.ckpt_dir)
-# prepare logger
-if opt.ckpt_dir:
+# prepare logger, only the main process writes logs and checkpoints
+if opt.ckpt_dir and opt.rank == 0:
     log_path = os.path.join(opt.ckpt_dir, 'train.log')
     if os.path.exists(log_path):
         log_file = open(log_path, 'a', encoding='utf-8')
@@ -106,6 +192,8 @@ if opt.ckpt_dir:
 
 
 def output(text):
+    if opt.rank != 0:
+        return
     print(text)
     if opt.ckpt_dir:
         print(text, file = log_file)
@@ -117,15 +205,16 @@ output('-' * 50)
 
 assert opt.report >= 1
 
-torch.manual_seed(1234)
-np.random.seed(1234)
-random.seed(1234)
+# different dropout masks in different processes, the data order is seeded separately (see get_data_loader)
+torch.manual_seed(1234 + opt.rank)
+np.random.seed(1234 + opt.rank)
+random.seed(1234 + opt.rank)
 if opt.n_gpu > 0:
-    torch.cuda.manual_seed_all(1234)
+    torch.cuda.manual_seed_all(1234 + opt.rank)
 
 
-def save_model(ckpt_dir, model_name, model: nn.Module, optimizer):
-    if opt.save_mode == 'none':
+def save_model(ckpt_dir, model_name, model: nn.Module, optimizer, writer: CheckpointWriter):
+    if opt.save_mode == 'none' or opt.rank != 0:
         return
 
     if not opt.ckpt_dir:
@@ -133,47 +222,177 @@ def save_model(ckpt_dir, model_name, model: nn.Module, optimizer):
         raise RuntimeError("Did not specify -ckpt_dir option")
 
     model_to_save = model.module if hasattr(model, "module") else model
-    model_state_dict = model_to_save.state_dict()
-    torch.save(model_state_dict, os.path.join(ckpt_dir, model_name))
+    model_state_dict = model_to_save.checkpoint_state_dict(save_frozen = opt.save_frozen_encoders)
+    writer.save(model_state_dict, os.path.join(ckpt_dir, model_name))
 
     if opt.save_mode in ['last', 'best-last', 'all']:
         optim_state_dict = optimizer.state_dict()
-        torch.save(optim_state_dict, os.path.join(ckpt_dir, "optimizer.pt"))
+        writer.save(optim_state_dict, os.path.join(ckpt_dir, "optimizer.pt"))
+
+
+def save_train_state(model: nn.Module, optimizer, writer: CheckpointWriter, train_state: Dict, rank_state: Dict):
+    """
+    Save everything needed to resume training from the next batch (-resume) to resume.pt in -ckpt_dir:
+    the model and optimizer states, the training progress (train_state), and the random states and
+    statistics of each process (rank_state), which are gathered by the main process. Only with -save_resume.
+    """
+    if not opt.save_resume:
+        return
+
+    rank_states = [rank_state]
+    if opt.distributed:
+        rank_states = [None] * opt.world_size
+        dist.all_gather_object(rank_states, rank_state)
+    if opt.rank != 0:
+        return
+
+    model_to_save = model.module if hasattr(model, "module") else model
+    model_state_dict = model_to_save.checkpoint_state_dict(save_frozen = opt.save_frozen_encoders)
+    train_state = dict(train_state, model = model_state_dict, optimizer = optimizer.state_dict(),
+                       rank_states = rank_states, world_size = opt.world_size)
+    writer.save(train_state, os.path.join(opt.ckpt_dir, 'resume.pt'))
+
+
+def get_data_loader(dataset: ProparaDataset, shuffle: bool) -> DataLoader:
+    """
+    Build the DataLoader of a dataset, with length bucketing (-bucket_batch) or paragraph grouping (-group_by_paragraph).
+    In distributed training, each process loads its own shard of the batches. Training shards are padded
+    to the same number of batches, since all processes synchronize on every step, while evaluation shards are not.
+    Batches of the training set (shuffle) can be skipped to resume an interrupted epoch (see ResumableBatchSampler).
+    """
+    # without workers, Collate writes the batch directly into pinned memory, which saves one copy
+    collate_pin_memory = opt.pin_memory and opt.num_workers == 0
+    collate_fn = Collate(pad_token_id = plm_tokenizer.pad_token_id, pin_memory = collate_pin_memory,
+                         dedup_paragraphs = opt.group_by_paragraph)
+    loader_kwargs = {'collate_fn': collate_fn,
+                     'num_workers': opt.num_workers,
+                     'pin_memory': opt.pin_memory and not collate_pin_memory}
+    if opt.num_workers > 0:
+        loader_kwargs['prefetch_factor'] = opt.prefetch_factor
+        # only the training loader is iterated more than once, evaluation loaders are rebuilt on every call
+        loader_kwargs['persistent_workers'] = shuffle
+
+    if opt.bucket_batch:
+        batch_sampler = BucketBatchSampler(dataset.get_instance_sizes(), batch_size = opt.batch_size, shuffle = shuffle)
+    elif opt.group_by_paragraph:
+        batch_sampler = ParagraphBatchSampler(dataset.dataset.get_para_ids(),
+                                              batch_size = opt.batch_size, shuffle = shuffle)
+    elif opt.distributed and shuffle:
+        sampler = DistributedSampler(dataset, num_replicas = opt.world_size, rank = opt.rank, shuffle = True, seed = 1234)
+        batch_sampler = BatchSampler(sampler, batch_size = opt.batch_size, drop_last = False)
+    else:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, batch_size = opt.batch_size, drop_last = False)
+
+    if opt.distributed and not isinstance(getattr(batch_sampler, 'sampler', None), DistributedSampler):
+        batch_sampler = DistributedBatchSampler(batch_sampler, num_replicas = opt.world_size, rank = opt.rank,
+                                                pad = shuffle, seed = 1234)
+    if shuffle:
+        batch_sampler = ResumableBatchSampler(batch_sampler)
+    return DataLoader(dataset = dataset, batch_sampler = batch_sampler, **loader_kwargs)
+
+
+def all_reduce_sum(values: List[float]) -> List[float]:
+    """
+    Sum the statistics of all processes in distributed training.
+    """
+    values = torch.tensor(values, dtype = torch.float64, device = 'cpu' if opt.no_cuda else 'cuda')
+    dist.all_reduce(values, op = dist.ReduceOp.SUM)
+    return values.tolist()
+
+
+def fill_embed_cache(model, datasets: List[ProparaDataset]):
+    """
+    Run the frozen paragraph encoder once over the paragraphs of the datasets and store the hidden states,
+    so that training epochs and evaluations only run the rest of the model.
+    """
+    start_time = time.time()
+    with torch.no_grad():
+        for dataset in datasets:
+            for batch in get_data_loader(dataset, shuffle = False):
+                token_ids = batch['token_ids']
+                if not opt.no_cuda:
+                    token_ids = token_ids.cuda(non_blocking = opt.pin_memory)
+                attention_mask = (token_ids != plm_tokenizer.pad_token_id).to(torch.int)
+                model.embed(token_ids, attention_mask)
+    if opt.distributed:  # each process encoded its own shard, read the entries written by the others
+        dist.barrier()
+        model.embed_cache.load_index()
+    print(f'[INFO] {len(model.embed_cache)} paragraphs in the paragraph encoder cache, '
+          f'time elapse: {time.time() - start_time:.2f}s')
 
 
 def train():
 
-    if opt.ckpt_dir:
+    tb_writer = None  # only the main process writes to TensorBoard
+    if opt.ckpt_dir and opt.rank == 0:
         if opt.ckpt_dir.endswith('/'):
             tb_writer = SummaryWriter(logdir=os.path.join('runs', opt.ckpt_dir.split('/')[-2]))
         else:
             tb_writer = SummaryWriter(logdir=os.path.join('runs', opt.ckpt_dir.split('/')[-1]))
-    else:
+    elif opt.rank == 0:
         tb_writer = SummaryWriter()
 
+    if opt.distributed and opt.rank != 0:
+        dist.barrier()  # let the main process build the feature caches first
     train_set = ProparaDataset(opt.train_set, opt=opt, tokenizer=plm_tokenizer, is_test=False)
-
-    train_batch = DataLoader(dataset=train_set, batch_size=opt.batch_size, shuffle=True, collate_fn=Collate())
     dev_set = ProparaDataset(opt.dev_set, opt=opt, tokenizer=plm_tokenizer, is_test=False)
+    if opt.distributed and opt.rank == 0:
+        dist.barrier()
+
+    train_batch = get_data_loader(train_set, shuffle = True)
 
     model = KOALA(opt = opt, is_test = False)
+    if opt.restore is not None:  # before wrapping, the checkpoint is saved without the "module." prefix
+        model_state_dict = torch.load(opt.restore, map_location = 'cpu')
+        model.load_checkpoint_state_dict(model_state_dict)
+
+    resume_state = None
+    if opt.resume:
+        assert opt.restore is None, '-resume and -restore can not be used together'
+        resume_path = os.path.join(opt.ckpt_dir, 'resume.pt')
+        resume_state = torch.load(resume_path, map_location = 'cpu', weights_only = False)  # with numpy random states
+        assert resume_state['world_size'] == opt.world_size, 'training must be resumed with the same number of processes'
+        model.load_checkpoint_state_dict(resume_state['model'])
     if not opt.no_cuda:
         model.cuda()
-        if opt.n_gpu > 1:
-            model = nn.DataParallel(model)
+    if opt.distributed:
+        # the pooler of the fine-tuned BERT never gets gradients, neither do the unused ConceptNet modules
+        find_unused_parameters = opt.finetune or opt.cpnet_inject != 'both'
+        model = nn.parallel.DistributedDataParallel(model, device_ids = None if opt.no_cuda else [opt.local_rank],
+                                                    find_unused_parameters = find_unused_parameters)
+    elif not opt.no_cuda and opt.n_gpu > 1:
+        model = nn.DataParallel(model)
     optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=opt.lr)
 
     if opt.restore is not None:
-        model_state_dict = torch.load(opt.restore)
-        model.load_state_dict(model_state_dict)
-        optim_state_dict = torch.load(os.path.join(opt.ckpt_dir, "optimizer.pt"))
+        optim_state_dict = torch.load(os.path.join(opt.ckpt_dir, "optimizer.pt"), map_location = 'cpu')
         optimizer.load_state_dict(optim_state_dict)
         print(f'[INFO] Loaded model and optimizer from {opt.ckpt_dir}, resume training...')
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state['optimizer'])
+
+    if opt.cpnet_cache is not None:
+        model_to_cache = model.module if hasattr(model, "module") else model
+        model_to_cache.set_cpnet_cache(opt.cpnet_cache, max_ram_mb = opt.cpnet_cache_ram)
 
-    best_score = np.NINF
+    if opt.embed_cache is not None:
+        assert not opt.finetune, '-embed_cache can not be used together with -finetune'
+        model_to_cache = model.module if hasattr(model, "module") else model
+        model_to_cache.set_embed_cache(opt.embed_cache, max_ram_mb = opt.embed_cache_ram, dtype = opt.embed_cache_dtype)
+        fill_embed_cache(model_to_cache, [train_set, dev_set])
+
+    best_score = -np.inf
     impatience = 0
     epoch_i = 0
     report_cnt = 0
+    eval_score = None
+    if resume_state is not None:
+        best_score, impatience = resume_state['best_score'], resume_state['impatience']
+        epoch_i, report_cnt, eval_score = resume_state['epoch'], resume_state['report_cnt'], resume_state['eval_score']
+        print(f'[INFO] Resume training from {resume_path}, after batch {resume_state["batch_cnt"]} of epoch {epoch_i+1}')
+
+    checkpoint_writer = CheckpointWriter() if opt.rank == 0 else None  # writes checkpoints in the background
 
     if opt.epoch == -1:
         opt.epoch = np.inf
@@ -187,80 +406,111 @@ def train():
     while epoch_i < opt.epoch:
 
         model.train()
-        train_instances = len(train_set)
+        train_batch.batch_sampler.set_epoch(epoch_i)  # shuffle the shards of distributed training differently in each epoch
 
         start_time = time.time()
         report_state_loss, report_loc_loss = 0, 0
         report_state_correct, report_state_pred = 0, 0
         report_loc_correct, report_loc_pred = 0, 0
+        report_state_decoded, report_loc_decoded = 0, 0  # number of predictions that count in accuracy
         report_attn_loss, report_attn_pred = 0, 0
         batch_cnt = 0
-
-        if train_instances % opt.batch_size == 0:
-            total_batches = train_instances // opt.batch_size
-        else:
-            total_batches = train_instances // opt.batch_size + 1
+        epoch_padding = np.zeros(4, dtype=np.int64)  # real & padded workload of tokens and location masks
+
+        if resume_state is not None:  # draw the same data order as the interrupted epoch, and skip the trained batches
+            rank_state = resume_state['rank_states'][opt.rank]
+            batch_cnt = resume_state['batch_cnt']
+            epoch_padding = rank_state['epoch_padding']
+            set_rng_state(rank_state['epoch_rng_state'])
+            train_batch.batch_sampler.skip(batch_cnt)
+
+        epoch_rng_state = get_rng_state()
+        batch_iter = iter(train_batch)  # the data order of the epoch is drawn here
+        if resume_state is not None:
+            set_rng_state(rank_state['rng_state'])
+            resume_state = None
+
+        total_batches = len(train_batch)
         report_batch = get_report_time(total_batches = total_batches,
                                        report_times = opt.report,
                                        grad_accum_step = opt.grad_accum_step)  # when to report results
 
-        for batch in train_batch:
+        for batch in batch_iter:
 
-            paragraphs = batch['paragraph']
-            token_ids = plm_tokenizer.batch_encode_plus(paragraphs, add_special_tokens=True,
-                                                        return_tensors='pt')['input_ids']
+            token_ids = batch['token_ids']
             sentence_mask = batch['sentence_mask']
             entity_mask = batch['entity_mask']
             verb_mask = batch['verb_mask']
             loc_mask = batch['loc_mask']
             gold_loc_seq = batch['gold_loc_seq']
             gold_state_seq = batch['gold_state_seq']
-            cpnet_triples = batch['cpnet']
+            cpnet_ids = batch['cpnet_ids']
+            cpnet_mask = batch['cpnet_mask']
+            para_index = batch.get('para_index')
             state_rel_labels = batch['state_rel_labels']
             loc_rel_labels = batch['loc_rel_labels']
             metadata = batch['metadata']
             num_cands = torch.IntTensor([meta['total_loc_cands'] + 1 for meta in metadata])  # +1 for unk
+            epoch_padding += count_padding(metadata)
 
             if not opt.no_cuda:
-                token_ids = token_ids.cuda()
-                sentence_mask = sentence_mask.cuda()
-                entity_mask = entity_mask.cuda()
-                verb_mask = verb_mask.cuda()
-                loc_mask = loc_mask.cuda()
-                gold_loc_seq = gold_loc_seq.cuda()
-                gold_state_seq = gold_state_seq.cuda()
-                state_rel_labels = state_rel_labels.cuda()
-                loc_rel_labels = loc_rel_labels.cuda()
-                num_cands = num_cands.cuda()
-
-            train_result = model(token_ids = token_ids, entity_mask = entity_mask, verb_mask = verb_mask,
-                                 loc_mask = loc_mask, gold_loc_seq = gold_loc_seq, gold_state_seq = gold_state_seq,
-                                 num_cands = num_cands, sentence_mask = sentence_mask, cpnet_triples = cpnet_triples,
-                                 state_rel_labels = state_rel_labels, loc_rel_labels = loc_rel_labels)
-
-            train_state_loss, train_loc_loss, train_attn_loss, train_state_correct,\
-            train_state_pred, train_loc_correct, train_loc_pred, train_attn_pred = train_result
+                token_ids = token_ids.cuda(non_blocking = opt.pin_memory)
+                sentence_mask = sentence_mask.cuda(non_blocking = opt.pin_memory)
+                entity_mask = entity_mask.cuda(non_blocking = opt.pin_memory)
+                verb_mask = verb_mask.cuda(non_blocking = opt.pin_memory)
+                loc_mask = loc_mask.cuda(non_blocking = opt.pin_memory)
+                gold_loc_seq = gold_loc_seq.cuda(non_blocking = opt.pin_memory)
+                gold_state_seq = gold_state_seq.cuda(non_blocking = opt.pin_memory)
+                state_rel_labels = state_rel_labels.cuda(non_blocking = opt.pin_memory)
+                loc_rel_labels = loc_rel_labels.cuda(non_blocking = opt.pin_memory)
+                cpnet_ids = cpnet_ids.cuda(non_blocking = opt.pin_memory)
+                cpnet_mask = cpnet_mask.cuda(non_blocking = opt.pin_memory)
+                if para_index is not None:
+                    para_index = para_index.cuda(non_blocking = opt.pin_memory)
+                num_cands = num_cands.cuda(non_blocking = opt.pin_memory)
+
+            # predictions are only needed for training accuracy
+            decode = not opt.skip_train_decode or batch_cnt + 1 in report_batch
+            # in distributed training, gradients are only all-reduced on the last step of gradient accumulation
+            if opt.distributed and (batch_cnt + 1) % opt.grad_accum_step != 0:
+                sync_context = model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+
+            with sync_context:
+                train_result = model(token_ids = token_ids, entity_mask = entity_mask, verb_mask = verb_mask,
+                                     loc_mask = loc_mask, gold_loc_seq = gold_loc_seq, gold_state_seq = gold_state_seq,
+                                     num_cands = num_cands, sentence_mask = sentence_mask,
+                                     cpnet_ids = cpnet_ids, cpnet_mask = cpnet_mask,
+                                     state_rel_labels = state_rel_labels, loc_rel_labels = loc_rel_labels,
+                                     para_index = para_index, decode = decode)
+
+                train_state_loss, train_loc_loss, train_attn_loss, train_state_correct,\
+                train_state_pred, train_loc_correct, train_loc_pred, train_attn_pred = train_result
+
+                if opt.n_gpu > 1:
+                    train_state_loss = train_state_loss.mean()
+                    train_loc_loss = train_loc_loss.mean()
+                    if train_attn_loss is not None:
+                        train_attn_loss = train_attn_loss.mean()
 
-            if opt.n_gpu > 1:
-                train_state_loss = train_state_loss.mean()
-                train_loc_loss = train_loc_loss.mean()
+                train_loss = train_state_loss + opt.loc_loss * train_loc_loss
                 if train_attn_loss is not None:
-                    train_attn_loss = train_attn_loss.mean()
-
-            train_loss = train_state_loss + opt.loc_loss * train_loc_loss
-            if train_attn_loss is not None:
-                train_loss += opt.attn_loss * train_attn_loss
+                    train_loss += opt.attn_loss * train_attn_loss
 
-            if opt.grad_accum_step > 1:
-                train_loss = train_loss / opt.grad_accum_step
-            train_loss.backward()
+                if opt.grad_accum_step > 1:
+                    train_loss = train_loss / opt.grad_accum_step
+                train_loss.backward()
 
             report_state_loss += train_state_loss.item() * train_state_pred
             report_loc_loss += train_loc_loss.item() * train_loc_pred
-            report_state_correct += train_state_correct
             report_state_pred += train_state_pred
-            report_loc_correct += train_loc_correct
             report_loc_pred += train_loc_pred
+            if decode:
+                report_state_correct += train_state_correct
+                report_loc_correct += train_loc_correct
+                report_state_decoded += train_state_pred
+                report_loc_decoded += train_loc_pred
             if train_attn_loss is not None:
                 report_attn_loss += train_attn_loss.item() * train_attn_pred
                 report_attn_pred += train_attn_pred
@@ -275,6 +525,14 @@ def train():
                 # time to report results
                 if batch_cnt in report_batch:
 
+                    if opt.distributed:
+                        report_state_loss, report_loc_loss, report_state_correct, report_state_pred, \
+                        report_loc_correct, report_loc_pred, report_state_decoded, report_loc_decoded, \
+                        report_attn_loss, report_attn_pred = all_reduce_sum([
+                            report_state_loss, report_loc_loss, report_state_correct, report_state_pred,
+                            report_loc_correct, report_loc_pred, report_state_decoded, report_loc_decoded,
+                            report_attn_loss, report_attn_pred])
+
                     state_loss = report_state_loss / report_state_pred  # average over all elements
                     loc_loss = report_loc_loss / report_loc_pred
                     total_loss = state_loss + opt.loc_loss * loc_loss
@@ -285,9 +543,9 @@ def train():
                     else:
                         attn_loss = 0
 
-                    state_accuracy = report_state_correct / report_state_pred
-                    loc_accuracy = report_loc_correct / report_loc_pred
-                    total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
+                    state_accuracy = report_state_correct / report_state_decoded
+                    loc_accuracy = report_loc_correct / report_loc_decoded
+                    total_accuracy = (report_state_correct + report_loc_correct) / (report_state_decoded + report_loc_decoded)
 
                     output('*' * 50)
                     output(f'{batch_cnt}/{total_batches}, Epoch {epoch_i+1}:\n'
@@ -300,11 +558,14 @@ def train():
                     output('-' * 50)
 
                     report_cnt += 1
-                    tb_writer.add_scalar('train_state_loss', state_loss, report_cnt)
-                    tb_writer.add_scalar('train_loc_loss', loc_loss, report_cnt)
+                    if tb_writer is not None:
+                        tb_writer.add_scalar('train_state_loss', state_loss, report_cnt)
+                        tb_writer.add_scalar('train_loc_loss', loc_loss, report_cnt)
 
                     model.eval()
-                    eval_score = evaluate(dev_set, model, tb_writer, report_cnt)
+                    # in distributed training, each process evaluates its own shard of the dev set without syncing
+                    eval_model = model.module if opt.distributed else model
+                    eval_score = evaluate(dev_set, eval_model, tb_writer, report_cnt)
                     model.train()
 
                     if eval_score > best_score:  # new best score
@@ -312,32 +573,59 @@ def train():
                         impatience = 0
                         output('New best score!')
                         if opt.save_mode == 'all':
-                            save_model(opt.ckpt_dir, f'best_checkpoint_{best_score:.3f}.pt', model, optimizer)
+                            save_model(opt.ckpt_dir, f'best_checkpoint_{best_score:.3f}.pt', model, optimizer,
+                                       checkpoint_writer)
                         elif opt.save_mode in ['best', 'best-last']:
-                            save_model(opt.ckpt_dir, f'best_checkpoint.pt', model, optimizer)
+                            save_model(opt.ckpt_dir, f'best_checkpoint.pt', model, optimizer, checkpoint_writer)
                     else:
                         impatience += 1
                         output(f'Impatience: {impatience}, best score: {best_score:.3f}.')
                         if opt.save_mode == 'all':
-                            save_model(opt.ckpt_dir, f'checkpoint{report_cnt}_{eval_score:.3f}.pt', model, optimizer)
+                            save_model(opt.ckpt_dir, f'checkpoint{report_cnt}_{eval_score:.3f}.pt', model, optimizer,
+                                       checkpoint_writer)
                         if impatience >= opt.impatience:
                             output('Early Stopping!')
                             if opt.save_mode in ['last', 'best-last']:
-                                save_model(opt.ckpt_dir, f'checkpoint{report_cnt}_{eval_score:.3f}.pt', model, optimizer)
-                            tb_writer.close()
-                            quit()
+                                save_model(opt.ckpt_dir, f'checkpoint{report_cnt}_{eval_score:.3f}.pt', model, optimizer,
+                                           checkpoint_writer)
+                            if tb_writer is not None:
+                                tb_writer.close()
+                            if checkpoint_writer is not None:
+                                checkpoint_writer.close()
+                            return
+
+                    train_state = {'epoch': epoch_i, 'batch_cnt': batch_cnt, 'best_score': best_score,
+                                   'impatience': impatience, 'report_cnt': report_cnt, 'eval_score': eval_score}
+                    rank_state = {'epoch_rng_state': epoch_rng_state, 'rng_state': get_rng_state(),
+                                  'epoch_padding': epoch_padding.copy()}
+                    save_train_state(model, optimizer, checkpoint_writer, train_state, rank_state)
 
                     report_state_loss, report_loc_loss = 0, 0
                     report_state_correct, report_state_pred = 0, 0
                     report_loc_correct, report_loc_pred = 0, 0
+                    report_state_decoded, report_loc_decoded = 0, 0
                     report_attn_loss, report_attn_pred = 0, 0
                     start_time = time.time()
 
+        if opt.distributed:
+            epoch_padding = all_reduce_sum(epoch_padding.tolist())
+        real_tokens, padded_tokens, real_loc, padded_loc = epoch_padding
+        token_pad_ratio = 1 - real_tokens / padded_tokens
+        loc_pad_ratio = 1 - real_loc / padded_loc
+        output(f'Epoch {epoch_i+1} padding ratio: {token_pad_ratio*100:.2f}% of paragraph tokens, '
+               f'{loc_pad_ratio*100:.2f}% of location mask workload')
+        if tb_writer is not None:
+            tb_writer.add_scalar('token_pad_ratio', token_pad_ratio, epoch_i + 1)
+            tb_writer.add_scalar('loc_pad_ratio', loc_pad_ratio, epoch_i + 1)
+
         epoch_i += 1
 
     if opt.save_mode in ['last', 'best-last']:
-        save_model(opt.ckpt_dir, f'checkpoint{report_cnt}_{eval_score:.3f}.pt', model, optimizer)
-    tb_writer.close()
+        save_model(opt.ckpt_dir, f'checkpoint{report_cnt}_{eval_score:.3f}.pt', model, optimizer, checkpoint_writer)
+    if tb_writer is not None:
+        tb_writer.close()
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
 
 
         # summary(model, char_paragraph, entity_mask, verb_mask, loc_mask)
@@ -346,7 +634,7 @@ def train():
 
 
 def evaluate(dev_set, model, tb_writer, report_cnt: int):
-    dev_batch = DataLoader(dataset=dev_set, batch_size=opt.batch_size, shuffle=False, collate_fn=Collate())
+    dev_batch = get_data_loader(dev_set, shuffle = False)
 
     start_time = time.time()
     report_state_loss, report_loc_loss = 0, 0
@@ -358,37 +646,43 @@ def evaluate(dev_set, model, tb_writer, report_cnt: int):
     with torch.no_grad():
         for batch in dev_batch:
 
-            paragraphs = batch['paragraph']
-            token_ids = plm_tokenizer.batch_encode_plus(paragraphs, add_special_tokens=True,
-                                                        return_tensors='pt')['input_ids']
+            token_ids = batch['token_ids']
             sentence_mask = batch['sentence_mask']
             entity_mask = batch['entity_mask']
             verb_mask = batch['verb_mask']
             loc_mask = batch['loc_mask']
             gold_loc_seq = batch['gold_loc_seq']
             gold_state_seq = batch['gold_state_seq']
-            cpnet_triples = batch['cpnet']
+            cpnet_ids = batch['cpnet_ids']
+            cpnet_mask = batch['cpnet_mask']
+            para_index = batch.get('para_index')
             state_rel_labels = batch['state_rel_labels']
             loc_rel_labels = batch['loc_rel_labels']
             metadata = batch['metadata']
             num_cands = torch.IntTensor([meta['total_loc_cands'] + 1 for meta in metadata])  # +1 for unk
 
             if not opt.no_cuda:
-                token_ids = token_ids.cuda()
-                sentence_mask = sentence_mask.cuda()
-                entity_mask = entity_mask.cuda()
-                verb_mask = verb_mask.cuda()
-                loc_mask = loc_mask.cuda()
-                gold_loc_seq = gold_loc_seq.cuda()
-                gold_state_seq = gold_state_seq.cuda()
-                state_rel_labels = state_rel_labels.cuda()
-                loc_rel_labels = loc_rel_labels.cuda()
-                num_cands = num_cands.cuda()
+                token_ids = token_ids.cuda(non_blocking = opt.pin_memory)
+                sentence_mask = sentence_mask.cuda(non_blocking = opt.pin_memory)
+                entity_mask = entity_mask.cuda(non_blocking = opt.pin_memory)
+                verb_mask = verb_mask.cuda(non_blocking = opt.pin_memory)
+                loc_mask = loc_mask.cuda(non_blocking = opt.pin_memory)
+                gold_loc_seq = gold_loc_seq.cuda(non_blocking = opt.pin_memory)
+                gold_state_seq = gold_state_seq.cuda(non_blocking = opt.pin_memory)
+                state_rel_labels = state_rel_labels.cuda(non_blocking = opt.pin_memory)
+                loc_rel_labels = loc_rel_labels.cuda(non_blocking = opt.pin_memory)
+                cpnet_ids = cpnet_ids.cuda(non_blocking = opt.pin_memory)
+                cpnet_mask = cpnet_mask.cuda(non_blocking = opt.pin_memory)
+                if para_index is not None:
+                    para_index = para_index.cuda(non_blocking = opt.pin_memory)
+                num_cands = num_cands.cuda(non_blocking = opt.pin_memory)
 
             eval_result = model(token_ids = token_ids, entity_mask = entity_mask, verb_mask = verb_mask,
                                 loc_mask = loc_mask, gold_loc_seq = gold_loc_seq, gold_state_seq = gold_state_seq,
-                                num_cands = num_cands, sentence_mask = sentence_mask, cpnet_triples = cpnet_triples,
-                                state_rel_labels = state_rel_labels, loc_rel_labels = loc_rel_labels)
+                                num_cands = num_cands, sentence_mask = sentence_mask,
+                                cpnet_ids = cpnet_ids, cpnet_mask = cpnet_mask,
+                                state_rel_labels = state_rel_labels, loc_rel_labels = loc_rel_labels,
+                                para_index = para_index)
 
             eval_state_loss, eval_loc_loss, eval_attn_loss, eval_state_correct,\
             eval_state_pred, eval_loc_correct, eval_loc_pred, eval_attn_pred = eval_result
@@ -411,10 +705,16 @@ def evaluate(dev_set, model, tb_writer, report_cnt: int):
 
             batch_cnt += 1
 
+    if opt.distributed:  # the last shards may be empty
+        report_state_loss, report_loc_loss, report_state_correct, report_state_pred, \
+        report_loc_correct, report_loc_pred, report_attn_loss, report_attn_pred = all_reduce_sum([
+            report_state_loss, report_loc_loss, report_state_correct, report_state_pred,
+            report_loc_correct, report_loc_pred, report_attn_loss, report_attn_pred])
+
     state_loss = report_state_loss / report_state_pred  # average over all elements
     loc_loss = report_loc_loss / report_loc_pred
     total_loss = state_loss + opt.loc_loss * loc_loss
-    if eval_attn_loss is not None:
+    if report_attn_pred > 0:  # no attention loss without ConceptNet
         attn_loss = report_attn_loss / report_attn_pred
         total_loss += opt.attn_loss * attn_loss
     else:
@@ -433,8 +733,9 @@ def evaluate(dev_set, model, tb_writer, report_cnt: int):
            f'\tTime Elapse: {time.time() - start_time:.2f}s')
     output('*' * 50)
 
-    tb_writer.add_scalar('eval_state_loss', state_loss, report_cnt)
-    tb_writer.add_scalar('eval_loc_loss', loc_loss, report_cnt)
+    if tb_writer is not None:
+        tb_writer.add_scalar('eval_state_loss', state_loss, report_cnt)
+        tb_writer.add_scalar('eval_loc_loss', loc_loss, report_cnt)
 
     return total_accuracy * 100
 
@@ -442,7 +743,7 @@ def evaluate(dev_set, model, tb_writer, report_cnt: int):
 def test(test_set, model):
 
     print('[INFO] Start testing...')
-    test_batch = DataLoader(dataset=test_set, batch_size=opt.batch_size, shuffle=False, collate_fn=Collate())
+    test_batch = get_data_loader(test_set, shuffle = False)
 
     start_time = time.time()
     report_state_correct, report_state_pred = 0, 0
@@ -454,40 +755,36 @@ def test(test_set, model):
         for batch in test_batch:
 
             paragraphs = batch['paragraph']
-            token_ids = plm_tokenizer.batch_encode_plus(paragraphs, add_special_tokens=True,
-                                                        return_tensors='pt')['input_ids']
+            token_ids = batch['token_ids']
 
             sentence_mask = batch['sentence_mask']
             entity_mask = batch['entity_mask']
             verb_mask = batch['verb_mask']
             loc_mask = batch['loc_mask']
-            gold_loc_seq = batch['gold_loc_seq']
-            gold_state_seq = batch['gold_state_seq']
-            cpnet_triples = batch['cpnet']
-            state_rel_labels = batch['state_rel_labels']
-            loc_rel_labels = batch['loc_rel_labels']
+            cpnet_ids = batch['cpnet_ids']
+            cpnet_mask = batch['cpnet_mask']
+            para_index = batch.get('para_index')
             metadata = batch['metadata']
             num_cands = torch.IntTensor([meta['total_loc_cands'] + 1 for meta in metadata])  # +1 for unk
 
             if not opt.no_cuda:
-                token_ids = token_ids.cuda()
-                sentence_mask = sentence_mask.cuda()
-                entity_mask = entity_mask.cuda()
-                verb_mask = verb_mask.cuda()
-                loc_mask = loc_mask.cuda()
-                gold_loc_seq = gold_loc_seq.cuda()
-                gold_state_seq = gold_state_seq.cuda()
-                state_rel_labels = state_rel_labels.cuda()
-                loc_rel_labels = loc_rel_labels.cuda()
-                num_cands = num_cands.cuda()
-
-            test_result = model(token_ids=token_ids, entity_mask=entity_mask, verb_mask=verb_mask,
-                                loc_mask=loc_mask, gold_loc_seq=gold_loc_seq, gold_state_seq=gold_state_seq,
-                                num_cands=num_cands, sentence_mask=sentence_mask, cpnet_triples=cpnet_triples,
-                                state_rel_labels=state_rel_labels, loc_rel_labels=loc_rel_labels)
-
-            pred_state_seq, pred_loc_seq, test_state_correct, test_state_pred,\
-                test_loc_correct, test_loc_pred = test_result
+                token_ids = token_ids.cuda(non_blocking = opt.pin_memory)
+                sentence_mask = sentence_mask.cuda(non_blocking = opt.pin_memory)
+                entity_mask = entity_mask.cuda(non_blocking = opt.pin_memory)
+                verb_mask = verb_mask.cuda(non_blocking = opt.pin_memory)
+                loc_mask = loc_mask.cuda(non_blocking = opt.pin_memory)
+                cpnet_ids = cpnet_ids.cuda(non_blocking = opt.pin_memory)
+                cpnet_mask = cpnet_mask.cuda(non_blocking = opt.pin_memory)
+                if para_index is not None:
+                    para_index = para_index.cuda(non_blocking = opt.pin_memory)
+                num_cands = num_cands.cuda(non_blocking = opt.pin_memory)
+
+            # gold labels are not needed for prediction, and they are absent in unlabeled data
+            pred_state_seq, pred_loc_seq = model.predict(token_ids = token_ids, entity_mask = entity_mask,
+                                                         verb_mask = verb_mask, loc_mask = loc_mask,
+                                                         num_cands = num_cands, sentence_mask = sentence_mask,
+                                                         cpnet_ids = cpnet_ids, cpnet_mask = cpnet_mask,
+                                                         para_index = para_index)
 
             batch_size = len(paragraphs)
             for i in range(batch_size):
@@ -496,21 +793,28 @@ def test(test_set, model):
                 entity_name = pred_instance['entity']
                 output_result[str(para_id) + '-' + entity_name] = pred_instance
 
-            report_state_correct += test_state_correct
-            report_state_pred += test_state_pred
-            report_loc_correct += test_loc_correct
-            report_loc_pred += test_loc_pred
+            if 'gold_state_seq' in batch:
+                test_state_correct, test_state_pred = compute_state_accuracy(pred = pred_state_seq,
+                                                                             gold = batch['gold_state_seq'].tolist(),
+                                                                             pad_value = PAD_STATE)
+                test_loc_correct, test_loc_pred = compute_pred_loc_accuracy(pred = pred_loc_seq,
+                                                                            gold = batch['gold_loc_seq'].tolist())
+                report_state_correct += test_state_correct
+                report_state_pred += test_state_pred
+                report_loc_correct += test_loc_correct
+                report_loc_pred += test_loc_pred
 
             batch_cnt += 1
 
-    total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
-    state_accuracy = report_state_correct / report_state_pred
-    loc_accuracy = report_loc_correct / report_loc_pred
+    if report_state_pred > 0:
+        total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
+        state_accuracy = report_state_correct / report_state_pred
+        loc_accuracy = report_loc_correct / report_loc_pred
 
-    output(f'Test:\n'
-           f'Total Accuracy: {total_accuracy * 100:.3f}%, '
-           f'State Prediction Accuracy: {state_accuracy * 100:.3f}%, '
-           f'Location Accuracy: {loc_accuracy * 100:.3f}%')
+        output(f'Test:\n'
+               f'Total Accuracy: {total_accuracy * 100:.3f}%, '
+               f'State Prediction Accuracy: {state_accuracy * 100:.3f}%, '
+               f'Location Accuracy: {loc_accuracy * 100:.3f}%')
 
     write_output(output = output_result, dummy_filepath = opt.dummy_test, output_filepath = opt.output)
     print(f'[INFO] Test finished. Time elapse: {time.time() - start_time}s')
@@ -520,6 +824,8 @@ if __name__ == "__main__":
 
     if opt.mode == 'train':
         train()
+        if opt.distributed:
+            dist.destroy_process_group()
 
     elif opt.mode == 'test':
         if not opt.restore:
@@ -540,11 +846,19 @@ if __name__ == "__main__":
 
         print('[INFO] Start loading trained model...')
         restore_start_time = time.time()
-        model = KOALA(opt = opt, is_test = True)
-        model_state_dict = torch.load(opt.restore)
-        model.load_state_dict(model_state_dict)
+        if opt.restore.endswith('.safetensors'):  # written by -export_model, no need to initialize the model
+            model = load_flat_model(lambda: KOALA(opt = opt, is_test = True), opt.restore)
+        else:
+            model = KOALA(opt = opt, is_test = True)
+            model_state_dict = torch.load(opt.restore)
+            model.load_checkpoint_state_dict(model_state_dict)
         model.eval()
         print(f'[INFO] Loaded model from {opt.restore}, time elapse: {time.time() - restore_start_time}s')
+        if opt.export_model is not None:
+            save_flat_model(model, opt.export_model, shared_modules = list(model.encoder_sources))
+            print(f'[INFO] Exported model to {opt.export_model}')
+        if opt.cpnet_cache is not None:
+            model.set_cpnet_cache(opt.cpnet_cache, max_ram_mb = opt.cpnet_cache_ram)
 
         if not opt.no_cuda:
             model.cuda()
@@ -5,9 +5,12 @@
  @homepage: ytyz1307zzh.github.io
 '''
 
+import os
 import json
+import hashlib
 import torch
-from typing import List, Set, Dict
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from typing import List, Set, Dict, Iterable, Optional
 import numpy as np
 from Constants import *
 import re
@@ -130,6 +133,178 @@ def find_allzero_rows(vector: torch.IntTensor) -> torch.BoolTensor:
     return column_sum == 0
 
 
+class SpanMask:
+    """
+    Sparse form of a binary mask of size (..., num_tokens). Instead of the dense 0/1 tensor,
+    only the positions of the masked-in tokens are kept, each with the id of the segment
+    (row of the dense mask, flattened over all leading dimensions) that it belongs to.
+    For a batch of masks, the leading dimensions include the batch dimension.
+    """
+    def __init__(self, token_idx: torch.LongTensor, segment_idx: torch.LongTensor, shape):
+        assert token_idx.size() == segment_idx.size()
+        self.token_idx = token_idx  # (num_mentions,)
+        self.segment_idx = segment_idx  # (num_mentions,), sorted in ascending order
+        self.shape = torch.Size(shape)  # size of the equivalent dense mask
+
+    def size(self, dim: int = None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def num_segments(self) -> int:
+        return int(np.prod(self.shape[:-1]))
+
+    def to(self, *args, **kwargs):
+        return SpanMask(token_idx=self.token_idx.to(*args, **kwargs),
+                        segment_idx=self.segment_idx.to(*args, **kwargs), shape=self.shape)
+
+    def cuda(self, non_blocking: bool = False):
+        return SpanMask(token_idx=self.token_idx.cuda(non_blocking=non_blocking),
+                        segment_idx=self.segment_idx.cuda(non_blocking=non_blocking), shape=self.shape)
+
+    def pin_memory(self):
+        return SpanMask(token_idx=self.token_idx.pin_memory(),
+                        segment_idx=self.segment_idx.pin_memory(), shape=self.shape)
+
+    @staticmethod
+    def from_dense(mask: torch.IntTensor) -> 'SpanMask':
+        nonzero = mask.reshape(-1, mask.size(-1)).nonzero()  # row-major, so segment ids are sorted
+        return SpanMask(token_idx=nonzero[:, 1], segment_idx=nonzero[:, 0], shape=mask.size())
+
+    def to_dense(self) -> torch.IntTensor:
+        dense = torch.zeros(self.num_segments(), self.shape[-1], dtype=torch.int, device=self.token_idx.device)
+        dense[self.segment_idx, self.token_idx] = 1
+        return dense.view(self.shape)
+
+    def repad(self, shape) -> 'SpanMask':
+        """
+        Re-index the segments as if the dense mask was zero-padded to a larger size.
+        """
+        assert len(shape) == len(self.shape)
+        segment_idx = self.segment_idx
+        new_segment_idx = torch.zeros_like(segment_idx)
+        stride, new_stride = 1, 1
+        for dim in range(len(self.shape) - 2, -1, -1):
+            assert shape[dim] >= self.shape[dim]
+            coord = (segment_idx // stride) % self.shape[dim]
+            new_segment_idx += coord * new_stride
+            stride *= self.shape[dim]
+            new_stride *= shape[dim]
+        return SpanMask(token_idx=self.token_idx, segment_idx=new_segment_idx, shape=shape)
+
+    @staticmethod
+    def stack(masks: List['SpanMask'], shape) -> 'SpanMask':
+        """
+        Batch a list of instance masks, zero-padding each of them to size 'shape'.
+        The output has size (batch, *shape).
+        """
+        segments_per_instance = int(np.prod(shape[:-1]))
+        token_idx, segment_idx = [], []
+        for i, mask in enumerate(masks):
+            padded_mask = mask.repad(shape)
+            token_idx.append(padded_mask.token_idx)
+            segment_idx.append(padded_mask.segment_idx + i * segments_per_instance)
+        return SpanMask(token_idx=torch.cat(token_idx), segment_idx=torch.cat(segment_idx),
+                        shape=(len(masks),) + tuple(shape))
+
+
+def span_masked_mean(source: torch.Tensor, mask: SpanMask) -> torch.Tensor:
+    """
+    Average the token representations selected by a batched SpanMask with segment reductions.
+    Equivalent to the masked mean over a dense mask, where all-zero rows give all-zero vectors.
+    Args:
+        source - token representations, size (batch, max_tokens, hidden)
+        mask - SpanMask of dense size (batch, ..., max_tokens)
+    Return:
+        the average of the selected tokens of each segment, size (batch, ..., hidden)
+    """
+    batch_size, max_tokens, hidden_size = source.size()
+    assert mask.size(0) == batch_size and mask.size(-1) == max_tokens
+    num_segments = mask.num_segments()
+    segments_per_instance = num_segments // batch_size
+
+    # position of each selected token in the flattened (batch * max_tokens) source
+    source_idx = (mask.segment_idx // segments_per_instance) * max_tokens + mask.token_idx
+    selected = source.reshape(batch_size * max_tokens, hidden_size).index_select(0, source_idx)
+    segment_sum = source.new_zeros(num_segments, hidden_size).index_add_(0, mask.segment_idx, selected)
+
+    num_tokens = torch.bincount(mask.segment_idx, minlength=num_segments).unsqueeze(dim=-1)
+    segment_mean = segment_sum / num_tokens.clamp(min=1).to(source.dtype)  # empty segments stay 0
+    return segment_mean.view(*mask.size()[:-1], hidden_size)
+
+
+def masked_mean(source: torch.Tensor, mask) -> torch.Tensor:
+    """
+    Average the token representations selected by each row of a binary mask.
+    Dense masks are normalized by their number of selected tokens and multiplied with source in one batched matmul,
+    SpanMasks are pooled by segment reductions. All-zero rows give all-zero vectors.
+    Args:
+        source - token representations, size (batch, max_tokens, hidden)
+        mask - binary masks of size (batch, ..., max_tokens), dense or SpanMask
+    Return:
+        the average of the selected tokens of each row, size (batch, ..., hidden)
+    """
+    if isinstance(mask, SpanMask):
+        return span_masked_mean(source, mask)
+
+    batch_size, max_tokens, hidden_size = source.size()
+    assert mask.size(0) == batch_size and mask.size(-1) == max_tokens
+    weights = mask.reshape(batch_size, -1, max_tokens).to(source.dtype, copy=True)
+    weights /= weights.sum(dim=-1, keepdim=True).clamp(min=1)  # normalize in place, all-zero rows stay 0 instead of nan
+    mean = torch.bmm(weights, source)
+    return mean.view(*mask.size()[:-1], hidden_size)
+
+
+def run_packed_lstm(lstm: torch.nn.LSTM, input: torch.Tensor, lengths: torch.Tensor, pack: bool = True) -> torch.Tensor:
+    """
+    Run a batch-first LSTM over packed sequences, so that padding steps are neither computed
+    nor read by the backward direction. Sequences of length 0 are not run at all.
+    If pack is False, the other sequences are run with their padding as by lstm(input), so their outputs
+    are the same as without this function (e.g., for models trained with padded LSTMs).
+    Under autocast, the LSTM runs in the autocast dtype, which is also the dtype of the output.
+    Args:
+        input - size (batch, max_len, input_size)
+        lengths - number of real steps of each sequence, size (batch,)
+    Return:
+        LSTM outputs of size (batch, max_len, num_directions * hidden_size), zeros for the sequences of length 0,
+        and also zeros at padding steps if pack is True
+    """
+    batch_size, max_len, _ = input.size()
+    output_size = lstm.hidden_size * (2 if lstm.bidirectional else 1)
+    if torch.is_autocast_enabled(input.device.type):  # autocast does not cast packed inputs by itself
+        input = input.to(torch.get_autocast_dtype(input.device.type))
+    lengths = lengths.cpu()  # pack_padded_sequence requires lengths on cpu
+    real_index = lengths.nonzero(as_tuple=True)[0]
+    if real_index.numel() == 0:
+        return input.new_zeros(batch_size, max_len, output_size)
+
+    if real_index.numel() < batch_size:  # only gather the non-empty sequences
+        real_input = input.index_select(0, real_index.to(input.device))
+        real_lengths = lengths.index_select(0, real_index)
+    else:
+        real_input, real_lengths = input, lengths
+
+    if pack:
+        packed_input = pack_padded_sequence(real_input, real_lengths, batch_first=True, enforce_sorted=False)
+        packed_output, _ = lstm(packed_input)
+        real_output, _ = pad_packed_sequence(packed_output, batch_first=True, total_length=max_len)
+    else:
+        real_output, _ = lstm(real_input)
+
+    if real_index.numel() < batch_size:  # scatter back, empty sequences get zeros
+        output = input.new_zeros(batch_size, max_len, output_size)
+        return output.index_copy(0, real_index.to(input.device), real_output)
+    return real_output
+
+
+def precision_autocast(precision: str, device_type: str):
+    """
+    Autocast context of the -precision option. 'bf16' runs the matmuls (and LSTMs) inside the context
+    in bfloat16, 'fp32' disables autocast. Outputs of the context should be cast back to float
+    before masked means, softmax and losses.
+    """
+    assert precision in ['fp32', 'bf16']
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=(precision == 'bf16'))
+
+
 def compute_state_accuracy(pred: List[List[int]], gold: List[List[int]], pad_value: int) -> (int, int):
     """
     Given the predicted tags and gold tags, compute the prediction accuracy.
@@ -165,6 +340,23 @@ def compute_loc_accuracy(logits: torch.FloatTensor, gold: torch.IntTensor, pad_v
     return correct_pred.item(), total_pred.item()
 
 
+def compute_pred_loc_accuracy(pred: List[List[int]], gold: List[List[int]]) -> (int, int):
+    """
+    Given the predicted location sequences (e.g., from KOALA.predict) and the padded gold location sequences,
+    compute the location prediction accuracy. Undefined gold locations (NIL, UNK, PAD) do not count.
+    """
+    assert len(pred) == len(gold)
+    correct_pred = 0
+    total_pred = 0
+
+    for i in range(len(pred)):
+        inst_gold = np.array(gold[i][:len(pred[i])])
+        total_pred += np.sum(inst_gold >= 0)
+        correct_pred += np.sum(np.equal(pred[i], inst_gold) & (inst_gold >= 0))
+
+    return int(correct_pred), int(total_pred)
+
+
 def get_pred_loc(loc_logits: torch.Tensor, gold_loc_seq: torch.IntTensor) -> List[List[int]]:
     """
     Get the predicted location sequence from raw logits.
@@ -198,6 +390,51 @@ def get_report_time(total_batches: int, report_times: int, grad_accum_step: int)
     return report_batch
 
 
+def count_padding(metadata: List[Dict]) -> np.ndarray:
+    """
+    Count the real and padded workload of a batch, on paragraph tokens and on location masks.
+    The location workload is proportional to the number of candidates * sentences * tokens.
+    Return:
+        an array of [real_tokens, padded_tokens, real_loc, padded_loc]
+    """
+    total_subwords = np.array([meta['total_subwords'] for meta in metadata])
+    total_sents = np.array([meta['total_sents'] for meta in metadata]) + 1  # +1 for location 0
+    total_loc_cands = np.array([meta['total_loc_cands'] for meta in metadata])
+    batch_size = len(metadata)
+
+    real_tokens = total_subwords.sum()
+    padded_tokens = batch_size * total_subwords.max()
+    real_loc = (total_loc_cands * total_sents * total_subwords).sum()
+    padded_loc = batch_size * total_loc_cands.max() * total_sents.max() * total_subwords.max()
+    return np.array([real_tokens, padded_tokens, real_loc, padded_loc], dtype=np.int64)
+
+
+def hash_state_dict(module: torch.nn.Module) -> str:
+    """
+    md5 digest of the names, shapes, dtypes and values of all parameters and buffers of a module.
+    """
+    md5 = hashlib.md5()
+    for name, tensor in sorted(module.state_dict().items()):
+        md5.update(f'{name}:{tuple(tensor.shape)}:{tensor.dtype};'.encode('utf-8'))
+        md5.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return md5.hexdigest()
+
+
+def get_pretrained_dir(source: str) -> Optional[str]:
+    """
+    Local directory of the pretrained weights of a model name or path: the path itself, or the snapshot of a model
+    downloaded from the huggingface hub. None if there is no such directory (e.g., with versions of transformers
+    that keep downloaded models in their own cache, without huggingface_hub).
+    """
+    if os.path.isdir(source):
+        return source
+    try:
+        from huggingface_hub import snapshot_download
+        return snapshot_download(source, local_files_only = True)
+    except (ImportError, OSError, ValueError):  # not downloaded, or not a hub model
+        return None
+
+
 def bert_subword_map(origin_tokens: List[str], tokens: List[str]) -> List[int]:
     """
     Map the original tokens to tokenized BERT sub-tokens.
@@ -236,54 +473,93 @@ def remove_stopword(paragraph: str) -> Set[str]:
     return {word for word in paragraph if word not in STOP_WORDS and word.isalpha()}
 
 
-def find_relevant_triple(gold_loc_seq: List[str], gold_state_seq: List[str], verb_dict: Dict, cpnet_triples: List[str]):
+class StemVocab:
+    """
+    Vocabulary of stemmed words. A text is converted to the sorted array of the vocab ids of its stemmed
+    content words, so that the token sets of different texts can be intersected with numpy.
+    """
+    def __init__(self):
+        self.stem2id = {}
+        self.word2stem = {}  # the stemmer is slow, so each distinct word is only stemmed once
+        self.text2ids = {}
+
+    def __len__(self):
+        return len(self.stem2id)
+
+    def get_ids(self, stems: Iterable[str]) -> np.ndarray:
+        """
+        Get the vocab ids of a set of already stemmed words, as a sorted array.
+        """
+        ids = [self.stem2id.setdefault(stem, len(self.stem2id)) for stem in set(stems)]
+        return np.array(sorted(ids), dtype=np.int64)
+
+    def encode(self, text: str) -> np.ndarray:
+        """
+        Get the vocab ids of the stemmed content words of a text, as a sorted array.
+        """
+        if text not in self.text2ids:
+            stems = []
+            for word in remove_stopword(text):
+                if word not in self.word2stem:
+                    self.word2stem[word] = stemmer.stem(word)
+                stems.append(self.word2stem[word])
+            self.text2ids[text] = self.get_ids(stems)
+        return self.text2ids[text]
+
+
+def match_token_sets(queries: List[np.ndarray], targets: List[np.ndarray]) -> np.ndarray:
+    """
+    Check whether each query token set intersects with each target token set.
+    Args:
+        queries, targets - token sets given by sorted arrays of unique vocab ids
+    Return:
+        a boolean matrix of size (num_queries, num_targets)
+    """
+    if not queries or not targets:
+        return np.zeros((len(queries), len(targets)), dtype=bool)
+    target_tokens = np.concatenate(targets)
+    query_tokens = np.concatenate(queries)
+
+    # incidence matrices of the targets and the queries over the vocab of the targets
+    vocab, target_cols = np.unique(target_tokens, return_inverse=True)
+    target_rows = np.repeat(np.arange(len(targets)), [len(tokens) for tokens in targets])
+    target_matrix = np.zeros((len(targets), len(vocab)), dtype=np.int32)
+    target_matrix[target_rows, target_cols] = 1
+
+    query_rows = np.repeat(np.arange(len(queries)), [len(tokens) for tokens in queries])
+    query_cols = np.searchsorted(vocab, query_tokens).clip(max=len(vocab) - 1)
+    in_vocab = vocab[query_cols] == query_tokens
+    query_matrix = np.zeros((len(queries), len(vocab)), dtype=np.int32)
+    query_matrix[query_rows[in_vocab], query_cols[in_vocab]] = 1
+
+    return (query_matrix @ target_matrix.T) > 0
+
+
+def find_relevant_triple(gold_loc_seq: List[str], gold_state_seq: List[str], state_token_ids: Dict[str, np.ndarray],
+                         triple_token_ids: List[np.ndarray], stem_vocab: StemVocab):
     """
     Find relevant triples for computing attention loss.
     Two categories: state-relevant and location-relevant
+    Args:
+        state_token_ids - vocab ids of the co-appearance verbs of states 'C', 'M' and 'D'
+        triple_token_ids - vocab ids of the stemmed content words of each ConceptNet triple
+        stem_vocab - the vocab used to encode the gold locations
+    Return:
+        state_rel_labels - size (num_sents, num_cpnet)
+        loc_rel_labels - size (num_sents + 1, num_cpnet), location 0 is never relevant
     """
-
     assert len(gold_state_seq) == len(gold_loc_seq) - 1
-    state_rel_labels, loc_rel_labels = [], []
-
-    # deal with location 0
-    loc_rel_list = [0 for _ in range(len(cpnet_triples))]
-    loc_rel_labels.append(loc_rel_list)
-
-    for sent_idx in range(len(gold_state_seq)):
-        state_rel_list, loc_rel_list = [], []
-        location = gold_loc_seq[sent_idx + 1]
-        state = gold_state_seq[sent_idx]
-
-        state_token_set = None
-        if state == 'C':
-            state_token_set = set(verb_dict['create'])
-        elif state == 'M':
-            state_token_set = set(verb_dict['move'])
-        elif state == 'D':
-            state_token_set = set(verb_dict['destroy'])
-
-        loc_token_set = remove_stopword(location)
-        loc_token_set = set(map(stemmer.stem, loc_token_set))
-
-        for triple in cpnet_triples:
-            token_set = remove_stopword(triple)
-            token_set = set(map(stemmer.stem, token_set))
-
-            if state_token_set is not None and token_set.intersection(state_token_set):
-                state_rel_list.append(1)
-            else:
-                state_rel_list.append(0)
-
-            if state in ['C', 'M'] and token_set.intersection(loc_token_set):
-                loc_rel_list.append(1)
-            else:
-                loc_rel_list.append(0)
-
-        state_rel_labels.append(state_rel_list)
-        loc_rel_labels.append(loc_rel_list)
-
-    state_rel_labels = torch.tensor(state_rel_labels, dtype=torch.int)
-    loc_rel_labels = torch.tensor(loc_rel_labels, dtype=torch.int)
+    empty_set = np.zeros(0, dtype=np.int64)
+
+    state_queries = [state_token_ids.get(state, empty_set) for state in gold_state_seq]
+    loc_queries = [stem_vocab.encode(gold_loc_seq[sent_idx + 1]) if state in ['C', 'M'] else empty_set
+                   for sent_idx, state in enumerate(gold_state_seq)]
+    relevance = match_token_sets(state_queries + loc_queries, triple_token_ids).astype(np.int32)
+
+    num_sents = len(gold_state_seq)
+    state_rel_labels = torch.from_numpy(relevance[:num_sents])
+    loc_rel_labels = torch.zeros((num_sents + 1, len(triple_token_ids)), dtype=torch.int)
+    loc_rel_labels[1:] = torch.from_numpy(relevance[num_sents:])
 
     return state_rel_labels, loc_rel_labels
 